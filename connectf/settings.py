@@ -156,12 +156,34 @@ CACHES = {
         'TIMEOUT': 3600
     },
     'default': {
-        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'BACKEND': 'querytgdb.cache.CompressedFileBasedCache',
         'LOCATION': tempfile.gettempdir(),
-        'TIMEOUT': 3600
+        'TIMEOUT': 3600,
+        'OPTIONS': {
+            # zstd, lz4, zlib or none, defaults to the fastest installed
+            'CODEC': CONFIG.get('CACHE_CODEC')
+        }
     },
 }
 
+# Memory limit in bytes for caching intermediate query results in each process
+QUERY_CACHE_SIZE = CONFIG.get('QUERY_CACHE_SIZE', 512 * 1024 ** 2)
+
+# Threads evaluating the queries of an expand function in each request, each opens its own database connection
+QUERY_EXPAND_WORKERS = CONFIG.get('QUERY_EXPAND_WORKERS', 4)
+
+# Directory for memory-mapped snapshots of the edge tables shared by worker processes, one subdirectory per database
+SNAPSHOT_DIR = CONFIG.get('SNAPSHOT_DIR', os.path.join(tempfile.gettempdir(), 'connectf_snapshots'))
+
+# Directory for the column arrays of query results, the manifests are kept in the default cache
+RESULT_DIR = CONFIG.get('RESULT_DIR', os.path.join(tempfile.gettempdir(), 'connectf_results'))
+
+# Serve per-process cache statistics at cache_stats/ when not in DEBUG
+CACHE_STATS_ENABLED = CONFIG.get('CACHE_STATS_ENABLED', False)
+
+# Warm motif caches and named query results when a worker starts, see the warm_cache command
+WARM_CACHE_ON_STARTUP = CONFIG.get('WARM_CACHE_ON_STARTUP', False)
+
 # Configure motif annotation file and cluster definitions here
 MOTIF_ANNOTATION = CONFIG.get('MOTIF_ANNOTATION',
                               os.path.join(BASE_DIR, 'data', 'motifs.csv.gz'))
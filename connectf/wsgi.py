@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "connectf.settings")
 
 application = get_wsgi_application()
+
+from querytgdb.utils.warmup import warm_on_startup
+
+warm_on_startup()
@@ -0,0 +1,262 @@
+import os
+import pickle
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.files import locks
+from django.core.files.move import file_move_safe
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+MAGIC = b'CFC1'
+HEADER = struct.Struct('<4sBI')
+LENGTH = struct.Struct('<Q')
+
+# out-of-band buffers smaller than this are kept in the pickle stream
+MIN_BUFFER_SIZE = 64 * 1024
+
+
+class Codec(NamedTuple):
+    name: str
+    compress: Callable[[bytes], bytes]
+    decompress: Callable[[bytes], bytes]
+
+
+CODECS: Dict[int, Codec] = OrderedDict()
+
+if zstandard is not None:
+    CODECS[3] = Codec('zstd',
+                      lambda b: zstandard.ZstdCompressor(level=1).compress(b),
+                      lambda b: zstandard.ZstdDecompressor().decompress(b))
+
+if lz4 is not None:
+    CODECS[2] = Codec('lz4', lz4.frame.compress, lz4.frame.decompress)
+
+CODECS[1] = Codec('zlib', lambda b: zlib.compress(b, 1), zlib.decompress)
+CODECS[0] = Codec('none', bytes, bytes)
+
+
+def get_codec_id(name: Optional[str] = None) -> int:
+    """
+    Get id of a codec by name, or of the fastest available codec if None
+
+    Unavailable codecs fall back to zlib.
+    """
+    if name is None:
+        return next(iter(CODECS))
+
+    for codec_id, codec in CODECS.items():
+        if codec.name == name:
+            return codec_id
+
+    return 1
+
+
+def get_family(key: str) -> str:
+    """
+    Strip the query uid or digest from a cache key, so keys of the same kind are counted together
+    """
+    return key.rsplit('/', 1)[-1]
+
+
+class CacheStats:
+    """
+    Per process counts of cache reads and writes by key family
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families: Dict[str, Dict[str, float]] = defaultdict(lambda: dict.fromkeys(
+            ('hits', 'misses', 'writes', 'raw_bytes', 'bytes', 'encode_time', 'decode_time'), 0))
+
+    def record(self, key: str, **counts: float):
+        with self.lock:
+            family = self.families[get_family(key)]
+
+            for name, value in counts.items():
+                family[name] += value
+
+    def to_dict(self) -> Dict[str, Dict[str, float]]:
+        with self.lock:
+            return {k: dict(v) for k, v in sorted(self.families.items())}
+
+    def clear(self):
+        with self.lock:
+            self.families.clear()
+
+
+stats = CacheStats()
+
+
+def encode(value: Any, codec_id: int, protocol: int = pickle.HIGHEST_PROTOCOL) -> Tuple[bytes, int]:
+    """
+    Pickle and compress a value
+
+    Array data of DataFrames and numpy arrays is pickled out-of-band where supported, and compressed
+    separately from the rest of the object.
+
+    :return: encoded bytes and the uncompressed size
+    """
+    buffers: List[pickle.PickleBuffer] = []
+
+    if sys.version_info >= (3, 8) and protocol >= 5:
+        def buffer_callback(buf: pickle.PickleBuffer) -> bool:
+            if buf.raw().nbytes < MIN_BUFFER_SIZE:
+                return True
+
+            buffers.append(buf)
+            return False
+
+        parts = [pickle.dumps(value, protocol, buffer_callback=buffer_callback)]
+        parts.extend(buf.raw() for buf in buffers)
+    else:
+        parts = [pickle.dumps(value, protocol)]
+
+    compress = CODECS[codec_id].compress
+    chunks = [HEADER.pack(MAGIC, codec_id, len(parts) - 1)]
+
+    for part in parts:
+        data = compress(part)
+        chunks.append(LENGTH.pack(len(data)))
+        chunks.append(data)
+
+    return b''.join(chunks), sum(memoryview(p).nbytes for p in parts)
+
+
+def decode(data: bytes) -> Any:
+    """
+    Decode value encoded with encode, or with the zlib compressed pickle of the Django file based cache
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        return pickle.loads(zlib.decompress(data))
+
+    _, codec_id, n_buffers = HEADER.unpack_from(data)
+    decompress = CODECS[codec_id].decompress
+
+    view = memoryview(data)
+    offset = HEADER.size
+    parts = []
+
+    for i in range(n_buffers + 1):
+        length, = LENGTH.unpack_from(view, offset)
+        offset += LENGTH.size
+        parts.append(decompress(view[offset:offset + length]))
+        offset += length
+
+    if n_buffers:
+        # arrays are read-only unless their buffers are mutable
+        return pickle.loads(parts[0], buffers=map(bytearray, parts[1:]))
+
+    return pickle.loads(parts[0])
+
+
+class CompressedFileBasedCache(FileBasedCache):
+    """
+    File based cache with configurable compression and per key family statistics
+
+    Set OPTIONS['CODEC'] to zstd, lz4, zlib or none. Codecs whose packages are not installed fall back to zlib,
+    files are readable whatever codec wrote them.
+    """
+
+    def __init__(self, dir, params):
+        options = params.get('OPTIONS', {})
+        self.codec_id = get_codec_id(options.get('CODEC'))
+
+        super().__init__(dir, {**params, 'OPTIONS': {k: v for k, v in options.items() if k != 'CODEC'}})
+
+    def get(self, key, default=None, version=None):
+        fname = self._key_to_file(key, version)
+
+        try:
+            with open(fname, 'rb') as f:
+                if not self._is_expired(f):
+                    data = f.read()
+
+                    start = time.perf_counter()
+                    value = decode(data)
+                    stats.record(key, hits=1, decode_time=time.perf_counter() - start)
+
+                    return value
+        except FileNotFoundError:
+            pass
+
+        stats.record(key, misses=1)
+
+        return default
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._createdir()
+        fname = self._key_to_file(key, version)
+        self._cull()
+        fd, tmp_path = tempfile.mkstemp(dir=self._dir)
+        renamed = False
+
+        try:
+            with open(fd, 'wb') as f:
+                counts = self._write_content(f, timeout, value)
+            file_move_safe(tmp_path, fname, allow_overwrite=True)
+            renamed = True
+        finally:
+            if not renamed:
+                os.remove(tmp_path)
+
+        stats.record(key, writes=1, **counts)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        try:
+            with open(self._key_to_file(key, version), 'r+b') as f:
+                try:
+                    locks.lock(f, locks.LOCK_EX)
+
+                    if self._is_expired(f):
+                        return False
+
+                    value = decode(f.read())
+                    f.seek(0)
+
+                    counts = self._write_content(f, timeout, value)
+                    f.truncate()
+                finally:
+                    locks.unlock(f)
+        except FileNotFoundError:
+            return False
+
+        stats.record(key, writes=1, **counts)
+
+        return True
+
+    def _write_content(self, file, timeout, value) -> Dict[str, float]:
+        """
+        Write expiry and encoded value
+        :return: sizes and encoding time for stats
+        """
+        expiry = self.get_backend_timeout(timeout)
+        file.write(pickle.dumps(expiry, self.pickle_protocol))
+
+        start = time.perf_counter()
+        data, raw_size = encode(value, self.codec_id, self.pickle_protocol)
+        encode_time = time.perf_counter() - start
+
+        file.write(data)
+
+        return {'raw_bytes': raw_size, 'bytes': len(data), 'encode_time': encode_time}
+
+    @property
+    def codec(self) -> str:
+        return CODECS[self.codec_id].name
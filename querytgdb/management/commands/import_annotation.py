@@ -2,8 +2,10 @@ from operator import itemgetter
 
 import pandas as pd
 from django.core.management.base import BaseCommand, CommandParser
+from django.db.transaction import on_commit
 
 from querytgdb.utils.insert_data import import_annotations
+from querytgdb.utils.snapshot import clear_snapshots
 from ...models import Annotation
 
 
@@ -28,3 +30,6 @@ class Command(BaseCommand):
 
         elif infile:
             import_annotations(infile, dry_run=options['dry_run'], delete_existing=options['delete'])
+
+            if not options['dry_run']:
+                on_commit(lambda: clear_snapshots('annotations'))
@@ -3,9 +3,10 @@ import os.path as path
 
 import pandas as pd
 from django.core.management.base import BaseCommand, CommandError
-from django.db.transaction import atomic
+from django.db.transaction import atomic, on_commit
 
 from querytgdb.utils.insert_data import insert_data
+from querytgdb.utils.snapshot import clear_snapshots
 
 
 def get_file_name(x):
@@ -47,6 +48,9 @@ class Command(BaseCommand):
                 else:
                     self.stdout.write("inserting {0[data]} {0[metadata]}\n".format(options))
                     insert_data(options['data'], options['metadata'], sep=options["sep"], dry_run=options['dry_run'])
+
+                if not options['dry_run']:
+                    on_commit(clear_snapshots)
             except ValueError as e:
                 raise CommandError(e) from e
             except KeyError as e:
@@ -8,6 +8,8 @@ import yaml
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError, CommandParser
 
+from ...utils.motif_enrichment.motif import compile_annotation_file
+
 
 def gz_copy(src, dst, force=False):
     mtype, enc = mimetypes.guess_type(src)
@@ -32,10 +34,22 @@ class Command(BaseCommand):
         parser.add_argument("-d", "--description", help="motif description (.csv)", type=str)
         parser.add_argument("-m", "--motifs", help="gene to motif counts (.csv)", type=str)
         parser.add_argument("-i", "--individual-motifs", help="gene to individual motif counts (.csv)", type=str)
+        parser.add_argument("-c", "--compile", help="compile the configured motif files for memory-mapped loading",
+                            action='store_true')
+
+    def compile(self, path):
+        try:
+            self.stdout.write(f"Compiled {path} to {compile_annotation_file(path)}")
+        except OSError as e:
+            raise CommandError(f"Could not compile {path}: {e}") from e
 
     def handle(self, *args, **options):
-        if not (options['description'] or options['motifs'] or options['individual_motifs']):
-            raise CommandError("Specify at least one of 'description', 'motifs', or 'individual-motifs'.")
+        if not (options['description'] or options['motifs'] or options['individual_motifs'] or options['compile']):
+            raise CommandError("Specify at least one of 'description', 'motifs', 'individual-motifs', or 'compile'.")
+
+        if options['compile']:
+            for path in (settings.MOTIF_ANNOTATION, settings.MOTIF_TF_ANNOTATION):
+                self.compile(path)
 
         os.makedirs(os.path.join(settings.BASE_DIR, 'data'), exist_ok=True)  # make data directory if not exist
 
@@ -49,11 +63,13 @@ class Command(BaseCommand):
             if options['motifs']:
                 motifs_path = os.path.join(settings.BASE_DIR, 'data/motifs.csv.gz')
                 gz_copy(options['motifs'], motifs_path, force=options['force'])
+                self.compile(motifs_path)
                 opts['MOTIF_ANNOTATION'] = motifs_path
 
             if options['individual_motifs']:
                 motifs_indv_path = os.path.join(settings.BASE_DIR, 'data/motifs_indv.csv.gz')
                 gz_copy(options['individual_motifs'], motifs_indv_path, force=options['force'])
+                self.compile(motifs_indv_path)
                 opts['MOTIF_TF_ANNOTATION'] = motifs_indv_path
 
             # Writes configs back into config.yaml with backup
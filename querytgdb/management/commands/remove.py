@@ -1,7 +1,8 @@
 from django.core.management.base import BaseCommand, CommandParser
-from django.db.transaction import atomic
+from django.db.transaction import atomic, on_commit
 
 from ...models import Analysis
+from ...utils.snapshot import clear_snapshots
 
 
 class Command(BaseCommand):
@@ -58,3 +59,7 @@ class Command(BaseCommand):
 
             else:
                 self.stdout.write("Nothing removed.", ending="\n")
+                return
+
+            if not dry_run:
+                on_commit(clear_snapshots)
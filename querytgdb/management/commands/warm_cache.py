@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from ...utils.warmup import get_tasks, warm_cache
+
+
+class Command(BaseCommand):
+    """
+    Build snapshots and shared query results before the first request after a deploy.
+    """
+
+    def add_arguments(self, parser: CommandParser):
+        parser.add_argument('tasks', nargs='*', help='tasks to run, all if none given')
+        parser.add_argument('-l', '--list', help='list tasks', action='store_true')
+        parser.add_argument('-j', '--jobs', help='number of parallel tasks', type=int)
+
+    def handle(self, *args, **options):
+        names = list(get_tasks())
+
+        if options['list']:
+            self.stdout.write('\n'.join(names))
+            return
+
+        unknown = set(options['tasks']) - set(names)
+
+        if unknown:
+            raise CommandError('Unknown tasks: ' + ', '.join(sorted(unknown)))
+
+        timings = warm_cache(options['tasks'] or None, workers=options['jobs'])
+
+        for timing in timings.values():
+            if timing.error is None:
+                self.stdout.write(self.style.SUCCESS(f'{timing.name}: {timing.seconds:.2f}s'))
+            else:
+                self.stdout.write(self.style.ERROR(f'{timing.name}: failed after {timing.seconds:.2f}s ({timing.error})'))
+
+        if any(t.error is not None for t in timings.values()):
+            raise CommandError('Some caches could not be warmed.')
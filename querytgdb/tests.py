@@ -2,18 +2,45 @@ import gzip
 import io
 import json
 import os
+import pickle
 import secrets
+import shutil
+import tempfile
+import unittest
+import zlib
 from glob import iglob
+from unittest import mock
 
+import numpy as np
 import pandas as pd
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.test import TestCase
 from django.urls import reverse
+from scipy.stats import fisher_exact, hypergeom
+from statsmodels.stats.multitest import multipletests
 
+from querytgdb.cache import CODECS, HEADER, decode, encode
 from querytgdb.utils.insert_data import import_additional_edges, import_annotations, insert_data, \
     read_annotation_file
-from .models import Analysis, Annotation, EdgeData, EdgeType
+from .models import Analysis, AnalysisData, Annotation, EdgeData, EdgeType, Interaction, Regulation
+from .utils import PandasJSONEncoder, metadata_to_dict
 from .utils.file import BadNetwork, get_network
+from .utils.formatter import DATA_COL_LEN, HEADER_LEN, format_data, get_data_columns, get_merge_cells, get_row_order, \
+    get_row_text, get_row_window
+from .utils.metadata import MetadataIndex, get_metadata_version
+from .utils.motif_enrichment import get_region_enrichment
+from .utils.motif_enrichment.motif import MotifData, compile_annotation_file, get_compiled_dir, get_compiled_name, \
+    load_annotation_file
+from .utils.analysis_enrichment import pairwise_enrichment
+from .utils.artifacts import artifacts
+from .utils.parser import bind_placeholder, describe_query, evaluate_masks, evaluate_tf, expr, get_query_result, \
+    get_tf_data, parse_query
+from .utils.snapshot import get_file_version, read_frame, write_frame
+from .utils.stats import fisher_exact_greater, fisher_exact_less, hypergeom_cdf, hypergeom_sf, intersection_counts, \
+    pairwise_intersections
+from .utils.store import InteractionStore, load_interaction_store
+from .utils.wire import ARROW_STREAM, COLUMNAR_JSON, encode_column, negotiate, pa, to_arrow, to_columnar
 
 
 class TestImportData(TestCase):
@@ -92,7 +119,7 @@ class TestQuery(TestCase):
             "query": "AT5G65210"
         })
 
-        result = json.loads(response.content)
+        result = json.loads(b''.join(response.streaming_content))
 
         self.assertIn('request_id', result, "has request_id")
 
@@ -105,12 +132,214 @@ class TestQuery(TestCase):
             "query": "AT5G65210"
         })
 
-        request_id = json.loads(response.content)['request_id']
+        request_id = json.loads(b''.join(response.streaming_content))['request_id']
 
         response = self.client.get(reverse("queryapp:queryapp") + request_id + "/")
 
         self.assertEqual(response.status_code, 200)
 
+    def edit_ids(self, request_id, edit):
+        ids = cache.get(f'{request_id}/analysis_ids')
+        data = [[[list(key[0]), key[1]], {'show': v['show'], 'name': v['name'], **edit.get(key, {})}]
+                for key, v in ids.items()]
+
+        response = self.client.post(reverse("queryapp:queryapp") + f"ids/{request_id}/", data=json.dumps(data),
+                                    content_type='application/json')
+
+        self.assertEqual(response.status_code, 201)
+
+    def test_edit_formatted_output(self):
+        """
+        Formatted output updated in place after hiding, showing and renaming analyses should match formatting again
+        """
+        response = self.client.post(reverse("queryapp:queryapp"), data={
+            "query": "AT5G65210 or AT5G65210[pvalue<0.05]"
+        })
+
+        request_id = json.loads(b''.join(response.streaming_content))['request_id']
+        first, second = list(cache.get(f'{request_id}/analysis_ids'))[:2]
+
+        for edit in [{first: {'show': False}},
+                     {first: {'show': True}, second: {'name': 'renamed'}},
+                     {second: {'show': False, 'name': 'hidden'}}]:
+            with self.subTest(edit=edit):
+                self.edit_ids(request_id, edit)
+
+                cached = cache.get(f'{request_id}/formatted_tabular_output')
+                keys = cache.get(f'{request_id}/formatted_columns')
+                self.assertIsNotNone(cached, "should update the formatted output in place")
+
+                result, metadata, stats, _uid, ids = get_query_result(uid=request_id)
+                columns, merged_cells, rows = format_data(result, stats, metadata, ids)
+
+                self.assertEqual(keys, get_data_columns(result))
+                self.assertEqual(cached[0], columns)
+                self.assertEqual(cached[1], merged_cells)
+                self.assertEqual(cached[2], rows)
+                self.assertEqual(cached[3], metadata_to_dict(metadata))
+
+    def test_query_rows(self):
+        """
+        Windows of rows read from the cached chunks should match windows of the whole formatted output
+        """
+        response = self.client.post(reverse("queryapp:queryapp"), data={
+            "query": "AT5G65210"
+        })
+
+        request_id = json.loads(b''.join(response.streaming_content))['request_id']
+        columns, _merged_cells, rows, _metadata = cache.get(f'{request_id}/formatted_tabular_output')
+
+        for params in [{'offset': 0, 'limit': 100},
+                       {'offset': 1000, 'limit': 1000},
+                       {'offset': 10, 'limit': 20, 'sort': f'-{DATA_COL_LEN - 1}'},
+                       {'offset': 0, 'limit': 50, 'filter': 'at1g'}]:
+            with self.subTest(params=params):
+                response = self.client.get(reverse("queryapp:queryapp") + f"{request_id}/rows/", data=params)
+                self.assertEqual(response.status_code, 200)
+
+                sort = params.get('sort')
+                total, window = get_row_window(columns, rows, params['offset'], params['limit'],
+                                               sort=int(sort.lstrip('-')) if sort else None,
+                                               descending=bool(sort), search=params.get('filter'))
+
+                result = response.json()
+                self.assertEqual(result['total'], total)
+                self.assertEqual(result['header'], rows[:HEADER_LEN])
+                self.assertEqual(result['data'], json.loads(json.dumps(window, cls=PandasJSONEncoder)))
+
+        token = cache.get(f'{request_id}/row_chunks')['token']
+        cache.delete(f'{request_id}/row_chunks/{token}/0')
+
+        response = self.client.get(reverse("queryapp:queryapp") + f"{request_id}/rows/", data={'offset': 0})
+        self.assertEqual(response.status_code, 200, "should cut the rows again if chunks are evicted")
+
+    def test_metadata_version(self):
+        version = get_metadata_version()
+
+        analysis_data = AnalysisData.objects.first()
+        analysis_data.value += ' edited'
+        analysis_data.save()
+
+        self.assertNotEqual(get_metadata_version(), version, "should change when a value is edited in place")
+
+    def test_expand(self):
+        """
+        Expanding a template should give the same result as the joined text query
+        """
+        tfs = pd.Series(['AT5G65210', 'at5g65210'])
+
+        for template in ['$filter_tf', '$filter_tf[pvalue<0.05]', '$filter_tf[pvalue<0.05 and log2fc>0]']:
+            for oper in ['and', 'or']:
+                with self.subTest(template=template, oper=oper):
+                    joined = f' {oper} '.join(f"({template.replace('$filter_tf', tf)})" for tf in tfs)
+
+                    pd.testing.assert_frame_equal(parse_query(f'expand("{template}", "{oper}")', tf_filter_list=tfs),
+                                                  parse_query(joined, tf_filter_list=tfs))
+
+
+class TestInteractionStore(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        annotation_file = max(iglob("test_data/annotation*.csv.gz"), key=os.path.getmtime)
+        import_annotations(annotation_file)
+
+        with gzip.open('test_data/AT5G65210_TGA1_DESEQ2.txt.gz', 'rt') as m, \
+                gzip.open('test_data/AT5G65210_TGA1_DESeq2.csv.gz', 'r') as d:
+            insert_data(d, m)
+
+    @classmethod
+    def tearDownClass(cls):
+        pass
+
+    @staticmethod
+    def small_store():
+        return InteractionStore.from_frames(
+            pd.DataFrame([(3, 20, 'AT2'), (1, 10, 'AT1'), (2, 10, 'AT1')], columns=['id', 'tf_id', 'tf_name']),
+            pd.DataFrame([(1, 100), (1, 101), (2, 102), (2, 101), (3, 101)], columns=['analysis_id', 'target_id']),
+            pd.DataFrame([(1, 101, 0.01, 1.5), (2, 102, 0.02, -2.0)],
+                         columns=['analysis_id', 'target_id', 'p_value', 'foldchange']),
+            [1, 2])
+
+    def test_from_frames(self):
+        store = self.small_store()
+
+        np.testing.assert_array_equal(store.get_analyses('at1'), [1, 2])
+        np.testing.assert_array_equal(store.expression, [True, True, False])
+
+        edges = store.get_edges([2, 3])
+
+        self.assertEqual(edges['id'].tolist(), [101, 102, 101])
+        self.assertEqual(edges['ANALYSIS'].tolist(), [2, 2, 3])
+        np.testing.assert_array_equal(edges['Pvalue'], [np.nan, 0.02, np.nan])
+        np.testing.assert_array_equal(edges['Log2FC'], [np.nan, -2.0, np.nan])
+
+    def test_edges(self):
+        store = load_interaction_store()
+
+        edges = store.get_edges().rename(columns={'ANALYSIS': 'analysis_id', 'id': 'target_id'})
+        db_edges = pd.DataFrame(Interaction.objects.values_list('analysis_id', 'target_id').iterator(),
+                                columns=['analysis_id', 'target_id']).merge(
+            pd.DataFrame(Regulation.objects.values_list('analysis_id', 'target_id', 'p_value', 'foldchange'),
+                         columns=['analysis_id', 'target_id', 'Pvalue', 'Log2FC']),
+            on=['analysis_id', 'target_id'], how='left')
+
+        self.assertEqual(edges.shape[0], db_edges.shape[0])
+        pd.testing.assert_frame_equal(
+            edges.sort_values(['analysis_id', 'target_id']).reset_index(drop=True),
+            db_edges.sort_values(['analysis_id', 'target_id']).reset_index(drop=True),
+            check_dtype=False)
+
+    def test_target_mask(self):
+        store = self.small_store()
+        universe = np.array([True, False, True])
+
+        np.testing.assert_array_equal(store.get_target_mask([1]), [True, True, False])
+        np.testing.assert_array_equal(store.get_target_mask(), [True, True, True])
+        np.testing.assert_array_equal(store.get_target_mask(every=True), [False, True, False])
+        np.testing.assert_array_equal(store.get_target_mask(universe=universe), [True, False, True])
+        np.testing.assert_array_equal(store.get_target_mask(universe=universe, every=True), [False, False, False],
+                                      "should only count analyses with targets in universe")
+
+    def test_evaluate_masks(self):
+        store = load_interaction_store()
+
+        for query in ["AT5G65210", "AT5G65210 and andalltfs", "AT5G65210 and not andalltfs",
+                      "AT5G65210 or not all_tfs", "not AT5G65210 and all_tfs"]:
+            with self.subTest(query=query):
+                parse = expr.parseString(query, parseAll=True).get('query')
+
+                df = evaluate_masks(store, parse)
+                db_df = evaluate_tf(parse)
+
+                self.assertEqual(df.include, db_df.include)
+
+                if db_df.include:
+                    self.assertEqual(set(df.index), set(db_df.index))
+
+    def test_pushdown(self):
+        store = load_interaction_store()
+
+        for predicates in [[('pvalue', '<', 0.05)], [('log2fc', '>', 1), ('pvalue', '<=', 0.01)]]:
+            with self.subTest(predicates=predicates):
+                df = get_tf_data('AT5G65210', predicates=predicates, store=store)
+                db_df = get_tf_data('AT5G65210', predicates=predicates)
+
+                pd.testing.assert_frame_equal(df.droplevel(0, axis=1).sort_index(),
+                                              db_df.droplevel(0, axis=1).sort_index(),
+                                              check_dtype=False)
+
+    def test_andalltfs_pushdown(self):
+        for query in ["andalltfs[pvalue<0.01]", "andalltfs[EXPERIMENT_TYPE=Expression]"]:
+            with self.subTest(query=query):
+                parse = expr.parseString(query, parseAll=True).get('query')
+
+                df = evaluate_tf(parse)
+
+                with mock.patch('querytgdb.utils.parser.get_pushdown', return_value=[]):
+                    no_pushdown_df = evaluate_tf(parse)
+
+                pd.testing.assert_frame_equal(df, no_pushdown_df)
+
 
 class TestNetworkParsing(TestCase):
     def test_good_file(self):
@@ -134,3 +363,403 @@ class TestNetworkParsing(TestCase):
 
         with self.assertRaises(BadNetwork):
             get_network(buff)
+
+
+class TestQueryCanonicalForm(TestCase):
+    @staticmethod
+    def describe(query):
+        return describe_query(expr.parseString(query, parseAll=True).get('query'), {})
+
+    def test_operand_order(self):
+        self.assertEqual(self.describe("AT5G65210 and AT4G13940")[0],
+                         self.describe("at4g13940 AND at5g65210")[0],
+                         "should ignore case and order of operands")
+        self.assertEqual(self.describe("(AT5G65210 or AT4G13940) or AT4G25210")[0],
+                         self.describe("AT4G25210 or (AT4G13940 or AT5G65210)")[0],
+                         "should flatten nested or")
+        self.assertNotEqual(self.describe("AT5G65210 and AT4G13940 or AT4G25210")[0],
+                            self.describe("AT5G65210 and (AT4G13940 or AT4G25210)")[0],
+                            "should keep grouping of different operators")
+
+    def test_filter_string(self):
+        self.assertEqual(self.describe("at5g65210 and AT4G13940[pvalue<0.01]")[1],
+                         "(AT5G65210 and AT4G13940[pvalue < 0.01])",
+                         "should match filter string from get_tf")
+
+    def test_bind_placeholder(self):
+        template = expr.parseString('$filter_tf[targeted_by="$filter_tf" and pvalue<0.01] or AT4G13940{"TF"="$FILTER_TF"}',
+                                    parseAll=True).get('query')
+
+        self.assertEqual(describe_query(bind_placeholder(template, 'AT5G65210'), {}),
+                         self.describe('AT5G65210[targeted_by="AT5G65210" and pvalue<0.01] or '
+                                       'AT4G13940{"TF"="AT5G65210"}'),
+                         "should bind names and values of modifiers")
+        self.assertEqual(self.describe('$filter_tf[targeted_by="$filter_tf" and pvalue<0.01] or '
+                                       'AT4G13940{"TF"="$FILTER_TF"}'),
+                         describe_query(template, {}),
+                         "should leave the template unchanged")
+
+
+class TestMetadataIndex(TestCase):
+    def setUp(self):
+        self.index = MetadataIndex(
+            pd.DataFrame([(1, 'EXPERIMENT_TYPE', 'Expression'), (2, 'EXPERIMENT_TYPE', 'Binding'),
+                          (2, 'EDGE_TYPE', 'ChIP-Seq')], columns=['analysis_id', 'key', 'value']),
+            (2, 2, 3, 3, ''),
+            pd.DataFrame([(1, 'gene_id', 'AT5G65210'), (2, 'gene_id', 'AT5G65210')],
+                         columns=['analysis_id', 'key', 'value']))
+
+    def test_get(self):
+        np.testing.assert_array_equal(self.index.get('experiment_type', 'EXPRESSION'), [1])
+        self.assertEqual(self.index.get('gene_id', 'AT5G65210').size, 0, "should only match AnalysisData keys")
+
+    def test_get_metadata(self):
+        metadata = self.index.get_metadata([2, 1], ['gene_id', 'EDGE_TYPE'])
+
+        self.assertEqual(metadata.index.tolist(), [2, 1])
+        self.assertEqual(metadata.loc[1, 'gene_id'], 'AT5G65210')
+        self.assertEqual(metadata.loc[1, 'edge_type'], 'None')
+
+
+class TestArtifactGraph(TestCase):
+    def test_dependents(self):
+        dependents = artifacts.dependents('analysis_ids')
+
+        self.assertIn('tabular_output', dependents)
+        self.assertIn('summary', dependents, "should include artifacts of dependents")
+        self.assertNotIn('tabular_output_unfiltered', dependents)
+        self.assertNotIn('analysis_ids', dependents)
+
+    def test_unrelated(self):
+        self.assertNotIn('stats', artifacts.dependents('background_genes'))
+
+    def test_keep(self):
+        dependents = artifacts.dependents('analysis_ids', keep=['tabular_output'])
+
+        self.assertNotIn('stats', dependents, "should not follow kept artifacts")
+        self.assertIn('summary', dependents, "should include direct dependents of kept artifacts")
+
+
+class TestRowWindow(TestCase):
+    def setUp(self):
+        self.columns = [{'type': 'text'}] * DATA_COL_LEN + [{'type': 'p_value'}]
+        self.rows = [[None] * (DATA_COL_LEN + 1)] * HEADER_LEN + [
+            [None] * (DATA_COL_LEN - 1) + [gene, p] for gene, p in
+            [('AT1G01010', 0.5), ('AT1G01020', None), ('AT2G01010', 0.01), ('AT1G01030', 0.1)]
+        ]
+
+    def test_window(self):
+        total, rows = get_row_window(self.columns, self.rows, offset=1, limit=2)
+
+        self.assertEqual(total, 4)
+        self.assertEqual([r[DATA_COL_LEN - 1] for r in rows], ['AT1G01020', 'AT2G01010'])
+
+    def test_sort(self):
+        _, rows = get_row_window(self.columns, self.rows, sort=DATA_COL_LEN)
+        self.assertEqual([r[-1] for r in rows], [0.01, 0.1, 0.5, None], "should sort empty cells last")
+
+        _, rows = get_row_window(self.columns, self.rows, sort=DATA_COL_LEN, descending=True)
+        self.assertEqual([r[-1] for r in rows], [0.5, 0.1, 0.01, None])
+
+        with self.assertRaises(ValueError):
+            get_row_window(self.columns, self.rows, sort=0)
+
+    def test_filter(self):
+        total, rows = get_row_window(self.columns, self.rows, sort=DATA_COL_LEN - 1, descending=True,
+                                     search='at1g')
+
+        self.assertEqual(total, 3)
+        self.assertEqual([r[DATA_COL_LEN - 1] for r in rows], ['AT1G01030', 'AT1G01020', 'AT1G01010'])
+
+    def test_order(self):
+        order = get_row_order(self.columns, self.rows, sort=DATA_COL_LEN, search='AT1G',
+                              text=get_row_text(self.rows))
+
+        np.testing.assert_array_equal(order, [3, 0, 1])
+        self.assertEqual(get_row_window(self.columns, self.rows, limit=1, order=order)[1][0][-1], 0.1)
+
+
+class TestMergeCells(TestCase):
+    def test_runs(self):
+        header = [[None] * DATA_COL_LEN + cells for cells in [
+            ['TF1', 'TF1', 'TF2', 'TF2'],
+            ['a', 'a', 'b', 'b'],
+            ['m', 'm', 'm', 'n'],
+            ['e', 'e', 'f', 'f'],
+            [None, None, None, None],
+            ['EDGE', 'Pvalue', 'EDGE', 'Pvalue']
+        ]]
+
+        merged_cells = get_merge_cells(header)[DATA_COL_LEN:]
+
+        self.assertEqual(merged_cells, [
+            {'row': 1, 'col': 8, 'colspan': 2, 'rowspan': 1},
+            {'row': 0, 'col': 8, 'colspan': 2, 'rowspan': 1},
+            {'row': 1, 'col': 10, 'colspan': 2, 'rowspan': 1},
+            {'row': 0, 'col': 10, 'colspan': 2, 'rowspan': 1},
+            {'row': 2, 'col': 8, 'colspan': 2, 'rowspan': 1},
+            {'row': 3, 'col': 8, 'colspan': 2, 'rowspan': 1},
+            {'row': 4, 'col': 8, 'colspan': 2, 'rowspan': 1}
+        ], "runs should end where a header row above changes")
+
+
+class TestHypergeometric(TestCase):
+    tables = np.array([[3, 1, 1, 3], [0, 5, 10, 85], [12, 30, 40, 20000], [5, 0, 0, 5]])
+
+    def test_fisher_exact(self):
+        a, b, c, d = self.tables.T
+
+        np.testing.assert_allclose(
+            fisher_exact_greater(a, b, c, d),
+            [fisher_exact(t.reshape(2, 2), alternative='greater')[1] for t in self.tables])
+        np.testing.assert_allclose(
+            fisher_exact_less(a, b, c, d),
+            [fisher_exact(t.reshape(2, 2), alternative='less')[1] for t in self.tables])
+
+    def test_hypergeom(self):
+        rng = np.random.RandomState(0)
+        total = rng.randint(1, 30000, 2000)
+        good = rng.randint(0, total + 1)
+        draws = rng.randint(0, total + 1)
+        k = rng.randint(-1, np.minimum(good, draws) + 2)
+
+        np.testing.assert_allclose(hypergeom_sf(k, total, good, draws), hypergeom.sf(k, total, good, draws),
+                                   rtol=1e-8, atol=1e-300)
+        np.testing.assert_allclose(hypergeom_cdf(k, total, good, draws), hypergeom.cdf(k, total, good, draws),
+                                   rtol=1e-8, atol=1e-300)
+
+    def test_pairwise_intersections(self):
+        items, counts = pairwise_intersections(np.array([[1, 1, 0], [1, 1, 1], [0, 1, 1], [1, 0, 0]]))
+
+        np.testing.assert_array_equal(counts, [2, 1, 2])
+        np.testing.assert_array_equal(items, [0, 1, 1, 1, 2])
+
+    def test_intersection_counts(self):
+        counts = intersection_counts([{'A', 'B', 'C'}, {'D'}, set()], [{'A', 'C', 'D'}, {'E'}])
+
+        np.testing.assert_array_equal(counts, [[2, 0], [1, 0], [0, 0]])
+
+
+class TestCacheEncoding(TestCase):
+    def setUp(self):
+        self.value = {
+            'frame': pd.DataFrame({'a': np.arange(100000, dtype=np.float64), 'b': ['x', 'y'] * 50000}),
+            'small': np.arange(10),
+            'name': 'AT5G65210'
+        }
+
+    def assertDecoded(self, value):
+        self.assertEqual(value.keys(), self.value.keys())
+        pd.testing.assert_frame_equal(value['frame'], self.value['frame'])
+        np.testing.assert_array_equal(value['small'], self.value['small'])
+        self.assertEqual(value['name'], self.value['name'])
+
+    def test_codecs(self):
+        for codec_id, codec in CODECS.items():
+            with self.subTest(codec=codec.name):
+                data, raw_size = encode(self.value, codec_id)
+
+                self.assertEqual(HEADER.unpack_from(data)[1], codec_id)
+                self.assertDecoded(decode(data))
+
+    def test_out_of_band(self):
+        data, _ = encode(self.value, 0, pickle.HIGHEST_PROTOCOL)
+        n_buffers = HEADER.unpack_from(data)[2]
+
+        if pickle.HIGHEST_PROTOCOL >= 5:
+            self.assertGreater(n_buffers, 0, "should pickle large arrays out-of-band")
+
+        value = decode(data)
+        self.assertDecoded(value)
+
+        value['frame'].iloc[0, 0] = -1.0  # arrays from out-of-band buffers should be writable
+
+        data, _ = encode(self.value, 0, 4)
+        self.assertEqual(HEADER.unpack_from(data)[2], 0, "should keep buffers in band before protocol 5")
+        self.assertDecoded(decode(data))
+
+    def test_legacy(self):
+        self.assertDecoded(decode(zlib.compress(pickle.dumps(self.value))))
+
+
+class TestSnapshot(TestCase):
+    def test_string_columns(self):
+        df = pd.DataFrame({'Full Name': ['kinase', None, 'kinase', 'ünïcode ' * 20],
+                           'Type': ['protein_coding'] * 4,
+                           'id': [1, 2, 3, 4]},
+                          index=pd.Index(['AT1G01010', 'AT1G01020', 'AT1G01030', 'AT1G01040'], name='TARGET'))
+        df = df.astype({'Full Name': object, 'Type': object})
+
+        with tempfile.TemporaryDirectory() as root:
+            write_frame('annotations', '1', df, root)
+            snapshot = read_frame('annotations', '1', root)
+
+        self.assertIsInstance(snapshot['Full Name'].dtype, pd.CategoricalDtype)
+        self.assertEqual(snapshot['Type'].cat.categories.tolist(), ['protein_coding'])
+        pd.testing.assert_frame_equal(snapshot.astype({'Full Name': object, 'Type': object}), df)
+
+
+def decode_column(column, length):
+    if 'index' in column:
+        values = [None] * length
+        for i, v in zip(column['index'], column['values']):
+            values[i] = v
+        return values
+
+    if 'dictionary' in column:
+        return [column['dictionary'][c] if c >= 0 else None for c in column['codes']]
+
+    return column['values']
+
+
+class TestWireFormats(TestCase):
+    def setUp(self):
+        self.rows = [['h'] * 4] * HEADER_LEN + [
+            ['AT1G01010', 'NAC', None, 0.5],
+            ['AT1G01020', 'NAC', None, None],
+            ['AT1G01030', 'NAC', 'x', 0.25],
+            ['AT1G01040', None, None, 0.125]
+        ]
+
+    def test_encode_column(self):
+        self.assertIn('index', encode_column(np.array([None, None, None, 'x'], dtype=object)))
+        self.assertIn('dictionary', encode_column(np.array(['a', 'a', 'a', 'b', 'a', None], dtype=object)))
+        self.assertIn('values', encode_column(np.array([0.5, 0.25, 1.0], dtype=object)))
+
+    def test_columnar(self):
+        columnar = to_columnar(self.rows)
+        columns = [decode_column(c, columnar['length']) for c in columnar['data']]
+
+        self.assertEqual(columnar['header'], self.rows[:HEADER_LEN])
+        self.assertEqual(len(columnar['data']), 4)
+        self.assertEqual(list(map(list, zip(*columns))), self.rows[HEADER_LEN:])
+
+    @unittest.skipIf(pa is None, "pyarrow not installed")
+    def test_arrow(self):
+        table = pa.ipc.open_stream(to_arrow(self.rows, columns=[{'type': 'text'}])).read_all()
+        metadata = table.schema.metadata
+
+        self.assertEqual(json.loads(metadata[b'header']), self.rows[:HEADER_LEN])
+        self.assertEqual(json.loads(metadata[b'columns']), [{'type': 'text'}])
+        self.assertEqual([list(r.values()) for r in table.to_pylist()], self.rows[HEADER_LEN:])
+
+    def test_negotiate(self):
+        offers = ['application/json', COLUMNAR_JSON, ARROW_STREAM]
+
+        self.assertEqual(negotiate('*/*', offers), 'application/json')
+        self.assertEqual(negotiate(ARROW_STREAM, offers), ARROW_STREAM)
+        self.assertEqual(negotiate(f'{ARROW_STREAM};q=0, */*', offers), 'application/json',
+                         "q=0 should not select a media type")
+        self.assertEqual(negotiate(f'{COLUMNAR_JSON};q=0.9, application/json;q=0.5', offers), COLUMNAR_JSON)
+        self.assertIsNone(negotiate(ARROW_STREAM, offers[:2]))
+
+
+class TestAnalysisEnrichment(TestCase):
+    def test_pairwise_enrichment(self):
+        df = pd.DataFrame({
+            'a': [1, 1, 1, np.nan, 1],
+            'b': [1, np.nan, 1, 1, np.nan],
+            'c': [np.nan, np.nan, np.nan, np.nan, 1],
+            'd': np.nan
+        }, index=['G1', 'G2', 'G3', 'G4', 'G5'])
+        background = 20
+
+        left, right, data = pairwise_enrichment(df, background)
+
+        greater = []
+        less = []
+
+        for i, j, d in zip(left, right, data):
+            x, y = df.iloc[:, i].notna().values, df.iloc[:, j].notna().values
+            table = [[(x & y).sum(), (x & ~y).sum()], [(~x & y).sum(), background - (x | y).sum()]]
+
+            greater.append(fisher_exact(table, alternative='greater')[1])
+            less.append(fisher_exact(table, alternative='less')[1])
+
+            self.assertEqual(list(d['genes']), list(df.index[x & y]))
+
+        np.testing.assert_allclose([d['greater'] for d in data], greater)
+        np.testing.assert_allclose([d['less'] for d in data], less)
+        np.testing.assert_allclose([d['greater_adj'] for d in data], multipletests(greater, method='bonferroni')[1])
+        np.testing.assert_allclose([d['less_adj'] for d in data], multipletests(less, method='bonferroni')[1])
+
+
+class TinyMotifData(MotifData):
+    annotation_frame = pd.DataFrame(
+        {3: [2, 1, 1, 4, 1, 5]},
+        index=pd.MultiIndex.from_tuples([
+            ('G1', '500bp_promoter', 'M1'),
+            ('G1', '500bp_promoter', 'M2'),
+            ('G2', '500bp_promoter', 'M1'),
+            ('G3', '500bp_promoter', 'M3'),
+            ('G4', '500bp_promoter', 'M2'),
+            ('G1', '1000bp_promoter', 'M1')
+        ]))
+
+    def get_annotation(self):
+        return self.annotation_frame
+
+
+class TestMotifEnrichment(TestCase):
+    gene_lists = [['G1', 'G2'], ['G3', 'G4'], ['G9']]
+    motif_lists = [None, ['M3'], None]
+
+    @staticmethod
+    def reference(annotation, region, genes, motifs):
+        """
+        Cluster enrichment of a gene list computed one cluster at a time
+        """
+        anno = annotation.xs(region, level=1)[3]
+        ann_cluster = anno.groupby(level=1).sum()
+        total = anno.sum()
+
+        in_list = anno[anno.index.get_level_values(0).isin(genes)]
+        list_cluster = in_list.groupby(level=1).sum().reindex(ann_cluster.index, fill_value=0)
+        list_sum = in_list.sum()
+
+        p = pd.Series([fisher_exact([[a, c - a], [list_sum - a, total - list_sum - c + a]], alternative='greater')[1]
+                       for a, c in zip(list_cluster, ann_cluster)], index=ann_cluster.index)
+
+        return p if motifs is None else p[p.index.isin(motifs)]
+
+    def check(self, motif_data):
+        matrix = motif_data.region_matrix('500bp_promoter')
+        result = get_region_enrichment(self.gene_lists, self.motif_lists, matrix)
+
+        for p, genes, motifs in zip(result, self.gene_lists, self.motif_lists):
+            with self.subTest(genes=genes, motifs=motifs):
+                pd.testing.assert_series_equal(p, self.reference(motif_data.annotation, '500bp_promoter', genes, motifs),
+                                               check_names=False)
+
+    def test_region_enrichment(self):
+        self.check(TinyMotifData())
+
+    def test_background(self):
+        motif_data = TinyMotifData(background=pd.Series(['G1', 'G3', 'G4']))
+
+        self.assertNotIn('G2', motif_data.annotation.index.get_level_values(0))
+        self.check(motif_data)
+
+    def test_region_matrix(self):
+        counts, genes, clusters = TinyMotifData().region_matrix('500bp_promoter')
+
+        self.assertEqual(clusters.tolist(), ['M1', 'M2', 'M3'])
+        self.assertEqual(counts[genes.get_loc('G1')].toarray().tolist(), [[2, 1, 0]],
+                         "should only count motifs of the region")
+
+    def test_compiled_annotation(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'data', 'motifs.csv.gz')
+            os.makedirs(os.path.dirname(path))
+            TinyMotifData.annotation_frame.to_csv(path, header=False)
+
+            compile_annotation_file(path)
+
+            # copied without the mtimes, like a deploy to another directory
+            copy = os.path.join(tmp, 'deploy', 'motifs.csv.gz')
+            shutil.copytree(os.path.dirname(path), os.path.dirname(copy), copy_function=shutil.copyfile)
+
+            df = read_frame(get_compiled_name(copy), get_file_version(copy), get_compiled_dir(copy))
+
+            self.assertIsNotNone(df, "compiled annotation should match the copied file")
+            pd.testing.assert_frame_equal(df, load_annotation_file(copy))
@@ -19,6 +19,7 @@ register_converter(FloatConverter, 'float')
 urlpatterns = [
     path('', views.QueryView.as_view(), name="queryapp"),
     path('<uuid:request_id>/', views.QueryView.as_view()),
+    path('<uuid:request_id>/rows/', views.QueryRowsView.as_view()),
     path('ids/<uuid:request_id>/', views.EditQueryView.as_view()),
     path('network/<uuid:request_id>/', views.NetworkJSONView.as_view()),
     path('network/<uuid:request_id>.sif', views.NetworkSifView.as_view()),
@@ -47,6 +48,8 @@ urlpatterns = [
          views.AnalysisEnrichmentView.as_view()),
     path('analysis_enrichment/<uuid:request_id>.csv', views.AnalysisEnrichmentCsvView.as_view()),
     path('summary/<uuid:request_id>/', views.SummaryView.as_view()),
+    path('artifacts/<uuid:request_id>/', views.ArtifactStatusView.as_view()),
+    path('cache_stats/', views.CacheStatsView.as_view()),
     path('aupr/<uuid:request_id>/', views.NetworkAuprView.as_view()),
     path('aupr/<uuid:request_id>/pruned/<float:cutoff>/', views.NetworkPrunedView.as_view()),
     path('sungear/<uuid:request_id>/', sungear_app.views.SungearView.as_view()),
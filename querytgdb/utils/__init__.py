@@ -1,26 +1,35 @@
 import base64
 import io
+import json
 import logging
 import math
 import pkgutil
 import sys
-from collections import UserDict
+import threading
+from collections import OrderedDict, UserDict
 from concurrent.futures import Future, ThreadPoolExecutor
 from functools import wraps
 from operator import methodcaller
-from typing import Any, Callable, Dict, Iterable, Optional, Sized, TypeVar
-from uuid import UUID
+from typing import Any, Callable, Dict, Generator, Hashable, Iterable, Optional, Sequence, Sized, Tuple, Type, \
+    TypeVar
+from uuid import UUID, uuid4
 
 import numpy as np
 import pandas as pd
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db import DatabaseError
 from django.db.models import QuerySet
-from django.http import FileResponse
+from django.http import FileResponse, StreamingHttpResponse
 from fontTools.ttLib import TTFont
 from lxml import etree
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from querytgdb.models import Analysis, AnalysisData, Annotation
+from querytgdb.utils.snapshot import get_frame, get_table_version
 
 logger = logging.getLogger(__name__)
 
@@ -60,6 +69,71 @@ class GzipFileResponse(FileResponse):
         self['Content-Encoding'] = 'gzip'
 
 
+def encode_rows(rows: Sequence, encoder: Type[json.JSONEncoder] = PandasJSONEncoder) -> bytes:
+    """
+    Encode rows as a JSON array, with orjson if installed
+
+    NaN and Inf are encoded as null by orjson.
+    """
+    if orjson is not None:
+        if isinstance(rows, np.ndarray) and rows.dtype == object:
+            rows = rows.tolist()
+
+        return orjson.dumps(rows, default=encoder().default, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    if isinstance(rows, np.ndarray):
+        rows = rows.tolist()
+
+    return json.dumps(rows, cls=encoder).encode()
+
+
+class StreamingJsonResponse(StreamingHttpResponse):
+    """
+    Stream a JSON object holding a large array, encoding the array a chunk of rows at a time
+
+    The rows can be a list or a 2d numpy array. The rows are not copied, but have to be in memory already, so this
+    saves the JSON string of the whole array and gets the first bytes out early, while peak memory still includes
+    the rows.
+    """
+
+    def __init__(self, data: Dict, path: Tuple[str, ...], chunk_size: int = 2000,
+                 encoder: Type[json.JSONEncoder] = PandasJSONEncoder, **kwargs):
+        """
+        :param data:
+        :param path: keys of the array to stream in data
+        :param chunk_size: number of rows encoded at a time
+        :param encoder:
+        :param kwargs:
+        """
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(self.stream(data, path, chunk_size, encoder), **kwargs)
+
+    @staticmethod
+    def stream(data: Dict, path: Tuple[str, ...], chunk_size: int,
+               encoder: Type[json.JSONEncoder]) -> Generator[bytes, None, None]:
+        *parents, key = path
+        placeholder = f'__rows_{uuid4().hex}__'
+
+        data = dict(data)
+        container = data
+        for k in parents:
+            container[k] = dict(container[k])
+            container = container[k]
+
+        rows = container[key]
+        container[key] = placeholder
+
+        prefix, suffix = json.dumps(data, cls=encoder).split(f'"{placeholder}"')
+
+        yield prefix.encode() + b'['
+
+        for i in range(0, len(rows), chunk_size):
+            chunk = encode_rows(rows[i:i + chunk_size], encoder)
+            yield (b',' if i else b'') + chunk[1:-1]
+
+        yield b']' + suffix.encode()
+
+
 class CaselessDict(UserDict):
     def __init__(self, dict_, **kwargs):
         super().__init__({k.lower(): v for k, v in dict_.items()}, **kwargs)
@@ -207,6 +281,59 @@ def get_size(func: Callable[..., Sized]) -> Callable[..., Sized]:
     return wrapper
 
 
+class LRUCache:
+    """
+    Thread safe least recently used cache that keeps the total size of its values under max_size
+
+    Values larger than max_size are not cached.
+    """
+
+    def __init__(self, max_size: int, size: Callable[[Any], int] = sys.getsizeof):
+        self.max_size = max_size
+        self.size = size
+        self.data: OrderedDict = OrderedDict()
+        self.sizes: Dict[Hashable, int] = {}
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            try:
+                self.data.move_to_end(key)
+            except KeyError:
+                return default
+
+            return self.data[key]
+
+    def __setitem__(self, key: Hashable, value: Any):
+        size = self.size(value)
+
+        if size > self.max_size:
+            return
+
+        with self.lock:
+            if key in self.data:
+                del self.data[key]
+                self.total -= self.sizes.pop(key)
+
+            self.data[key] = value
+            self.sizes[key] = size
+            self.total += size
+
+            while self.total > self.max_size:
+                old_key, _ = self.data.popitem(last=False)
+                self.total -= self.sizes.pop(old_key)
+
+    def __len__(self):
+        return len(self.data)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.sizes.clear()
+            self.total = 0
+
+
 class AsyncDataLoader:
     def __init__(self):
         self.data = {}
@@ -252,13 +379,18 @@ def skip_for_management(func):
     return f
 
 
+def load_annotations() -> pd.DataFrame:
+    anno = pd.DataFrame(
+        Annotation.objects.values_list(
+            'gene_id', 'fullname', 'gene_family', 'gene_type', 'name', 'id').iterator(),
+        columns=['TARGET', 'Full Name', 'Gene Family', 'Type', 'Name', 'id'])
+
+    return anno.set_index('TARGET')
+
+
 def get_annotations():
     try:
-        anno = pd.DataFrame(
-            Annotation.objects.values_list(
-                'gene_id', 'fullname', 'gene_family', 'gene_type', 'name', 'id').iterator(),
-            columns=['TARGET', 'Full Name', 'Gene Family', 'Type', 'Name', 'id'])
-        anno = anno.set_index('TARGET')
+        anno = get_frame('annotations', get_table_version(Annotation), load_annotations)
     except DatabaseError:
         anno = pd.DataFrame(columns=['Full Name', 'Gene Family', 'Type', 'Name', 'id'])
         anno.index.name = 'TARGET'
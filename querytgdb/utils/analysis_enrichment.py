@@ -3,20 +3,23 @@ import warnings
 from collections import OrderedDict
 from functools import reduce
 from io import StringIO
-from itertools import combinations
 from operator import itemgetter, methodcaller, or_
 from typing import Dict, List, Optional, Tuple, Union
 from uuid import UUID
 
+import numpy as np
 import pandas as pd
+import scipy.sparse as sparse
 from django.core.cache import cache
 from django.http import HttpResponse
 from scipy.special import comb
-from scipy.stats import fisher_exact
 from statsmodels.stats.multitest import multipletests
 
 from querytgdb.utils import async_loader
 from ..utils import clear_data, get_metadata
+from ..utils.artifacts import artifacts
+from ..utils.results import load_result
+from ..utils.stats import fisher_exact_greater, fisher_exact_less, pairwise_intersections
 
 
 class AnalysisEnrichmentError(ValueError):
@@ -31,13 +34,45 @@ def split_col_name(col_name: Tuple[Tuple[str, str, str], int]) -> Tuple[str, str
     return col_name[0] + (col_name[1],)
 
 
-def analysis_enrichment(uid: Union[UUID, str], size_limit: int = 100, raise_warning: bool = False) -> Dict:
+def pairwise_enrichment(df: pd.DataFrame, background: int) -> Tuple[np.ndarray, np.ndarray, List[Dict]]:
+    """
+    Fisher's exact tests of the target overlap of every pair of columns
+
+    :param df: targets × analyses, targets where not null
+    :param background: number of genes
+    :return: left and right columns of each pair in np.triu_indices order, and their tests and shared targets
+    """
+    incidence = sparse.csc_matrix(df.notna().values)
+    counts = np.diff(incidence.indptr)
+
+    shared, common = pairwise_intersections(incidence)
+    left, right = np.triu_indices(df.shape[1], 1)
+
+    c = (common, counts[left] - common, counts[right] - common, background - (counts[left] + counts[right] - common))
+    greater = fisher_exact_greater(*c)
+    less = fisher_exact_less(*c)
+
+    less_adj = multipletests(less, method='bonferroni')[1]
+    greater_adj = multipletests(greater, method='bonferroni')[1]
+
+    genes = np.split(df.index.values[shared], np.cumsum(common)[:-1])
+
+    data = [{
+        'greater': g,
+        'less': l,
+        'genes': gs,
+        'less_adj': l_adj,
+        'greater_adj': g_adj
+    } for g, l, gs, l_adj, g_adj in zip(greater.tolist(), less.tolist(), genes, less_adj.tolist(),
+                                        greater_adj.tolist())]
+
+    return left, right, data
+
+
+def analysis_enrichment(uid: Union[UUID, str], size_limit: int = 20_000, raise_warning: bool = False) -> Dict:
     try:
-        cached_data = cache.get_many([f'{uid}/tabular_output', f'{uid}/analysis_ids'])
-        df, ids = itemgetter(
-            f'{uid}/tabular_output',
-            f'{uid}/analysis_ids'
-        )(cached_data)
+        df = load_result(uid, 'tabular_output', ['EDGE', 'Log2FC'])
+        ids = cache.get_many([f'{uid}/analysis_ids'])[f'{uid}/analysis_ids']
     except KeyError as e:
         raise AnalysisEnrichmentError("Please make a new query") from e
 
@@ -53,8 +88,6 @@ def analysis_enrichment(uid: Union[UUID, str], size_limit: int = 100, raise_warn
         else:
             warnings.warn(e)
 
-    columns = []
-    data = []
     info = []
 
     background_genes = cache.get(f'{uid}/background_genes')
@@ -79,35 +112,14 @@ def analysis_enrichment(uid: Union[UUID, str], size_limit: int = 100, raise_warn
 
         info.append((split_col_name(col_name), d))
 
-    for (name1, col1), (name2, col2) in combinations(((name, col.index[col.notna()])
-                                                      for name, col in df.iteritems()), 2):
-        columns.append((
-            split_col_name(name1),
-            split_col_name(name2)
-        ))
-
-        common = col1.intersection(col2).sort_values()
+    df = df.sort_index()
 
-        c = (
-            (len(common), len(col1.difference(col2))),
-            (len(col2.difference(col1)), background - len(col1.union(col2)))
-        )
+    left, right, data = pairwise_enrichment(df, background)
 
-        data.append({
-            'greater': fisher_exact(c, 'greater')[1],
-            'less': fisher_exact(c, 'less')[1],
-            'genes': common
-        })
-
-    p_values = (pd.DataFrame(data)[['less', 'greater']]
-                .apply(lambda x: multipletests(x, method='bonferroni')[1])
-                .rename(columns=lambda x: x + '_adj'))
-
-    for d, adj_p in zip(data, p_values.itertuples(index=False)):
-        d.update(adj_p._asdict())
+    names = [split_col_name(name) for name in df.columns]
 
     return {
-        'columns': columns,
+        'columns': [(names[i], names[j]) for i, j in zip(left.tolist(), right.tolist())],
         'data': data,
         'info': info
     }
@@ -122,16 +134,13 @@ FIELD_NAMES = ['tf1', 'query1', 'analysis1', 'count1',
 def analysis_enrichment_csv(uid: Union[str, UUID],
                             fields: Optional[List[str]] = None,
                             buffer: Optional[Union[StringIO, HttpResponse]] = None,
-                            size_limit: int = 100,
+                            size_limit: int = 20_000,
                             raise_warning: bool = False):
     if buffer is None:
         buffer = StringIO()
 
-    enrichment = cache.get(f'{uid}/analysis_enrichment')
-
-    if enrichment is None:
-        enrichment = analysis_enrichment(uid, size_limit, raise_warning)
-        cache.set(f'{uid}/analysis_enrichment', enrichment)
+    enrichment = artifacts.get_or_set(uid, 'analysis_enrichment',
+                                      lambda: analysis_enrichment(uid, size_limit, raise_warning))
 
     info = dict(enrichment['info'])
 
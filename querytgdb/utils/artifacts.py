@@ -0,0 +1,151 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Union
+from uuid import UUID
+
+from django.core.cache import cache
+
+
+class Artifact:
+    def __init__(self, name: str, inputs: Iterable[str] = (), keys: Optional[Iterable[str]] = None):
+        """
+        :param name:
+        :param inputs: names of the artifacts this one is computed from
+        :param keys: cache keys (without uid) holding the artifact, defaults to the name
+        """
+        self.name = name
+        self.inputs = list(inputs)
+        self.keys = list(keys) if keys is not None else [name]
+
+
+class ArtifactRegistry:
+    """
+    Dependency graph of the data cached for each query
+
+    Invalidating an artifact deletes everything computed from it, directly or not. Artifacts are recomputed
+    lazily with get_or_set, which lets only one thread per process compute a missing artifact.
+    """
+
+    def __init__(self):
+        self.artifacts: Dict[str, Artifact] = OrderedDict()
+        self.lock = threading.Lock()
+        self.pending: Dict[str, List] = {}
+
+    def register(self, name: str, inputs: Iterable[str] = (), keys: Optional[Iterable[str]] = None) -> Artifact:
+        artifact = Artifact(name, inputs, keys)
+        self.artifacts[name] = artifact
+
+        return artifact
+
+    def __getitem__(self, name: str) -> Artifact:
+        return self.artifacts[name]
+
+    def dependents(self, name: str, keep: Iterable[str] = ()) -> Set[str]:
+        """
+        Get names of all artifacts computed from an artifact
+
+        :param name:
+        :param keep: artifacts to leave out, along with the artifacts depending on the artifact only through them
+        :return:
+        """
+        keep = set(keep)
+        found = set()
+        stack = [name]
+
+        while stack:
+            current = stack.pop()
+
+            for artifact in self.artifacts.values():
+                if current in artifact.inputs and artifact.name not in found and artifact.name not in keep:
+                    found.add(artifact.name)
+                    stack.append(artifact.name)
+
+        return found
+
+    def invalidate(self, uid: Union[str, UUID], name: str, keep: Iterable[str] = ()):
+        """
+        Delete cached artifacts that depend on an artifact, the artifact itself is kept
+        """
+        cache.delete_many([f'{uid}/{key}' for n in self.dependents(name, keep) for key in self.artifacts[n].keys])
+
+    def discard(self, uid: Union[str, UUID], name: str):
+        """
+        Delete a cached artifact and the artifacts depending on it
+        """
+        self.invalidate(uid, name)
+        cache.delete_many([f'{uid}/{key}' for key in self.artifacts[name].keys])
+
+    def get_or_set(self, uid: Union[str, UUID], name: str, compute: Callable[[], Any],
+                   key: Optional[str] = None) -> Any:
+        """
+        Get an artifact from the cache, or compute and cache it if missing
+
+        Concurrent calls for the same artifact wait for the first one instead of computing it again.
+
+        :param uid:
+        :param name:
+        :param compute:
+        :param key: cache key of the artifact if it has more than one
+        :return:
+        """
+        if key is None:
+            key = self.artifacts[name].keys[0]
+
+        cache_key = f'{uid}/{key}'
+
+        value = cache.get(cache_key)
+
+        if value is not None:
+            return value
+
+        with self.lock:
+            entry = self.pending.setdefault(cache_key, [threading.Lock(), 0])
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                value = cache.get(cache_key)
+
+                if value is None:
+                    value = compute()
+                    cache.set(cache_key, value)
+
+                return value
+        finally:
+            with self.lock:
+                entry[1] -= 1
+
+                if not entry[1]:
+                    del self.pending[cache_key]
+
+    def status(self, uid: Union[str, UUID]) -> Dict[str, Dict[str, Any]]:
+        """
+        Report which artifacts of a query are cached
+        """
+        return OrderedDict(
+            (name, {
+                'warm': all(cache.has_key(f'{uid}/{key}') for key in artifact.keys),
+                'inputs': artifact.inputs
+            }) for name, artifact in self.artifacts.items())
+
+
+artifacts = ArtifactRegistry()
+
+for name in ('query', 'tabular_output_unfiltered', 'analysis_ids', 'metadata', 'target_genes', 'background_genes',
+             'target_network'):
+    artifacts.register(name)
+
+artifacts.register('tabular_output', ['tabular_output_unfiltered', 'analysis_ids', 'target_genes'])
+artifacts.register('formatted_tabular_output', ['tabular_output', 'analysis_ids'],
+                   ['formatted_tabular_output', 'formatted_columns'])
+artifacts.register('row_index', ['formatted_tabular_output'])
+artifacts.register('row_chunks', ['formatted_tabular_output'])
+artifacts.register('network', ['tabular_output'])
+artifacts.register('stats', ['tabular_output'])
+artifacts.register('figure', ['tabular_output_unfiltered', 'analysis_ids', 'target_network'],
+                   ['figure', 'figure_data'])
+artifacts.register('list_enrichment', ['tabular_output_unfiltered', 'analysis_ids', 'target_genes', 'background_genes'],
+                   ['list_enrichment', 'list_enrichment_legend', 'list_enrichment_data'])
+artifacts.register('analysis_enrichment', ['tabular_output', 'analysis_ids', 'background_genes'])
+artifacts.register('summary', ['tabular_output', 'analysis_ids'])
+artifacts.register('sungear', ['tabular_output', 'analysis_ids'])
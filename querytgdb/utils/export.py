@@ -13,18 +13,18 @@ from django.core.cache import cache
 
 from ..utils import column_string, data_to_edges
 from ..utils.parser import expand_ref_ids
+from ..utils.results import load_result
 
 __all__ = ('create_export_zip', 'write_excel', 'export_csv')
 
 
 def create_export_zip(uid: Union[str, UUID], out_dir):
-    cached_data = cache.get_many([f'{uid}/tabular_output', f'{uid}/query'])
-    df = cached_data[f'{uid}/tabular_output']
+    df = load_result(uid, 'tabular_output')
     create_sifs(df, out_dir)
     create_all_tf_genelists(df, out_dir)
 
     with open(os.path.join(out_dir, 'query.txt'), 'w') as f:
-        f.write(cached_data[f'{uid}/query'])
+        f.write(cache.get_many([f'{uid}/query'])[f'{uid}/query'])
 
     write_excel(uid, os.path.join(out_dir, 'tabular_output.xlsx'))
 
@@ -181,9 +181,9 @@ def create_all_tf_genelists(result: pd.DataFrame, output):
 
 
 def export_csv(uid: Union[UUID, str], buff=None) -> IO:
-    data = cache.get_many([f'{uid}/tabular_output', f'{uid}/metadata'])
+    data = cache.get_many([f'{uid}/metadata'])
 
-    df = data[f'{uid}/tabular_output']
+    df = load_result(uid, 'tabular_output')
 
     df = df.stack([0, 1]).reorder_levels([1, 2, 'TARGET']).sort_index(level=0)
     df.index.names = ("TF", "ANALYSIS", "TARGET")
@@ -1,16 +1,26 @@
 import logging
 import re
-from itertools import groupby, islice, zip_longest
-from operator import itemgetter
-from typing import Any, Dict, Iterable, List, Tuple, Union
+from collections import OrderedDict
+from itertools import zip_longest
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+from uuid import UUID, uuid4
 
 import numpy as np
 import pandas as pd
+from django.core.cache import cache
 
-from ..utils.parser import Ids
+from ..utils import metadata_to_dict
+from ..utils.artifacts import artifacts
+from ..utils.parser import Id, Ids, get_metadata, get_total, induce_repress_count
+from ..utils.results import get_result_columns, load_result
 
 logger = logging.getLogger(__name__)
 
+DATA_COL_LEN = 8  # annotation columns and Gene ID before the analysis columns
+HEADER_LEN = 6  # header rows before the data rows
+ROW_ORDERS = 16  # sorted and filtered row orders cached per query
+ROW_CHUNK = 1000  # formatted data rows per cache entry, see cache_row_chunks
+
 
 def is_numeric_column(cols: np.ndarray) -> np.ndarray:
     return np.isin(cols, ['User List Count', 'Edge Count', 'Pvalue', 'Log2FC'])
@@ -24,27 +34,42 @@ def is_edge(col: Union[str, Tuple[str]]) -> bool:
     return col in {'EDGE', 'Log2FC'}
 
 
-def get_merge_cells(columns: List[Iterable]) -> List[Dict[str, Any]]:
+def to_object_array(values: Iterable) -> np.ndarray:
+    values = list(values)
+    arr = np.empty(len(values), dtype=object)
+    arr[:] = values
+
+    return arr
+
+
+def get_merge_cells(columns: List[List]) -> List[Dict[str, Any]]:
     """
     Get merge cells for Handsontable. Highly customized don't copy paste.
-    :param columns:
+
+    Runs of analysis columns with the same header rows are merged, a run ends where any header row above it changes.
+    :param columns: header rows
     :return:
     """
-    columns = list(zip(*columns))
+    merged_cells = [{'row': 0, 'col': i, 'colspan': 1, 'rowspan': HEADER_LEN} for i in range(DATA_COL_LEN)]
+
+    n = len(columns[0]) - DATA_COL_LEN
+    if n <= 0:
+        return merged_cells
 
-    merged_cells = [{'row': 0, 'col': i, 'colspan': 1, 'rowspan': 6} for i in range(8)]
+    changed = np.zeros(n, dtype=np.bool_)
+    changed[0] = True
 
-    for i in range(1, 6):
-        index = 8
-        for label, group in groupby(columns[8:], key=itemgetter(slice(1, i + 1))):
-            size = sum(1 for _ in group)
+    for i in range(1, HEADER_LEN):
+        codes, _ = pd.factorize(to_object_array(columns[i][DATA_COL_LEN:]))
+        changed[1:] |= codes[1:] != codes[:-1]
 
-            if size > 1:
-                merged_cells.append({'row': i, 'col': index, 'colspan': size, 'rowspan': 1})
-                if i == 1:
-                    merged_cells.append({'row': 0, 'col': index, 'colspan': size, 'rowspan': 1})
+        starts = np.flatnonzero(changed)
+        sizes = np.diff(np.append(starts, n))
 
-            index += size
+        for start, size in zip(starts[sizes > 1].tolist(), sizes[sizes > 1].tolist()):
+            merged_cells.append({'row': i, 'col': start + DATA_COL_LEN, 'colspan': size, 'rowspan': 1})
+            if i == 1:
+                merged_cells.append({'row': 0, 'col': start + DATA_COL_LEN, 'colspan': size, 'rowspan': 1})
 
     return merged_cells
 
@@ -85,6 +110,38 @@ def get_edge(a: pd.Series) -> str:
     return 'Edges: {0} {{}}'.format(a.get('EDGE_TYPE', default=''))
 
 
+def get_analysis_header(key: Id,
+                        metadata: pd.DataFrame,
+                        ids: Ids,
+                        edge_counts: pd.Series,
+                        total_edge_counts: pd.Series,
+                        induce_repress: pd.Series) -> Optional[Tuple[str, str, str, str, Optional[str]]]:
+    """
+    Get the name, data, analysis method, edge count and induced/repressed count headers of an analysis
+
+    :return: None if the analysis is missing from the metadata or counts
+    """
+    try:
+        analysis = metadata.loc[:, key[1]]
+        name = get_name(key[0][0], analysis, ids[key])
+
+        edge_count = edge_counts.at[key]
+        total_edge_count = total_edge_counts.at[key]
+
+        edge = get_edge(analysis).format(edge_count)
+        if edge_count != total_edge_count:
+            edge += " ({})".format(total_edge_count)
+    except KeyError:
+        return None
+
+    try:
+        ind_rep = "Induced-{0[induced]:} Repressed-{0[repressed]:}".format(induce_repress[(*key, 'Log2FC')])
+    except KeyError:
+        ind_rep = None
+
+    return name, get_tech(analysis), get_analysis_method(analysis), edge, ind_rep
+
+
 def format_data(df: pd.DataFrame, stats: Dict, metadata: pd.DataFrame, ids: Ids) -> Tuple[List, List, List]:
     df = df.reset_index()
     df.insert(7, 'Gene ID', df.pop('TARGET'))
@@ -111,10 +168,8 @@ def format_data(df: pd.DataFrame, stats: Dict, metadata: pd.DataFrame, ids: Ids)
     df.loc[:, num_cols] = num_df.mask(np.isinf(num_df), np.nan)
     df = df.replace({np.nan: None})
 
-    data_col_len = 8
-
-    columns = list(map(list, zip_longest(*((col,) for col in df.columns[:data_col_len]),
-                                         *df.columns[data_col_len:])))
+    columns = list(map(list, zip_longest(*((col,) for col in df.columns[:DATA_COL_LEN]),
+                                         *df.columns[DATA_COL_LEN:])))
 
     none_cols = [None] * len(columns[0])
 
@@ -122,47 +177,28 @@ def format_data(df: pd.DataFrame, stats: Dict, metadata: pd.DataFrame, ids: Ids)
                        none_cols.copy(),
                        none_cols.copy()]  # avoid references
 
-    prev = (None,) * 5
-    name = None
-    tech = None
-    method = None
-    edge = None
-    ind_rep = None
-    for i, col in enumerate(islice(zip(*columns), data_col_len, None), data_col_len):
-        try:
-            if col[0:2] != prev[0:2]:
-                name, _, uuid_ = col[0]
-                analysis = metadata.loc[:, col[1]]
-
-                name = get_name(name, analysis, ids[col[0:2]])
+    data_cols = df.columns[DATA_COL_LEN:]
 
-                tech = get_tech(analysis)
-                method = get_analysis_method(analysis)
+    if len(data_cols):
+        # header rows are computed once per analysis, then spread over its columns
+        analyses: Dict[Id, int] = {}
+        codes = np.fromiter((analyses.setdefault(col[:2], len(analyses)) for col in data_cols), np.intp,
+                            len(data_cols))
 
-                edge_count = edge_counts.at[col[:2]]
-                total_edge_count = total_edge_counts.at[col[:2]]
+        headers = [get_analysis_header(key, metadata, ids, edge_counts, total_edge_counts, induce_repress)
+                   for key in analyses]
 
-                edge = get_edge(analysis).format(edge_count)
-                if edge_count != total_edge_count:
-                    edge += " ({})".format(total_edge_count)
+        found = np.array([h is not None for h in headers], dtype=np.bool_)[codes]
+        dap = to_object_array(columns[-1][DATA_COL_LEN:]) == 'DAP'
 
-                try:
-                    ind_rep = "Induced-{0[induced]:} Repressed-{0[repressed]:}".format(
-                        induce_repress[(*col[:2], 'Log2FC')])
-                except KeyError:
-                    ind_rep = None
+        for i in range(HEADER_LEN - 1):
+            row = to_object_array(columns[i][DATA_COL_LEN:])
+            row[found] = to_object_array(h[i] if h is not None else None for h in headers)[codes[found]]
 
-            columns[0][i] = name
-            columns[1][i] = tech
-            columns[2][i] = method
-            columns[3][i] = edge
-            columns[4][i] = ind_rep
-        except KeyError:
-            pass
+            if i in (1, 2):
+                row[dap] = None
 
-        if col[-1] == 'DAP':
-            columns[2][i] = columns[1][i] = None
-        prev = col
+            columns[i][DATA_COL_LEN:] = row.tolist()
 
     merged_cells = get_merge_cells(columns)
 
@@ -178,10 +214,10 @@ def format_data(df: pd.DataFrame, stats: Dict, metadata: pd.DataFrame, ids: Ids)
 
             if fc:
                 opt['renderer'] = 'renderFc'
-            elif i >= data_col_len and not p:
+            elif i >= DATA_COL_LEN and not p:
                 opt['renderer'] = 'renderExp'
 
-            if i >= data_col_len:
+            if i >= DATA_COL_LEN:
                 opt['validator'] = 'exponential'
         else:
             opt['type'] = 'text'
@@ -195,3 +231,326 @@ def format_data(df: pd.DataFrame, stats: Dict, metadata: pd.DataFrame, ids: Ids)
 
         column_formats.append(opt)
     return column_formats, merged_cells, columns + df.values.tolist()
+
+
+def is_sortable(column_formats: List[Dict], col: int) -> bool:
+    return col == DATA_COL_LEN - 1 or column_formats[col]['type'] in {'numeric', 'p_value'}
+
+
+def get_row_text(rows: List[List]) -> np.ndarray:
+    """
+    Lowercased Gene ID and annotation text of each data row of format_data output, for searching
+    """
+    return pd.Series(['\0'.join(str(c) for c in row[:DATA_COL_LEN] if c is not None) for row in rows[HEADER_LEN:]],
+                     dtype=object).str.lower().values
+
+
+def get_row_order(column_formats: List[Dict],
+                  rows: List[List],
+                  sort: Optional[int] = None,
+                  descending: bool = False,
+                  search: Optional[str] = None,
+                  text: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Get the positions of the data rows of format_data output that match a filter, in sorted order
+
+    :param column_formats:
+    :param rows: formatted rows, header included
+    :param sort: index of the Gene ID or a numeric column to sort by, empty cells sort last
+    :param descending:
+    :param search: keep rows with the text in the Gene ID or annotation columns, ignoring case
+    :param text: output of get_row_text, computed if None
+    :return:
+    :raises ValueError: if the rows cannot be sorted by the column
+    """
+    data = rows[HEADER_LEN:]
+    order = np.arange(len(data))
+
+    if search:
+        if text is None:
+            text = get_row_text(rows)
+
+        order = np.flatnonzero(pd.Series(text, dtype=object).str.contains(search.lower(), regex=False).values)
+
+    if sort is not None:
+        if not 0 <= sort < len(column_formats) or not is_sortable(column_formats, sort):
+            raise ValueError(f'Cannot sort by column {sort}')
+
+        keys = pd.Series([data[i][sort] for i in order], dtype=object)
+
+        if sort != DATA_COL_LEN - 1:
+            keys = pd.to_numeric(keys, errors='coerce')
+
+        order = order[keys.sort_values(ascending=not descending, kind='mergesort', na_position='last').index]
+
+    return order
+
+
+def get_cached_row_order(uid: Union[str, UUID],
+                         column_formats: List[Dict],
+                         get_rows: Callable[[], List[List]],
+                         sort: Optional[int] = None,
+                         descending: bool = False,
+                         search: Optional[str] = None) -> np.ndarray:
+    """
+    get_row_order, with the row text and the last ROW_ORDERS orders of a query cached
+
+    The cache is invalidated with the formatted output, see the row_index artifact.
+
+    :param uid:
+    :param column_formats:
+    :param get_rows: returns the formatted rows, header included, only called if the order is not cached
+    :param sort:
+    :param descending:
+    :param search:
+    :return:
+    """
+    row_index = cache.get(f'{uid}/row_index') or {'text': None, 'orders': OrderedDict()}
+    key = (sort, descending, search.lower() if search else None)
+
+    try:
+        return row_index['orders'][key]
+    except KeyError:
+        pass
+
+    rows = get_rows()
+
+    if search and row_index['text'] is None:
+        row_index['text'] = get_row_text(rows)
+
+    order = get_row_order(column_formats, rows, sort, descending, search, row_index['text'])
+
+    row_index['orders'][key] = order
+
+    while len(row_index['orders']) > ROW_ORDERS:
+        row_index['orders'].popitem(last=False)
+
+    cache.set(f'{uid}/row_index', row_index)
+
+    return order
+
+
+def cache_row_chunks(uid: Union[str, UUID],
+                     column_formats: List[Dict],
+                     merged_cells: List[Dict],
+                     rows: List[List]) -> Dict[str, Any]:
+    """
+    Cache the data rows of format_data output in chunks of ROW_CHUNK rows, so windows of rows are read without
+    loading the whole output
+
+    Chunk keys carry a token of the output they were cut from, chunks of older outputs are never read again and
+    expire with the cache.
+
+    :param uid:
+    :param column_formats:
+    :param merged_cells:
+    :param rows: formatted rows, header included
+    :return: column formats, merged cells, header rows, number of data rows and token of the chunks
+    """
+    token = uuid4().hex
+    data = rows[HEADER_LEN:]
+
+    cache.set_many({f'{uid}/row_chunks/{token}/{i}': data[start:start + ROW_CHUNK]
+                    for i, start in enumerate(range(0, len(data), ROW_CHUNK))})
+
+    return {
+        'columns': column_formats,
+        'merged_cells': merged_cells,
+        'header': rows[:HEADER_LEN],
+        'total': len(data),
+        'token': token
+    }
+
+
+def get_chunked_rows(uid: Union[str, UUID], row_chunks: Dict[str, Any], positions: np.ndarray) -> List[List]:
+    """
+    Get data rows by position from the chunks cached with cache_row_chunks, reading only the chunks they are in
+
+    :param uid:
+    :param row_chunks: output of cache_row_chunks
+    :param positions:
+    :return:
+    :raises KeyError: if a chunk is no longer cached
+    """
+    keys = {i: f'{uid}/row_chunks/{row_chunks["token"]}/{i}' for i in np.unique(positions // ROW_CHUNK).tolist()}
+    cached = cache.get_many(list(keys.values()))
+    chunks = {i: cached[key] for i, key in keys.items()}
+
+    return [chunks[p // ROW_CHUNK][p % ROW_CHUNK] for p in positions.tolist()]
+
+
+def get_row_window(column_formats: List[Dict],
+                   rows: List[List],
+                   offset: int = 0,
+                   limit: int = 100,
+                   sort: Optional[int] = None,
+                   descending: bool = False,
+                   search: Optional[str] = None,
+                   order: Optional[np.ndarray] = None) -> Tuple[int, List[List]]:
+    """
+    Get a window of the data rows of format_data output, optionally filtered and sorted
+
+    :param column_formats:
+    :param rows: formatted rows, header included
+    :param offset:
+    :param limit:
+    :param sort: see get_row_order
+    :param descending:
+    :param search:
+    :param order: output of get_row_order, computed from sort, descending and search if None
+    :return: number of rows matching the filter and the rows in the window
+    :raises ValueError: if the rows cannot be sorted by the column
+    """
+    if order is None:
+        order = get_row_order(column_formats, rows, sort, descending, search)
+
+    data = rows[HEADER_LEN:]
+
+    return len(order), [data[i] for i in order[offset:offset + limit]]
+
+
+def get_data_columns(df: pd.DataFrame) -> List[Tuple]:
+    """
+    Get the labels of the analysis columns of a result formatted with format_data, in order
+    :param df:
+    :return:
+    """
+    return list(df.columns[DATA_COL_LEN - 1:])
+
+
+def rename_columns(rows: List[List], keys: List[Tuple], metadata: pd.DataFrame, ids: Ids, renamed: Set[Id]):
+    """
+    Rewrite the name header of renamed analyses in place
+    :param rows: formatted rows
+    :param keys: analysis column labels
+    :param metadata:
+    :param ids:
+    :param renamed:
+    :return:
+    """
+    for i, key in enumerate(keys, DATA_COL_LEN):
+        if key[:2] in renamed:
+            try:
+                rows[0][i] = get_name(key[0][0], metadata.loc[:, key[1]], ids[key[:2]])
+            except KeyError:
+                pass
+
+
+def toggle_columns(uid: Union[str, UUID],
+                   column_formats: List[Dict],
+                   rows: List[List],
+                   keys: List[Tuple],
+                   ids: Ids) -> Tuple[List[Dict], List[List], List[Tuple], pd.DataFrame]:
+    """
+    Show and hide analysis columns of formatted rows
+
+    Kept columns are taken from the formatted rows, only shown columns are formatted. Edge counts are updated
+    with the edges of the shown and hidden analyses, and rows sorted again.
+
+    :param uid:
+    :param column_formats:
+    :param rows: formatted rows
+    :param keys: analysis column labels
+    :param ids:
+    :return: column formats, rows, analysis column labels and metadata
+    :raises KeyError: if the query result is not available
+    """
+    unfiltered = get_result_columns(uid, 'tabular_output_unfiltered')
+    new_keys = [c for c in unfiltered if ids[c[:2]]['show']]
+
+    prev_ids = {k[:2] for k in keys}
+    curr_ids = {k[:2] for k in new_keys}
+
+    rows = np.array(rows, dtype=object)
+    header, data = rows[:HEADER_LEN], rows[HEADER_LEN:]
+    genes = pd.Index(data[:, DATA_COL_LEN - 1])
+    column_formats = list(column_formats)
+
+    metadata = get_metadata(pd.unique([k[1] for k in new_keys]))
+
+    index = {k: i for i, k in enumerate(keys, DATA_COL_LEN)}
+    added = [k for k in new_keys if k not in index]
+
+    if added:
+        df = load_result(uid, 'tabular_output_unfiltered', analyses={k[1] for k in added})
+        df = df.loc[:, df.columns.isin(added)].reindex(genes)
+        df.index.name = 'TARGET'
+
+        total = get_total(df)
+        stats = {'total': total, 'edge_counts': total.copy(), 'induce_repress_count': induce_repress_count(df)}
+
+        df.columns = df.columns.to_flat_index()
+        df = pd.concat([pd.DataFrame(np.nan, index=df.index, columns=header[0, :DATA_COL_LEN - 1]), df], axis=1)
+
+        extra_formats, _, extra_rows = format_data(df, stats, metadata, ids)
+        extra_rows = np.array(extra_rows, dtype=object)[:, DATA_COL_LEN:]
+
+        index.update({k: i for i, k in enumerate(df.columns[DATA_COL_LEN - 1:], len(column_formats))})
+        header = np.hstack([header, extra_rows[:HEADER_LEN]])
+        data = np.hstack([data, extra_rows[HEADER_LEN:]])
+        column_formats.extend(extra_formats[DATA_COL_LEN:])
+
+    take = list(range(DATA_COL_LEN)) + [index[k] for k in new_keys]
+    header, data = header[:, take], data[:, take]
+    column_formats = [column_formats[i] for i in take]
+
+    edges = load_result(uid, 'tabular_output_unfiltered', ['EDGE', 'Log2FC'], {k[1] for k in prev_ids ^ curr_ids})
+    sign = np.array([(c[:2] in curr_ids) - (c[:2] in prev_ids) for c in edges.columns], dtype=np.int64)
+    delta = edges.reindex(genes).notna().values @ sign
+
+    count_col = header[0].tolist().index('Edge Count')
+    counts = data[:, count_col].astype(np.int64) + delta
+    data[:, count_col] = counts.tolist()
+
+    positions = load_result(uid, 'tabular_output_unfiltered', fields=[]).index.get_indexer(genes)
+    data = data[np.lexsort((positions, -counts))]
+
+    return column_formats, header.tolist() + data.tolist(), new_keys, metadata
+
+
+def update_formatted_data(uid: Union[str, UUID], ids: Ids, renamed: Set[Id], toggled: Set[Id]) -> bool:
+    """
+    Update the cached format_data output of a query after analyses are renamed, hidden or shown
+
+    :param uid:
+    :param ids:
+    :param renamed:
+    :param toggled:
+    :return: False if the output has to be formatted again
+    """
+    cached_data = cache.get_many([
+        f'{uid}/formatted_tabular_output',
+        f'{uid}/formatted_columns',
+        f'{uid}/metadata',
+        f'{uid}/target_genes'
+    ])
+
+    try:
+        columns, merged_cells, rows, meta_dict = cached_data[f'{uid}/formatted_tabular_output']
+        keys = cached_data[f'{uid}/formatted_columns']
+        metadata = cached_data[f'{uid}/metadata']
+    except KeyError:
+        return False
+
+    if toggled:
+        if f'{uid}/target_genes' in cached_data:  # user lists drop and reorder columns
+            return False
+
+        try:
+            columns, rows, keys, metadata = toggle_columns(uid, columns, rows, keys, ids)
+        except (KeyError, ValueError):
+            return False
+
+        merged_cells = get_merge_cells(rows[:HEADER_LEN])
+        meta_dict = metadata_to_dict(metadata)
+
+    rename_columns(rows, keys, metadata, ids, renamed)
+
+    cache.set_many({
+        f'{uid}/formatted_tabular_output': (columns, merged_cells, rows, meta_dict),
+        f'{uid}/formatted_columns': keys,
+        f'{uid}/metadata': metadata
+    })
+    artifacts.invalidate(uid, 'formatted_tabular_output')
+
+    return True
@@ -2,8 +2,7 @@ import io
 import math
 import sys
 from collections import OrderedDict
-from itertools import count, product
-from operator import itemgetter
+from itertools import count
 from typing import List, Optional, Union
 from uuid import UUID
 
@@ -13,13 +12,14 @@ import pandas as pd
 import scipy.cluster.hierarchy as hierarchy
 import seaborn as sns
 from django.core.cache import cache
-from scipy.stats import fisher_exact
 from statsmodels.stats.multitest import multipletests
 
 from querytgdb.utils import async_loader
 from .parser import filter_df_by_ids
 from ..models import Analysis
 from ..utils import clear_data, column_string, get_metadata
+from ..utils.results import load_result
+from ..utils.stats import fisher_exact_greater, indicator_matrix
 
 sns.set()
 
@@ -75,7 +75,6 @@ def gene_list_enrichment(uid: Union[str, UUID], draw=True, legend=False, use_lab
     # raising exception here if target genes are not uploaded by the user
     cached_data = cache.get_many([
         f'{uid}/target_genes',
-        f'{uid}/tabular_output_unfiltered',
         f'{uid}/background_genes',
         f'{uid}/analysis_ids',
         f'{uid}/list_enrichment_data'
@@ -87,10 +86,8 @@ def gene_list_enrichment(uid: Union[str, UUID], draw=True, legend=False, use_lab
         raise ValueError('No target genes uploaded') from e
 
     try:
-        query_result, ids = itemgetter(
-            f'{uid}/tabular_output_unfiltered',
-            f'{uid}/analysis_ids'
-        )(cached_data)
+        ids = cached_data[f'{uid}/analysis_ids']
+        query_result = load_result(uid, 'tabular_output_unfiltered', ['EDGE', 'Log2FC'])
         query_result = filter_df_by_ids(query_result, ids)
     except KeyError as e:
         raise ValueError('Query result unavailable') from e
@@ -115,17 +112,17 @@ def gene_list_enrichment(uid: Union[str, UUID], draw=True, legend=False, use_lab
 
     metadata = get_metadata(analyses)
 
-    # save targets for each TF into a dict
-    targets = OrderedDict()
+    # targets of each analysis as an analysis × gene boolean frame
+    targets = query_result.notna().T.groupby(level=[0, 1], sort=False).any()
+    targets.columns = targets.columns.str.upper()
 
-    for (name, analysis_id), column in query_result.iteritems():
-        analysis_targets = set(column.dropna().index.str.upper())
+    analysis_len = targets.values.sum(axis=1)
 
-        name, criterion, _uid = name
-
-        targets[(name, criterion, _uid, analysis_id, len(analysis_targets))] = analysis_targets
-
-    list_enrichment_pvals = pd.DataFrame(index=targets.keys(), columns=list_to_name.keys(), dtype=np.float64)
+    list_enrichment_pvals = pd.DataFrame(
+        index=pd.Index([(name, criterion, _uid, analysis_id, l) for ((name, criterion, _uid), analysis_id), l in
+                        zip(targets.index, analysis_len.tolist())]),
+        columns=list_to_name.keys(),
+        dtype=np.float64)
 
     if not legend:
         try:
@@ -133,31 +130,27 @@ def gene_list_enrichment(uid: Union[str, UUID], draw=True, legend=False, use_lab
                 cached_data[f'{uid}/list_enrichment_data']
         except KeyError:
 
-            list_enrichment_count = pd.DataFrame(index=list_enrichment_pvals.index,
-                                                 columns=list_enrichment_pvals.columns,
-                                                 dtype=np.int_)
-            list_enrichment_influence = list_enrichment_pvals.copy()
-            list_enrichment_specificity = list_enrichment_pvals.copy()
-
-            colnames = {}
-
-            for (analysis_name, analysis_list), (name, user_list) in product(targets.items(), list_to_name.items()):
-                intersect_len = len(analysis_list & user_list)
-                colnames[name] = "{} ({})".format(name, len(user_list))
-
-                odds, pvalue = fisher_exact([
-                    [intersect_len, len(user_list - analysis_list)],
-                    [len(analysis_list - user_list), background - len(user_list | analysis_list)]
-                ], alternative='greater')
-                list_enrichment_pvals.at[analysis_name, name] = pvalue
-                list_enrichment_count.at[analysis_name, name] = intersect_len
-                list_enrichment_influence.at[analysis_name, name] = intersect_len / len(user_list)
-                list_enrichment_specificity.at[analysis_name, name] = intersect_len / len(analysis_list)
-
-            list_enrichment_pvals = list_enrichment_pvals.rename(columns=colnames)
-            list_enrichment_count = list_enrichment_count.rename(columns=colnames)
-            list_enrichment_influence = list_enrichment_influence.rename(columns=colnames)
-            list_enrichment_specificity = list_enrichment_specificity.rename(columns=colnames)
+            user_lists = list(list_to_name.values())
+
+            # user genes outside of the query result can't intersect with the targets, counts are exact in float32
+            user_genes = indicator_matrix(user_lists, targets.columns).T.toarray().astype(np.float32)
+            intersect_len = (targets.values.astype(np.float32) @ user_genes).astype(np.int64)
+            user_len = np.array([len(s) for s in user_lists], dtype=np.int64)[np.newaxis, :]
+            target_len = analysis_len[:, np.newaxis]
+
+            pvalues = fisher_exact_greater(intersect_len,
+                                           user_len - intersect_len,
+                                           target_len - intersect_len,
+                                           background - (user_len + target_len - intersect_len))
+
+            colnames = ["{} ({})".format(name, len(user_list)) for name, user_list in list_to_name.items()]
+
+            list_enrichment_pvals = pd.DataFrame(pvalues, index=list_enrichment_pvals.index, columns=colnames)
+            list_enrichment_count = pd.DataFrame(intersect_len, index=list_enrichment_pvals.index, columns=colnames)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                list_enrichment_influence = list_enrichment_count / user_len
+                list_enrichment_specificity = list_enrichment_count / target_len
 
             # bonferroni correction
             list_enrichment_pvals = list_enrichment_pvals.stack()
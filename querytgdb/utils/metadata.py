@@ -0,0 +1,156 @@
+import hashlib
+import logging
+import time
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from django.db import DatabaseError
+from django.db.models import Count, Max
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from querytgdb.models import Analysis, AnalysisData
+from querytgdb.utils import async_loader, skip_for_management
+
+logger = logging.getLogger(__name__)
+
+# seconds between checks of the database for new or removed metadata
+CHECK_INTERVAL = 60
+
+Version = Tuple[int, Optional[int], int, Optional[int], str]
+
+
+class MetadataIndex:
+    """
+    Inverted index of analysis metadata
+
+    Maps lowercased key and value to sorted analysis ids, for the AnalysisData keys that modifiers match.
+    gene_id, gene_name and analysis_id are only kept as columns for get_metadata, like in the get_metadata
+    of querytgdb.utils.
+    """
+
+    def __init__(self, metadata: pd.DataFrame, version: Version, columns: Optional[pd.DataFrame] = None):
+        """
+        :param metadata: columns: analysis_id, key, value
+        :param version:
+        :param columns: additional metadata that is not indexed, same columns as metadata
+        """
+        self.version = version
+        self.checked = time.monotonic()
+
+        lowered = metadata.assign(lkey=metadata['key'].str.lower(), value=metadata['value'].str.lower())
+        self.index = {k: np.unique(g.values) for k, g in lowered.groupby(['lkey', 'value'])['analysis_id']}
+
+        if columns is not None:
+            metadata = pd.concat([metadata, columns], ignore_index=True, sort=False)
+
+        self.metadata = metadata.assign(lkey=metadata['key'].str.lower())
+
+    def get(self, key: str, value: str) -> np.ndarray:
+        """
+        Get sorted ids of analyses with metadata key=value (case insensitive)
+        """
+        try:
+            return self.index[(key.lower(), str(value).lower())]
+        except KeyError:
+            return np.array([], dtype=np.int64)
+
+    def get_metadata(self, analyses: Iterable[int], keys: Iterable[str]) -> pd.DataFrame:
+        """
+        Metadata of analyses by lowercased key, like get_metadata with lowercased columns
+
+        Keys that none of the analyses have are left out, other missing values are "None".
+        """
+        analyses = pd.unique(np.asarray(analyses, dtype=np.int64))
+        keys = {k.lower() for k in keys}
+
+        df = self.metadata.loc[self.metadata['analysis_id'].isin(analyses) & self.metadata['lkey'].isin(keys), :]
+        df = (df.drop_duplicates(['analysis_id', 'lkey'])
+              .pivot(index='analysis_id', columns='lkey', values='value')
+              .reindex(index=analyses)
+              .fillna('None'))
+        df.columns.name = None
+
+        return df
+
+
+def get_metadata_version() -> Version:
+    """
+    Change counter for the metadata
+
+    Imports add rows with higher ids and removals lower the counts. Values are hashed, since they can be edited
+    in place.
+    """
+    analyses = Analysis.objects.aggregate(count=Count('id'), last=Max('id'))
+    analysis_data = AnalysisData.objects.aggregate(count=Count('id'), last=Max('id'))
+
+    values = hashlib.md5()
+    for row in AnalysisData.objects.order_by('id').values_list('id', 'key_id', 'value').iterator():
+        values.update('\t'.join(map(str, row)).encode() + b'\n')
+
+    return analyses['count'], analyses['last'], analysis_data['count'], analysis_data['last'], values.hexdigest()[:8]
+
+
+def load_metadata_index() -> MetadataIndex:
+    version = get_metadata_version()
+
+    metadata = pd.DataFrame(
+        AnalysisData.objects.values_list('analysis_id', 'key__name', 'value').iterator(),
+        columns=['analysis_id', 'key', 'value'])
+
+    genes = pd.DataFrame(Analysis.objects.values_list('id', 'tf__gene_id', 'tf__name').iterator(),
+                         columns=['analysis_id', 'gene_id', 'gene_name'])
+    genes['analysis_id'] = genes['analysis_id'].astype(str)
+    genes.insert(0, 'id', genes['analysis_id'].astype(np.int64))
+    genes = genes.melt(id_vars='id', var_name='key').rename(columns={'id': 'analysis_id'})
+    genes['value'] = genes['value'].fillna('').astype(str)
+
+    metadata['analysis_id'] = metadata['analysis_id'].astype(np.int64)
+    metadata['value'] = metadata['value'].fillna('').astype(str)
+
+    return MetadataIndex(metadata, version, genes)
+
+
+@skip_for_management
+def get_initial_index() -> Optional[MetadataIndex]:
+    try:
+        return load_metadata_index()
+    except DatabaseError:
+        logger.warning("Could not load metadata index, falling back to database queries.")
+        return None
+
+
+async_loader['metadata'] = get_initial_index
+
+
+def get_metadata_index() -> Optional[MetadataIndex]:
+    """
+    Get the metadata index, reloading it if the metadata in the database changed
+
+    :return: None if the index is not loaded
+    """
+    index = async_loader['metadata']
+
+    if index is not None and time.monotonic() - index.checked > CHECK_INTERVAL:
+        index.checked = time.monotonic()
+
+        try:
+            if get_metadata_version() != index.version:
+                index = load_metadata_index()
+                async_loader['metadata'] = index
+        except DatabaseError:
+            logger.warning("Could not reload metadata index.")
+
+    return index
+
+
+@receiver(post_save, sender=Analysis)
+@receiver(post_save, sender=AnalysisData)
+@receiver(post_delete, sender=Analysis)
+@receiver(post_delete, sender=AnalysisData)
+def invalidate_metadata_index(**kwargs):
+    index = async_loader.data.get('metadata')
+
+    if isinstance(index, MetadataIndex):
+        index.checked = -np.inf
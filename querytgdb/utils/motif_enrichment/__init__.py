@@ -1,7 +1,6 @@
 import math
 import sys
 from collections import Counter, OrderedDict
-from functools import partial
 from io import BytesIO
 from itertools import chain, count, cycle, repeat, starmap, tee
 from operator import attrgetter, itemgetter
@@ -15,13 +14,15 @@ import scipy.cluster.hierarchy as hierarchy
 import seaborn as sns
 from django.conf import settings
 from django.core.cache import cache
-from scipy.stats import fisher_exact
 from statsmodels.stats.multitest import multipletests
 
 from querytgdb.models import Analysis
 from querytgdb.utils import clear_data, column_string, get_metadata, svg_font_adder
-from querytgdb.utils.motif_enrichment.motif import AdditionalMotifData, MotifData, Region
+from querytgdb.utils.artifacts import artifacts
+from querytgdb.utils.motif_enrichment.motif import AdditionalMotifData, MotifData, Region, RegionMatrix
 from querytgdb.utils.parser import Id, Ids
+from querytgdb.utils.results import load_result
+from querytgdb.utils.stats import fisher_exact_greater, indicator_matrix
 
 sns.set()
 
@@ -93,6 +94,8 @@ class Mrna(Region):
     group = [2, 3, 4, 5]
 
 
+artifacts.register('motif_enrichment', ['tabular_output', 'target_genes'], [f'{r}_enrich' for r in MOTIFS.regions])
+
 try:
     CLUSTER_INFO = pd.read_csv(
         settings.MOTIF_CLUSTER_INFO,
@@ -117,48 +120,45 @@ class MotifDict(OrderedDict):
         super().__setitem__(key, value)
 
 
-def cluster_fisher(row):
-    return fisher_exact((row[:2], row[2:]), alternative='greater')[1]
+def get_region_enrichment(gene_lists: Iterable[Iterable[str]],
+                          motif_lists: Iterable[Optional[List[str]]],
+                          matrix: RegionMatrix) -> List[pd.Series]:
+    """
+    Test each gene list for enrichment of the motif clusters of a region
 
+    The cluster counts of all lists are one product of a list × gene indicator matrix with the gene × cluster
+    count matrix of the region.
 
-def get_list_enrichment(gene_list: Iterable[str],
-                        motifs: Optional[List[str]],
-                        annotated: pd.DataFrame,
-                        ann_cluster_size: pd.DataFrame,
-                        total: int) -> pd.Series:
-    if motifs is None:
-        list_cluster_dedup = annotated.loc[annotated.index.get_level_values(0).isin(gene_list), :]
-    else:
-        list_cluster_dedup = annotated.loc[
-                             annotated.index.get_level_values(0).isin(gene_list) &
-                             annotated.index.get_level_values(2).isin(motifs), :]
-        ann_cluster_size = ann_cluster_size[ann_cluster_size.index.isin(motifs)]
-    if list_cluster_dedup.empty:
-        m = annotated.index.get_level_values(2).unique() if motifs is None else motifs
-        list_cluster_dedup = pd.DataFrame(0,
-                                          index=pd.MultiIndex.from_product(
-                                              [gene_list, annotated.index.get_level_values(1).unique(), m]),
-                                          columns=[3])
-
-    list_cluster_size = list_cluster_dedup.groupby(level=2).sum()
-
-    if motifs is None:
-        list_cluster_sum = list_cluster_dedup.sum()
-    else:
-        list_cluster_sum = annotated.loc[annotated.index.get_level_values(0).isin(gene_list), :].sum()
+    :param gene_lists:
+    :param motif_lists: clusters to test for each list, all if None
+    :param matrix:
+    :return: p-values by cluster for each gene list
+    """
+    counts, genes, clusters = matrix
+
+    lists = indicator_matrix(list(gene_lists), genes)
 
-    contingency = pd.concat([
-        list_cluster_size,
-        ann_cluster_size - list_cluster_size,
-        list_cluster_sum - list_cluster_size,
-        total - list_cluster_sum - ann_cluster_size + list_cluster_size
-    ], axis=1, sort=False)
+    list_cluster_size = (lists @ counts).toarray()
+    list_cluster_sum = list_cluster_size.sum(axis=1, keepdims=True)
+    ann_cluster_size = np.asarray(counts.sum(axis=0))
+    total = counts.sum()
 
-    if contingency.empty:
-        return pd.Series([])
+    p_values = fisher_exact_greater(list_cluster_size,
+                                    ann_cluster_size - list_cluster_size,
+                                    list_cluster_sum - list_cluster_size,
+                                    total - list_cluster_sum - ann_cluster_size + list_cluster_size)
 
-    p_values = contingency.fillna(0).apply(cluster_fisher, axis=1)
-    return p_values
+    result = []
+
+    for p, motifs in zip(p_values, motif_lists):
+        p = pd.Series(p, index=clusters)
+
+        if motifs is not None:
+            p = p[clusters.isin(motifs)]
+
+        result.append(p)
+
+    return result
 
 
 def correct_pvalues(df: pd.DataFrame) -> pd.DataFrame:
@@ -203,26 +203,12 @@ def motif_enrichment(res: Dict[Tuple[Tuple[str, str, str], int], Set[str]],
     else:
         cached_region = {}
 
-    annotated = None
-
     for region in regions:
         try:
             region_enrich = cached_region[f'{uid}/{region}_enrich']
         except KeyError:
-            if annotated is None:
-                genes = set(chain.from_iterable(res.values()))
-                annotated = motif_data.annotation
-                annotated = annotated.loc[(
-                                              annotated.index.get_level_values(0).isin(genes),
-                                              regions,
-                                              slice(None)
-                                          ), :]
-            region_enrich = list(map(partial(get_list_enrichment,
-                                             annotated=annotated.loc[(slice(None), region, slice(None)), :],
-                                             ann_cluster_size=getattr(motif_data, f'{region}_cluster_size'),
-                                             total=motif_data.region_total.loc[region, :].squeeze()),
-                                     res.values(),
-                                     motif_dict.values()))
+            region_enrich = get_region_enrichment(res.values(), motif_dict.values(), motif_data.region_matrix(region))
+
             if uid is not None:
                 cache.set(f'{uid}/{region}_enrich', region_enrich)
 
@@ -264,8 +250,8 @@ def motif_enrichment(res: Dict[Tuple[Tuple[str, str, str], int], Set[str]],
 
 
 def get_analysis_gene_list(uid: Union[str, UUID]) -> Dict[Id, Set[str]]:
-    cached_data = cache.get_many([f'{uid}/tabular_output', f'{uid}/target_genes'])
-    df = cached_data[f'{uid}/tabular_output']
+    cached_data = cache.get_many([f'{uid}/target_genes'])
+    df = load_result(uid, 'tabular_output', ['EDGE', 'Log2FC'])
     df = clear_data(df)
     res = OrderedDict((name, set(col.index[col.notnull()])) for name, col in df.iteritems())
 
@@ -549,8 +535,9 @@ TableRow = Tuple[Dict, str, str, str, str, str]
 
 def get_motif_enrichment_heatmap_table(uid: Union[str, UUID], use_labels: bool = False) -> \
         Generator[TableRow, None, None]:
-    cached_data = cache.get_many([f'{uid}/tabular_output', f'{uid}/target_genes', f'{uid}/analysis_ids'])
-    df, ids = itemgetter(f'{uid}/tabular_output', f'{uid}/analysis_ids')(cached_data)
+    cached_data = cache.get_many([f'{uid}/target_genes', f'{uid}/analysis_ids'])
+    df = load_result(uid, 'tabular_output', ['EDGE', 'Log2FC'])
+    ids = cached_data[f'{uid}/analysis_ids']
     df = clear_data(df)
 
     metadata = get_metadata(df.columns.get_level_values(1))
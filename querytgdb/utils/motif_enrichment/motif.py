@@ -1,38 +1,103 @@
+import logging
+import os
 import re
 from abc import ABC
 from collections import OrderedDict
-from typing import Dict, List, Optional, Type
+from functools import partial
+from typing import Any, Dict, List, NamedTuple, Optional, Type
 
+import numpy as np
 import pandas as pd
+import scipy.sparse as sparse
 import seaborn as sns
 from django.conf import settings
 
 from querytgdb.utils import async_loader, skip_for_management
+from querytgdb.utils.snapshot import get_file_version, get_frame, read_frame, write_frame
+
+logger = logging.getLogger(__name__)
 
 
 class MotifError(Exception):
     pass
 
 
+def get_compiled_dir(path: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(path)), 'compiled')
+
+
+def get_compiled_name(path: str) -> str:
+    return 'motifs_' + re.sub(r'[^\w.-]', '_', os.path.basename(path))
+
+
+def load_annotation_file(path: str) -> pd.DataFrame:
+    # levels are unnamed, like the compiled annotation
+    return pd.read_csv(path, index_col=[0, 1, 2], header=None).rename_axis([None, None, None])
+
+
+def compile_annotation_file(path: str) -> str:
+    """
+    Save a motif annotation file as integer coded genes, regions and motifs with their dictionaries, next to the file
+
+    The compiled annotation is keyed by the contents of the file, and memory-mapped by read_annotation_file instead
+    of parsing the file until the contents change. It stays valid when the data directory is copied elsewhere.
+
+    :param path:
+    :return: directory of the compiled annotation
+    """
+    version = get_file_version(path)
+    root = get_compiled_dir(path)
+    name = get_compiled_name(path)
+
+    write_frame(name, version, load_annotation_file(path), root)
+
+    return os.path.join(root, name, version)
+
+
+def read_annotation_file(path: str) -> pd.DataFrame:
+    version = get_file_version(path)
+    name = get_compiled_name(path)
+
+    try:
+        df = read_frame(name, version, get_compiled_dir(path))
+    except (OSError, ValueError):
+        logger.warning("Could not read the compiled annotation of %s.", path, exc_info=True)
+        df = None
+
+    if df is not None:
+        return df
+
+    logger.warning("No compiled annotation matches %s, falling back to parsing it. "
+                   "Run 'import_motifs --compile' to compile it.", path)
+
+    return get_frame(name, version, partial(load_annotation_file, path))
+
+
 @skip_for_management
 def get_annotations():
-    return pd.read_csv(settings.MOTIF_ANNOTATION, index_col=[0, 1, 2], header=None)
+    return read_annotation_file(settings.MOTIF_ANNOTATION)
 
 
 @skip_for_management
 def get_tf_annotations():
-    return pd.read_csv(settings.MOTIF_TF_ANNOTATION, index_col=[0, 1, 2], header=None)
+    return read_annotation_file(settings.MOTIF_TF_ANNOTATION)
 
 
 async_loader['motifs'] = get_annotations
 async_loader['motifs_tf'] = get_tf_annotations
 
 
+class RegionMatrix(NamedTuple):
+    counts: sparse.csr_matrix  # motif counts, genes × clusters
+    genes: pd.Index
+    clusters: pd.Index
+
+
 class MotifData:
     _regions: Dict[str, 'Region'] = OrderedDict()
 
     def __init__(self, background: Optional[pd.Series] = None):
-        self.cache: Dict[str, pd.DataFrame] = {}
+        self.cache: Dict[str, Any] = {}
         self._colors = None
         self.background = background
 
@@ -80,6 +145,33 @@ class MotifData:
 
             return cluster_size
 
+    def region_matrix(self, region) -> RegionMatrix:
+        """
+        Get the motif counts of a region as a sparse gene × cluster matrix
+        :param region:
+        :return:
+        """
+        try:
+            return self.cache[region + '_matrix']
+        except KeyError:
+            # built from the index codes, so the region is not sliced out of a memory-mapped annotation
+            index = self.annotation.index
+            in_region = index.codes[1] == index.levels[1].get_loc(self._regions[region].name)
+
+            cluster_codes, cluster_rows = np.unique(index.codes[2][in_region], return_inverse=True)
+
+            genes = index.levels[0]
+            clusters = index.levels[2][cluster_codes]
+
+            counts = sparse.csr_matrix(
+                (self.annotation.values[in_region, 0], (index.codes[0][in_region], cluster_rows)),
+                shape=(len(genes), len(clusters)))
+
+            matrix = RegionMatrix(counts, genes, clusters)
+            self.cache[region + '_matrix'] = matrix
+
+            return matrix
+
     @property
     def region_total(self):
         try:
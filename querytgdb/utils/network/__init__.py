@@ -18,6 +18,7 @@ from querytgdb.utils import async_loader
 from ..parser import filter_df_by_ids
 from ...models import Analysis, Annotation, EdgeData, EdgeType
 from ...utils import data_to_edges, get_size
+from ...utils.results import load_result
 from ...utils.network.utils import COLOR, COLOR_SHAPE
 
 GENE_TYPE = async_loader['annotations'][['Name', 'Type', 'id']]
@@ -76,11 +77,10 @@ def get_network_json(uid: Union[str, UUID],
     :return:
     """
     network_key = f'{uid}/network'
-    df_key = f'{uid}/tabular_output'
 
-    cached_data = cache.get_many([df_key, network_key])
+    cached_data = cache.get_many([network_key])
 
-    df = cached_data[df_key]
+    df = load_result(uid, 'tabular_output', ['EDGE', 'Log2FC'])
 
     analyses = (pd.DataFrame(
         Analysis.objects.filter(
@@ -261,13 +261,12 @@ def get_network_json(uid: Union[str, UUID],
             except TypeError:
                 cached_data = cache.get_many([
                     f"{uid}/target_network",
-                    f'{uid}/tabular_output_unfiltered',
                     f'{uid}/analysis_ids'
                 ])
 
                 name, network_data = cached_data[f"{uid}/target_network"]
                 network_data = network_data.sort_values('rank')
-                df_unf = cached_data[f'{uid}/tabular_output_unfiltered']
+                df_unf = load_result(uid, 'tabular_output_unfiltered', ['EDGE', 'Log2FC'])
                 ids = cached_data[f'{uid}/analysis_ids']
                 df_unf = filter_df_by_ids(df_unf, ids)
 
@@ -318,11 +317,10 @@ def get_network_sif(uid: Union[str, UUID],
     Get cytoscape network SIF from queried data.
     """
     network_key = f'{uid}/network'
-    df_key = f'{uid}/tabular_output'
 
-    cached_data = cache.get_many([df_key, network_key])
+    cached_data = cache.get_many([network_key])
 
-    df = cached_data[df_key]
+    df = load_result(uid, 'tabular_output', ['EDGE', 'Log2FC'])
 
     analyses = (pd.DataFrame(
         Analysis.objects.filter(
@@ -399,13 +397,12 @@ def get_network_sif(uid: Union[str, UUID],
             except TypeError:
                 cached_data = cache.get_many([
                     f"{uid}/target_network",
-                    f'{uid}/tabular_output_unfiltered',
                     f'{uid}/analysis_ids'
                 ])
 
                 name, network_data = cached_data[f"{uid}/target_network"]
                 network_data = network_data.sort_values('rank')
-                df_unf = cached_data[f'{uid}/tabular_output_unfiltered']
+                df_unf = load_result(uid, 'tabular_output_unfiltered', ['EDGE', 'Log2FC'])
 
                 ids = cached_data[f'{uid}/analysis_ids']
                 df_unf = filter_df_by_ids(df_unf, ids)
@@ -597,9 +594,8 @@ def get_pruned_network(uid: str, cutoff: float) -> pd.DataFrame:
         recall, precision, g = cache.get(f'{uid}/figure_data')
     except TypeError:
         try:
-            cached_data = cache.get_many([f'{uid}/tabular_output_unfiltered', f'{uid}/analysis_ids'])
-            df = cached_data[f'{uid}/tabular_output_unfiltered']
-            ids = cached_data[f'{uid}/analysis_ids']
+            df = load_result(uid, 'tabular_output_unfiltered', ['EDGE', 'Log2FC'])
+            ids = cache.get_many([f'{uid}/analysis_ids'])[f'{uid}/analysis_ids']
             df = filter_df_by_ids(df, ids)
         except KeyError as e:
             raise ValueError("Query data not found") from e
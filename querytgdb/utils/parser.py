@@ -1,11 +1,13 @@
+import hashlib
 import logging
 import operator
 import re
 from collections import UserDict, defaultdict, deque
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial, reduce
+from itertools import chain
 from operator import and_, itemgetter, methodcaller, or_
-from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple, Union
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Sequence, Set, Tuple, Union
 from uuid import UUID, uuid4
 
 import numpy as np
@@ -14,12 +16,17 @@ import pyparsing as pp
 from django.conf import settings
 from django.core.cache import cache, caches
 from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
-from django.db.models import Q
+from django.db import connections
+from django.db.models import Exists, OuterRef, Q
 
 from querytgdb.models import Analysis, Annotation, EdgeData, EdgeType, Interaction, Regulation
 from querytgdb.utils import async_loader
-from ..utils import CaselessDict, clear_data, get_metadata as get_meta_df
+from ..utils import CaselessDict, LRUCache, clear_data, get_metadata as get_meta_df
 from ..utils.file import UserGeneLists
+from ..utils.metadata import get_metadata_index, get_metadata_version
+from ..utils.results import link_result, load_result, save_result
+from ..utils.snapshot import get_table_version
+from ..utils.store import InteractionStore, get_store, get_store_version, load_interaction_store
 
 logger = logging.getLogger(__name__)
 
@@ -111,7 +118,7 @@ def parse_prebuilt_query(tocs):
 named_query = reduce(lambda a, b: a | b, map(pp.CaselessKeyword, NAMED_QUERIES.keys())).setParseAction(
     parse_prebuilt_query)
 
-gene = (all_tfs | multitype | named_query | name)('gene_name')
+gene = (all_tfs | multitype | named_query | pl_name | name)('gene_name')
 
 # additional functions
 
@@ -147,19 +154,41 @@ def mod_to_str(curr: pp.ParseResults) -> str:
         return str(curr)
 
 
-def query_metadata(df: TargetFrame, key: str, value: str) -> pd.DataFrame:
-    ref_ids = Analysis.objects.filter(
+def get_metadata_analyses(key: str, value: str) -> np.ndarray:
+    index = get_metadata_index()
+
+    if index is not None:
+        return index.get(key, value)
+
+    return np.fromiter(Analysis.objects.filter(
         (Q(analysisdata__key__name__iexact=key) & Q(analysisdata__value__iexact=value))
-    ).values_list('id', flat=True)
+    ).values_list('id', flat=True).iterator(), dtype=np.int64)
+
+
+def get_blocks(df: TargetFrame) -> Tuple[pd.MultiIndex, np.ndarray]:
+    """
+    Get the (name, analysis) column blocks of a TargetFrame, and the block of each column
+    :param df:
+    :return: blocks, block index of each column
+    """
+    columns = df.columns.droplevel(2)
+    blocks = columns.unique()
 
-    if not ref_ids:
-        return pd.DataFrame(False, columns=df.columns, index=df.index)
+    return blocks, blocks.get_indexer(columns)
 
-    mask = pd.DataFrame(True, columns=df.columns, index=df.index)
 
-    mask.loc[:, ~df.columns.get_level_values(1).isin(ref_ids)] = False
+def broadcast_rows(rows: np.ndarray, df: TargetFrame) -> np.ndarray:
+    return np.broadcast_to(rows[:, np.newaxis], df.shape)
 
-    return mask
+
+def broadcast_columns(columns: np.ndarray, df: TargetFrame) -> np.ndarray:
+    return np.broadcast_to(columns, df.shape)
+
+
+def query_metadata(df: TargetFrame, key: str, value: str) -> np.ndarray:
+    ref_ids = get_metadata_analyses(key, value)
+
+    return broadcast_columns(np.isin(df.columns.get_level_values(1), ref_ids), df)
 
 
 OPERS = {
@@ -173,34 +202,44 @@ OPERS = {
 }
 
 
-def apply_comp_mod(df: TargetFrame, key: str, oper: str, value: float) -> pd.DataFrame:
+def apply_comp_mod(df: TargetFrame, key: str, oper: str, value: float) -> np.ndarray:
     """
     apply Pvalue and Log2FC (fold change)
-    """
-    try:
-        c = df[(*df.name, key)]
-    except KeyError:
-        return pd.DataFrame(False, columns=df.columns, index=df.index)
-
-    mask = pd.DataFrame(True, columns=df.columns, index=df.index)
 
+    Each column block is masked by the comparison on its own key column, or is False without one.
+    """
     try:
-        return mask.where(OPERS[oper](c, value), False)
+        op = OPERS[oper]
     except KeyError as e:
         raise ValueError('invalid operator: {}'.format(oper)) from e
 
+    blocks, codes = get_blocks(df)
+    is_key = df.columns.get_level_values(2) == key
 
-def apply_search_column(df: TargetFrame, key, value) -> pd.DataFrame:
-    mask = pd.DataFrame(True, columns=df.columns, index=df.index)
+    block_mask = np.zeros((df.shape[0], len(blocks)), dtype=np.bool_)
 
-    try:
-        return mask.where(df[(*df.name, key)].str.contains(value, case=False, regex=False), False)
-    except KeyError:
-        mask.loc[:, :] = False
-        return mask
+    if is_key.any():
+        with np.errstate(invalid='ignore'):
+            block_mask[:, codes[is_key]] = op(df.loc[:, is_key].values.astype(np.float64), value)
+
+    return block_mask[:, codes]
+
+
+def apply_search_column(df: TargetFrame, key, value) -> np.ndarray:
+    blocks, codes = get_blocks(df)
+    is_key = df.columns.get_level_values(2) == key
 
+    block_mask = np.zeros((df.shape[0], len(blocks)), dtype=np.bool_)
 
-def match_id(df: TargetFrame, oper: str, analysis_id: Union[str, int]):
+    if is_key.any():
+        values = df.loc[:, is_key].values
+        found = pd.Series(values.ravel(), dtype=object).str.contains(value, case=False, regex=False)
+        block_mask[:, codes[is_key]] = found.fillna(False).values.astype(np.bool_).reshape(values.shape)
+
+    return block_mask[:, codes]
+
+
+def match_id(df: TargetFrame, oper: str, analysis_id: Union[str, int]) -> np.ndarray:
     """
     Filter dataframe by analysis_id
     :param df:
@@ -208,10 +247,7 @@ def match_id(df: TargetFrame, oper: str, analysis_id: Union[str, int]):
     :param analysis_id:
     :return:
     """
-    mask = pd.DataFrame(False, columns=df.columns, index=df.index)
-    mask.loc[:, (slice(None), OPERS[oper](df.columns.get_level_values(1), int(analysis_id)), slice(None))] = True
-
-    return mask
+    return broadcast_columns(np.asarray(OPERS[oper](df.columns.get_level_values(1), int(analysis_id))), df)
 
 
 COL_TRANSLATE = {
@@ -221,37 +257,53 @@ COL_TRANSLATE = {
 }
 
 
-def apply_has_column(df: TargetFrame, value) -> pd.DataFrame:
+def apply_has_column(df: TargetFrame, value) -> np.ndarray:
     try:
         value = COL_TRANSLATE[value]
     except KeyError:
         pass
 
-    if (*df.name, value) in df:
-        return pd.DataFrame(True, columns=df.columns, index=df.index)
+    blocks, codes = get_blocks(df)
+    has_column = np.zeros(len(blocks), dtype=np.bool_)
+    has_column[codes[df.columns.get_level_values(2) == value]] = True
 
-    return pd.DataFrame(False, columns=df.columns, index=df.index)
+    return broadcast_columns(has_column[codes], df)
 
 
-def apply_has_add_edges(df: TargetFrame, analyses, anno_ids, value) -> pd.DataFrame:
-    mask = pd.DataFrame(True, columns=df.columns, index=df.index)
+def apply_has_add_edges(df: TargetFrame, value) -> np.ndarray:
+    """
+    Keep targets of each column block that also have an additional edge of type value from the TF
+    """
     try:
         edge_type = EdgeType.objects.get(name__iexact=value)
-        target_ids = set(EdgeData.objects.filter(
+    except (ObjectDoesNotExist, MultipleObjectsReturned):
+        return np.zeros(df.shape, dtype=np.bool_)
+
+    blocks, codes = get_blocks(df)
+    tf_ids = dict(Analysis.objects.filter(
+        pk__in=blocks.get_level_values(1).unique()
+    ).values_list('id', 'tf_id'))
+    block_tfs = np.array([tf_ids.get(a, -1) for a in blocks.get_level_values(1)], dtype=np.int64)
+
+    edge_data = pd.DataFrame(
+        EdgeData.objects.filter(
             type=edge_type,
-            tf_id=analyses.get(pk=df.name[1]).tf_id
-        ).values_list('target_id', flat=True).iterator())
+            tf_id__in=list(set(tf_ids.values()))
+        ).values_list('tf_id', 'target_id').iterator(),
+        columns=['tf_id', 'target_id'])
 
-        target_ids &= set(anno_ids.loc[df.index[df.notna().any(axis=1)]].unique())
+    anno_ids = async_loader['annotations'].loc[df.index, 'id'].values
 
-        mask.loc[~df.index.isin(anno_ids.index[anno_ids.isin(target_ids)]), :] = False
-    except (ObjectDoesNotExist, MultipleObjectsReturned):
-        mask.loc[:, :] = False
+    has_data = pd.DataFrame(df.notna().values).groupby(codes, axis=1).any().values
+    block_mask = np.zeros((df.shape[0], len(blocks)), dtype=np.bool_)
+
+    for tf_id, targets in edge_data.groupby('tf_id')['target_id']:
+        block_mask[:, block_tfs == tf_id] = np.isin(anno_ids, targets.values)[:, np.newaxis]
 
-    return mask
+    return (block_mask & has_data)[:, codes]
 
 
-def match_targeted_by(df, oper, value):
+def match_targeted_by(df, oper, value) -> np.ndarray:
     frac = False
     if '%' in value:
         value = float(value.rstrip('% ')) / 100
@@ -262,8 +314,6 @@ def match_targeted_by(df, oper, value):
     if 0 <= value < 1:
         frac = True
 
-    mask = pd.DataFrame(False, columns=df.columns, index=df.index)
-
     cleared = df.pipe(clear_data)
 
     targeted_count = cleared.count(axis=1)
@@ -275,21 +325,79 @@ def match_targeted_by(df, oper, value):
     else:
         rows = op_func(targeted_count, value)
 
-    mask.loc[rows, :] = True
+    return broadcast_rows(rows.values, df)
 
-    return mask
 
+ROW_KEYS = {'pvalue', 'log2fc', 'additional_edge', 'targeted_by'}
 
-def get_mod(df: TargetFrame, query: Union[pp.ParseResults, pd.DataFrame]) -> pd.DataFrame:
+
+def get_mod_analyses(query: Union[pp.ParseResults, np.ndarray], analyses: np.ndarray) -> Optional[np.ndarray]:
+    """
+    Resolve a modifier on analysis ids and metadata alone with set operations
+
+    :param query:
+    :param analyses: sorted ids of all analyses in the frame
+    :return: sorted ids of analyses that pass, None if the modifier also depends on edges
     """
-    Get ref_id from modifier to filter TF dataframe
+    if isinstance(query, pp.ParseResults):
+        if 'key' not in query:
+            it = iter(query)
+            stack: Deque[Union[pp.ParseResults, np.ndarray]] = deque()
 
+            try:
+                while True:
+                    curr = next(it)
+                    if curr in ('and', 'or'):
+                        prec = get_mod_analyses(stack.pop(), analyses)
+                        if prec is None:
+                            return None
+
+                        succ = get_mod_analyses(next(it), analyses)
+                        if succ is None:
+                            return None
+
+                        if curr == 'and':
+                            stack.append(np.intersect1d(prec, succ, assume_unique=True))
+                        else:
+                            stack.append(np.union1d(prec, succ))
+                    elif curr == 'not':
+                        succ = get_mod_analyses(next(it), analyses)
+                        if succ is None:
+                            return None
+
+                        stack.append(np.setdiff1d(analyses, succ, assume_unique=True))
+                    else:
+                        stack.append(curr)
+            except StopIteration:
+                return get_mod_analyses(stack.pop(), analyses)
+        else:
+            key, oper, value = itemgetter('key', 'oper', 'value')(query)
+            if key in ROW_KEYS:
+                return None
+            elif key == 'id':
+                return analyses[OPERS[oper](analyses, int(value))]
+            else:
+                return np.intersect1d(analyses, get_metadata_analyses(key, value))
+    return query
+
+
+def get_mod(df: TargetFrame, query: Union[pp.ParseResults, np.ndarray]) -> np.ndarray:
+    """
+    Get boolean mask from modifier to filter TF dataframe
+
+    Masks are numpy arrays with the shape of df, possibly read only broadcasts of a row or column mask.
     Careful not to modify original df
     """
     if isinstance(query, pp.ParseResults):
+        analysis_ids = df.columns.get_level_values(1).values.astype(np.int64)
+        analyses = get_mod_analyses(query, np.unique(analysis_ids))
+
+        if analyses is not None:
+            return broadcast_columns(np.isin(analysis_ids, analyses), df)
+
         if 'key' not in query:
             it = iter(query)
-            stack: Deque[Union[pp.ParseResults, pd.DataFrame]] = deque()
+            stack: Deque[Union[pp.ParseResults, np.ndarray]] = deque()
 
             try:
                 while True:
@@ -310,16 +418,11 @@ def get_mod(df: TargetFrame, query: Union[pp.ParseResults, pd.DataFrame]) -> pd.
         else:
             key, oper, value = itemgetter('key', 'oper', 'value')(query)
             if key == 'pvalue':
-                return df.groupby(level=[0, 1], axis=1).apply(apply_comp_mod, key=PVALUE, oper=oper, value=value)
+                return apply_comp_mod(df, key=PVALUE, oper=oper, value=value)
             elif key == 'log2fc':
-                return df.groupby(level=[0, 1], axis=1).apply(apply_comp_mod, key=LOG2FC, oper=oper, value=value)
+                return apply_comp_mod(df, key=LOG2FC, oper=oper, value=value)
             elif key == 'additional_edge':
-                analyses = Analysis.objects.filter(pk__in=df.columns.get_level_values(1)).prefetch_related('tf')
-                anno_ids = async_loader['annotations'].loc[df.index, 'id']
-                return df.groupby(level=[0, 1], axis=1).apply(apply_has_add_edges,
-                                                              analyses=analyses,
-                                                              anno_ids=anno_ids,
-                                                              value=value)
+                return apply_has_add_edges(df, value=value)
             elif key == 'id':
                 return match_id(df, oper, value)
             elif key == 'targeted_by':
@@ -329,6 +432,115 @@ def get_mod(df: TargetFrame, query: Union[pp.ParseResults, pd.DataFrame]) -> pd.
     return query
 
 
+Predicate = Tuple[str, str, Any]
+
+EDGE_KEYS = {
+    'pvalue': PVALUE,
+    'log2fc': LOG2FC
+}
+
+REGULATION_FIELDS = {
+    'pvalue': 'p_value',
+    'log2fc': 'foldchange'
+}
+
+LOOKUPS = {
+    '>': 'gt',
+    '>=': 'gte',
+    '<': 'lt',
+    '<=': 'lte',
+    '=': 'exact'
+}
+
+
+def iter_mods(query: pp.ParseResults) -> Iterator[pp.ParseResults]:
+    if is_mod(query):
+        yield query
+    elif isinstance(query, pp.ParseResults):
+        for q in query:
+            yield from iter_mods(q)
+
+
+def get_conjuncts(query: pp.ParseResults) -> List[pp.ParseResults]:
+    """
+    Get the mods joined by "and" at the top of a modifier
+    """
+    if is_mod(query):
+        return [query]
+
+    if any(q in ('or', 'not') for q in query if isinstance(q, str)):
+        return []
+
+    return list(chain.from_iterable(get_conjuncts(q) for q in query if not isinstance(q, str)))
+
+
+def get_pushdown(modifier: pp.ParseResults) -> List[Predicate]:
+    """
+    Get predicates of a modifier that can be applied while fetching edges
+
+    Conjuncts on p-value, fold change, analysis id and metadata keep a superset of the edges that get_mod
+    keeps, so get_mod is still applied to the fetched data afterwards. Nothing is pushed down if the
+    modifier counts edges across analyses with targeted_by. Operands that count targets across analyses, like
+    andalltfs, are not given predicates either, see get_modifier_operand.
+    """
+    if any(m['key'] == 'targeted_by' for m in iter_mods(modifier)):
+        return []
+
+    return [(m['key'], m['oper'], m['value']) for m in get_conjuncts(modifier) if m['key'] != 'additional_edge']
+
+
+def filter_analyses(analyses: np.ndarray, predicates: List[Predicate]) -> np.ndarray:
+    for key, oper, value in predicates:
+        if key == 'id':
+            analyses = analyses[OPERS[oper](analyses, int(value))]
+        elif key not in EDGE_KEYS:
+            analyses = np.intersect1d(analyses, get_metadata_analyses(key, value))
+
+    return analyses
+
+
+def filter_edges(df: pd.DataFrame, predicates: List[Predicate]) -> pd.DataFrame:
+    """
+    Filter edges in long format by p-value and fold change predicates
+    """
+    mask = np.ones(df.shape[0], dtype=np.bool_)
+
+    for key, oper, value in predicates:
+        if key in EDGE_KEYS:
+            mask &= OPERS[oper](df[EDGE_KEYS[key]].values, value)
+
+    if mask.all():
+        return df
+
+    return df[mask]
+
+
+def get_regulation_q(predicates: List[Predicate]) -> Q:
+    """
+    Translate p-value and fold change predicates to a filter on Regulation
+
+    != is left out, since edges without p-values and fold changes pass it.
+    """
+    q = Q()
+
+    for key, oper, value in predicates:
+        if key in REGULATION_FIELDS and oper in LOOKUPS:
+            q &= Q(**{f'{REGULATION_FIELDS[key]}__{LOOKUPS[oper]}': value})
+
+    return q
+
+
+def filter_regulated(qs, reg_q: Q):
+    """
+    Only keep interactions with regulation data that satisfies reg_q
+    """
+    return qs.annotate(
+        regulated=Exists(Regulation.objects.filter(reg_q,
+                                                   analysis_id=OuterRef('analysis_id'),
+                                                   target_id=OuterRef('target_id')))
+    ).filter(regulated=True)
+
+
 def gene_to_ids(metadata, ids):
     d: Dict[str, set] = defaultdict(set)
     for idx in ids:
@@ -338,8 +550,13 @@ def gene_to_ids(metadata, ids):
 
 
 def get_column_filter(df: TargetFrame, filter_list) -> TargetFrame:
-    metadata = get_meta_df(Analysis.objects.filter(pk__in=df.columns.get_level_values(1)))
-    metadata.columns = metadata.columns.str.lower()
+    index = get_metadata_index()
+
+    if index is not None:
+        metadata = index.get_metadata(df.columns.get_level_values(1), ['gene_id', *(q['key'] for q in filter_list)])
+    else:
+        metadata = get_meta_df(Analysis.objects.filter(pk__in=df.columns.get_level_values(1)))
+        metadata.columns = metadata.columns.str.lower()
     result = []
     for query in filter_list:
         key, oper, value = itemgetter('key', 'oper', 'value')(query)
@@ -425,58 +642,108 @@ def initialize_column_name(col_name) -> Tuple[str, str, str]:
     return col_name, "", str(uuid4())
 
 
+def in_tf_filter(query: str, tf_filter_list: Optional[pd.Series] = None) -> bool:
+    return tf_filter_list is None or tf_filter_list.str.contains(rf'^{re.escape(query)}$', flags=re.I).any()
+
+
 def get_tf_data(query: str,
                 edges: Optional[List[str]] = None,
                 tf_filter_list: Optional[pd.Series] = None,
-                target_filter_list: Optional[pd.Series] = None) -> TargetFrame:
+                target_filter_list: Optional[pd.Series] = None,
+                predicates: Optional[List[Predicate]] = None,
+                store: Optional[InteractionStore] = None) -> TargetFrame:
     """
     Get data for single TF
     :param query:
     :param edges:
     :param tf_filter_list:
     :param target_filter_list:
+    :param predicates: pushed down from a modifier
+    :param store: store with the TF, if the global store is not loaded
     :return:
     """
     anno = async_loader['annotations']
 
-    if (tf_filter_list is not None and tf_filter_list.str.contains(rf'^{re.escape(query)}$', flags=re.I).any()) \
-            or tf_filter_list is None:
-        analyses = Analysis.objects.filter(tf__gene_id__iexact=query)
+    if store is None:
+        store = get_store()
+
+    tf_id = None
 
-        if not analyses.exists():
-            raise ValueError(f'"{query}" is not in database')
+    if in_tf_filter(query, tf_filter_list):
+        if store is not None:
+            analyses = store.get_analyses(query)
+
+            if not analyses.size:
+                raise ValueError(f'"{query}" is not in database')
+
+            tf_id = store.get_tf_id(analyses[0])
+
+            if predicates:
+                analyses = filter_analyses(analyses, predicates)
+
+            df = TargetFrame(store.get_edges(analyses))
+
+            if predicates:
+                df = filter_edges(df, predicates)
+
+            expressions = store.expressions
+        else:
+            analyses = Analysis.objects.filter(tf__gene_id__iexact=query)
+
+            if not analyses.exists():
+                raise ValueError(f'"{query}" is not in database')
+
+            tf_id = analyses[0].tf_id
+
+            interactions = Interaction.objects.filter(analysis__in=analyses)
+            regulations = Regulation.objects.filter(analysis__in=analyses)
+
+            if predicates:
+                analysis_ids = filter_analyses(
+                    np.fromiter(analyses.values_list('pk', flat=True).iterator(), dtype=np.int64),
+                    predicates).tolist()
+                interactions = interactions.filter(analysis_id__in=analysis_ids)
+                regulations = regulations.filter(analysis_id__in=analysis_ids)
+
+                reg_q = get_regulation_q(predicates)
+
+                if reg_q:
+                    interactions = filter_regulated(interactions, reg_q)
+                    regulations = regulations.filter(reg_q)
+
+            df = TargetFrame(
+                interactions.values_list('target_id', 'analysis_id').iterator(),
+                columns=['id', 'ANALYSIS'])
+
+            if not df.empty:
+                reg = TargetFrame(
+                    regulations.values_list('analysis_id', 'target_id', 'p_value', 'foldchange').iterator(),
+                    columns=['ANALYSIS', 'id', PVALUE, LOG2FC])
+
+                if not reg.empty:
+                    df = df.merge(reg, on=['ANALYSIS', 'id'], how='left')
+
+            if predicates:
+                df = filter_edges(df.reindex(columns=['id', 'ANALYSIS', PVALUE, LOG2FC]), predicates)
+
+            expressions = Analysis.objects.filter(
+                pk__in=analyses,
+                analysisdata__key__name='EXPERIMENT_TYPE',
+                analysisdata__value__iexact='expression'
+            ).values_list('pk', flat=True)
 
-        df = TargetFrame(
-            Interaction.objects.filter(analysis__in=analyses).values_list(
-                'target_id', 'analysis_id').iterator(),
-            columns=['id', 'ANALYSIS'])
         df = df.merge(anno['id'].reset_index(), on=['id'])
         if target_filter_list is not None:
             df = df[df['TARGET'].str.upper().isin(target_filter_list.str.upper())]
-        df = df.reindex(columns=['TARGET', 'ANALYSIS', 'id'])
+        df = df.reindex(columns=['TARGET', 'ANALYSIS', 'id', PVALUE, LOG2FC])
     else:
-        analyses = []
-        df = TargetFrame(columns=['TARGET', 'ANALYSIS', 'id'])
+        df = TargetFrame(columns=['TARGET', 'ANALYSIS', 'id', PVALUE, LOG2FC])
 
     if not df.empty:
-        reg = TargetFrame(
-            Regulation.objects.filter(analysis__in=analyses).values_list(
-                'analysis_id', 'target_id', 'p_value', 'foldchange').iterator(),
-            columns=['ANALYSIS', 'id', PVALUE, LOG2FC])
-
         df.insert(2, 'EDGE', '+')
 
-        expressions = Analysis.objects.filter(
-            pk__in=analyses,
-            analysisdata__key__name='EXPERIMENT_TYPE',
-            analysisdata__value__iexact='expression'
-        ).values_list('pk', flat=True)
-
         df.loc[df['ANALYSIS'].isin(expressions), 'EDGE'] = '*'
-
-        if not reg.empty:
-            df = df.merge(reg, on=['ANALYSIS', 'id'], how='left')
-            df.loc[~(df[LOG2FC].isna() & df[PVALUE].isna()), 'EDGE'] = np.nan
+        df.loc[~(df[LOG2FC].isna() & df[PVALUE].isna()), 'EDGE'] = np.nan
 
         if edges:
             try:
@@ -493,9 +760,9 @@ def get_tf_data(query: str,
     else:
         df = TargetFrame(columns=[(np.nan, 'EDGE')])
 
-    try:
-        query = anno.index[np.argmax(anno['id'] == analyses[0].tf_id)].upper()
-    except IndexError:
+    if tf_id is not None:
+        query = anno.index[np.argmax(anno['id'] == tf_id)].upper()
+    else:
         query = query.upper()
 
     q = initialize_column_name(query)
@@ -517,20 +784,79 @@ def get_all_analyses(qs):
     return TargetFrame(qs.iterator(), columns=['ANALYSIS', 'TF'])
 
 
-def get_all_df(query: str,
-               tf_filter_list: Optional[pd.Series] = None,
-               target_filter_list: Optional[pd.Series] = None) -> TargetFrame:
-    qs = Interaction.objects.values_list('target_id', 'analysis_id')
+def get_multitype_analyses() -> pd.Series:
+    """
+    Get analyses of TFs with more than one EXPERIMENT_TYPE
+    :return:
+    """
+    a = pd.DataFrame(Analysis.objects.filter(
+        analysisdata__key__name__iexact="EXPERIMENT_TYPE"
+    ).values_list('id', 'tf_id', 'analysisdata__value', named=True).iterator())
+
+    a = a.groupby('tf_id').filter(lambda x: x['analysisdata__value'].nunique() > 1)
+
+    return a['id']
+
+
+def get_all_store_df(store: InteractionStore,
+                     query: str,
+                     tf_filter_list: Optional[pd.Series] = None,
+                     target_filter_list: Optional[pd.Series] = None,
+                     predicates: Optional[List[Predicate]] = None) -> TargetFrame:
+    anno = async_loader['annotations']
+
+    analyses = store.get_analyses(tf_filter_list) if tf_filter_list is not None else None
+
+    if predicates:
+        analyses = filter_analyses(store.analysis_ids if analyses is None else analyses, predicates)
+
+    df = TargetFrame(store.get_edges(analyses))
+
+    if predicates:
+        df = filter_edges(df, predicates)
+
+    df = df.merge(anno['id'].reset_index(), on='id')
+    df = df.reindex(columns=['TARGET', 'ANALYSIS', 'id', PVALUE, LOG2FC])
+
+    if query == "multitype":
+        df = df[df['ANALYSIS'].isin(get_multitype_analyses())]
+
+    if target_filter_list is not None:
+        df = df[df['TARGET'].str.upper().isin(target_filter_list.str.upper())]
+
+    df = df.merge(store.get_tfs(), on='ANALYSIS')
+
+    return df.reindex(columns=['TARGET', 'ANALYSIS', 'id', 'TF', PVALUE, LOG2FC])
+
+
+def get_all_db_df(query: str,
+                  tf_filter_list: Optional[pd.Series] = None,
+                  target_filter_list: Optional[pd.Series] = None,
+                  predicates: Optional[List[Predicate]] = None) -> TargetFrame:
+    qs = Interaction.objects.all()
+    reg_qs = Regulation.objects.all()
     anno = async_loader['annotations']
 
     if tf_filter_list is not None:
         qs = qs.filter(analysis__tf_id__in=anno.loc[anno.index.str.upper().isin(tf_filter_list.str.upper()), 'id'])
 
+    if predicates:
+        analysis_ids = filter_analyses(
+            np.fromiter(Analysis.objects.values_list('pk', flat=True).iterator(), dtype=np.int64),
+            predicates).tolist()
+        qs = qs.filter(analysis_id__in=analysis_ids)
+        reg_qs = reg_qs.filter(analysis_id__in=analysis_ids)
+
+        reg_q = get_regulation_q(predicates)
+
+        if reg_q:
+            qs = filter_regulated(qs, reg_q)
+            reg_qs = reg_qs.filter(reg_q)
+
     with ThreadPoolExecutor(max_workers=3) as executor:
-        interaction_task = executor.submit(get_all_interaction, qs)
+        interaction_task = executor.submit(get_all_interaction, qs.values_list('target_id', 'analysis_id'))
         regulation_task = executor.submit(get_all_regulation,
-                                          Regulation.objects.values_list('analysis_id', 'target_id', 'p_value',
-                                                                         'foldchange'))
+                                          reg_qs.values_list('analysis_id', 'target_id', 'p_value', 'foldchange'))
         analysis_task = executor.submit(get_all_analyses, Analysis.objects.values_list('id', 'tf__gene_id'))
 
         df = interaction_task.result()
@@ -539,13 +865,7 @@ def get_all_df(query: str,
         df = df.reindex(columns=['TARGET', 'ANALYSIS', 'id'])
 
         if query == "multitype":
-            a = pd.DataFrame(Analysis.objects.filter(
-                analysisdata__key__name__iexact="EXPERIMENT_TYPE"
-            ).values_list('id', 'tf_id', 'analysisdata__value', named=True).iterator())
-
-            a = a.groupby('tf_id').filter(lambda x: x['analysisdata__value'].nunique() > 1)
-
-            df = df[df['ANALYSIS'].isin(a['id'])]
+            df = df[df['ANALYSIS'].isin(get_multitype_analyses())]
 
         if target_filter_list is not None:
             df = df[df['TARGET'].str.upper().isin(target_filter_list.str.upper())]
@@ -557,9 +877,27 @@ def get_all_df(query: str,
 
     df = df.merge(reg, on=['ANALYSIS', 'id'], how='left')
 
+    if predicates:
+        df = filter_edges(df, predicates)
+
+    return df
+
+
+def get_all_df(query: str,
+               tf_filter_list: Optional[pd.Series] = None,
+               target_filter_list: Optional[pd.Series] = None,
+               predicates: Optional[List[Predicate]] = None) -> TargetFrame:
+    store = get_store()
+
+    if store is not None:
+        df = get_all_store_df(store, query, tf_filter_list, target_filter_list, predicates)
+    else:
+        df = get_all_db_df(query, tf_filter_list, target_filter_list, predicates)
+
     # additional restrictions here as well
     if query == 'andalltfs':
-        df = df[df.loc[:, (slice(None), slice(None), ['EDGE', 'Log2FC'])].notna().all(axis=1)]
+        counts = df.groupby('id')['ANALYSIS'].nunique()
+        df = df[df['id'].isin(counts.index[counts == df['ANALYSIS'].nunique()])]
 
     return df
 
@@ -571,21 +909,28 @@ def replace_filter_str(col: Tuple[str, str, str], filter_string: str) -> Tuple[s
 def get_all_tf(query: str,
                edges: Optional[List[str]] = None,
                tf_filter_list: Optional[pd.Series] = None,
-               target_filter_list: Optional[pd.Series] = None) -> TargetFrame:
+               target_filter_list: Optional[pd.Series] = None,
+               predicates: Optional[List[Predicate]] = None) -> TargetFrame:
     """
     Get data for all TFs at once
     :param query:
     :param edges:
     :param tf_filter_list:
     :param target_filter_list:
+    :param predicates: pushed down from a modifier
     :return:
     """
-    if tf_filter_list is None and target_filter_list is None:
+    if tf_filter_list is None and target_filter_list is None and not predicates:
         df = mem_cache.get_or_set(query, partial(get_all_df, query))
     else:
-        df = get_all_df(query, tf_filter_list, target_filter_list)
+        df = get_all_df(query, tf_filter_list, target_filter_list, predicates)
 
     if df.empty:
+        if predicates:  # nothing passed the modifier
+            df = TargetFrame(columns=pd.MultiIndex(levels=[[], [], []], codes=[[], [], []]))
+            df.filter_string += query
+            return df
+
         raise ValueError("No data in database.")
 
     if edges:
@@ -599,10 +944,15 @@ def get_all_tf(query: str,
     df.insert(3, 'EDGE', np.nan)
     df['EDGE'] = df['EDGE'].where(df[LOG2FC].notna() | df[PVALUE].notna(), '+')
 
-    expressions = Analysis.objects.filter(
-        analysisdata__key__name='EXPERIMENT_TYPE',
-        analysisdata__value__iexact='expression'
-    ).values_list('pk', flat=True)
+    store = get_store()
+
+    if store is not None:
+        expressions = store.expressions
+    else:
+        expressions = Analysis.objects.filter(
+            analysisdata__key__name='EXPERIMENT_TYPE',
+            analysisdata__value__iexact='expression'
+        ).values_list('pk', flat=True)
 
     df.loc[df[LOG2FC].isna() & df[PVALUE].isna() & (df['ANALYSIS'].isin(expressions)), 'EDGE'] = '*'
 
@@ -621,19 +971,280 @@ def get_all_tf(query: str,
     return df
 
 
+def apply_modifier(df: TargetFrame, modifier: pp.ParseResults) -> TargetFrame:
+    if not df.empty:
+        mod = get_mod(df, modifier)
+        df = df.where(mod).dropna(how='all').dropna(how='all', axis=1)  # filter out empty tfs
+
+    df.filter_string += f'[{mod_to_str(modifier[0])}]'
+
+    return df.rename(columns=partial(replace_filter_str, filter_string=df.filter_string), level=0)
+
+
+def get_leaf(query: str,
+             edges: Optional[List[str]] = None,
+             tf_filter_list: Optional[pd.Series] = None,
+             target_filter_list: Optional[pd.Series] = None,
+             predicates: Optional[List[Predicate]] = None,
+             store: Optional[InteractionStore] = None) -> TargetFrame:
+    if query.lower() in {'andalltfs', 'all_tfs', 'multitype'}:
+        return get_all_tf(query.lower(), edges, tf_filter_list, target_filter_list, predicates)
+
+    return get_tf_data(query, edges, tf_filter_list, target_filter_list, predicates, store)
+
+
+def get_modifier_operand(query: Union[pp.ParseResults, str, TargetFrame],
+                         modifier: pp.ParseResults,
+                         edges: Optional[List[str]] = None,
+                         tf_filter_list: Optional[pd.Series] = None,
+                         target_filter_list: Optional[pd.Series] = None,
+                         frames: Optional[Dict[int, TargetFrame]] = None,
+                         store: Optional[InteractionStore] = None) -> TargetFrame:
+    """
+    Evaluate the operand of a modifier, pushing the modifier down into the fetch if the operand is a single name
+    """
+    while isinstance(query, pp.ParseResults) and len(query) == 1:
+        query = query[0]
+
+    if isinstance(query, str):
+        # andalltfs keeps targets of every analysis, which filtering analyses and edges first would change
+        predicates = [] if query.lower() == 'andalltfs' else get_pushdown(modifier)
+
+        return get_leaf(query, edges, tf_filter_list, target_filter_list, predicates, store)
+
+    return get_tf(query, edges, tf_filter_list, target_filter_list, frames, store)
+
+
+def entry_size(entry: Tuple[TargetFrame, Dict[str, str]]) -> int:
+    return int(entry[0].memory_usage(deep=True).sum())
+
+
+subquery_cache = LRUCache(getattr(settings, 'QUERY_CACHE_SIZE', 512 * 1024 ** 2), size=entry_size)
+subquery_version: Optional[str] = None
+
+
+def get_cache_version() -> str:
+    """
+    Version of the edges, additional edges and metadata that query results are computed from
+    """
+    return '\0'.join([get_store_version(), get_table_version(EdgeData), '-'.join(map(str, get_metadata_version()))])
+
+
+def refresh_subquery_cache():
+    """
+    Key subquery results with the current data version, dropping results of older versions
+    """
+    global subquery_version
+
+    version = get_cache_version()
+
+    if version != subquery_version:
+        subquery_cache.clear()
+        subquery_version = version
+
+
+def describe_query(query: Union[pp.ParseResults, str], labels: Dict[str, str]) -> Tuple[str, str]:
+    """
+    Get canonical form and filter string of a query
+
+    The canonical form ignores case of names and the order of operands of "and" and "or". Filter strings
+    of the subqueries, as get_tf would name them, are collected in labels by canonical form.
+
+    :param query:
+    :param labels:
+    :return: canonical form, filter string
+    """
+    if isinstance(query, str):
+        canonical = query.lower()
+        label = canonical if canonical in {'andalltfs', 'all_tfs', 'multitype'} else query.upper()
+    elif isinstance(query, pp.ParseResults):
+        it = iter(query)
+        # canonical form, filter string, operator, operands
+        stack: Deque[Union[Tuple[str, str, Optional[str], List[str]], str, pp.ParseResults]] = deque()
+
+        def describe(item):
+            if isinstance(item, tuple):
+                return item
+            return (*describe_query(item, labels), None, [])
+
+        try:
+            while True:
+                curr = next(it)
+                if curr in ('and', 'or'):
+                    prec_canonical, prec_label, prec_oper, prec_operands = describe(stack.pop())
+                    succ_canonical, succ_label, succ_oper, succ_operands = describe(next(it))
+
+                    operands = prec_operands if prec_oper == curr else [prec_canonical]
+                    operands = operands + (succ_operands if succ_oper == curr else [succ_canonical])
+
+                    canonical = f'{curr}({",".join(sorted(operands))})'
+                    label = f'({prec_label} {curr} {succ_label})'
+                    labels[canonical] = label
+
+                    stack.append((canonical, label, curr, operands))
+                elif curr == 'not':
+                    succ_canonical, succ_label, *rest = describe(next(it))
+                    stack.append((f'not({succ_canonical})', 'not ' + succ_label, None, []))
+                elif is_modifier(curr):
+                    prec_canonical, prec_label, *rest = describe(stack.pop())
+                    mod = mod_to_str(curr[0])
+                    stack.append((f'{prec_canonical}[{mod.lower().replace("<>", "!=")}]',
+                                  f'{prec_label}[{mod}]', None, []))
+                elif is_column_filter(curr):
+                    prec_canonical, prec_label, *rest = describe(stack.pop())
+                    mods = sorted(f'{m["key"].lower()}{m["oper"].replace("<>", "!=")}{m["value"]}' for m in curr)
+                    stack.append((f'{prec_canonical}{{{",".join(mods)}}}', prec_label, None, []))
+                else:
+                    stack.append(curr)
+        except StopIteration:
+            canonical, label, *rest = describe(stack.pop())
+    else:
+        raise ValueError(query)
+
+    labels[canonical] = label
+
+    return canonical, label
+
+
+def list_digest(genes: Optional[pd.Series]) -> Optional[str]:
+    if genes is None:
+        return None
+
+    return hashlib.md5('\n'.join(sorted(set(genes.str.upper()))).encode()).hexdigest()
+
+
+def refresh_column(col: Tuple[str, str, str], uids: Dict[str, str], labels: Dict[str, str]) -> Tuple[str, str, str]:
+    return col[0], labels.get(col[1], col[1]), uids[col[2]]
+
+
+def get_cached(query: Union[pp.ParseResults, str],
+               func: Callable[[], TargetFrame],
+               edges: Optional[List[str]] = None,
+               tf_filter_list: Optional[pd.Series] = None,
+               target_filter_list: Optional[pd.Series] = None) -> TargetFrame:
+    """
+    Get result of query from subquery_cache, or compute it with func
+
+    Queries equivalent up to case and operand order share an entry. Columns get new uuids every time, and
+    filter strings are renamed to those of the query asked. Entries are keyed with the data version of the last
+    refresh_subquery_cache, so results computed while the data changes are not used afterwards.
+    """
+    labels: Dict[str, str] = {}
+    canonical, label = describe_query(query, labels)
+    key = (subquery_version, canonical, tuple(sorted(edges or [])), list_digest(tf_filter_list),
+           list_digest(target_filter_list))
+
+    cached = subquery_cache.get(key)
+
+    if cached is None:
+        df = func()
+        subquery_cache[key] = (df, labels)
+        relabel = {}
+    else:
+        df, cached_labels = cached
+        relabel = {cached_labels[k]: l for k, l in labels.items() if k in cached_labels and cached_labels[k] != l}
+
+    result = df.rename(columns=partial(refresh_column, uids=defaultdict(lambda: str(uuid4())), labels=relabel),
+                       level=0)
+    result.include = df.include
+    result.filter_string = label
+
+    return result
+
+
+def combine_frames(prec: TargetFrame, succ: TargetFrame, oper: str) -> TargetFrame:
+    """
+    Combine results of two subqueries with "and" or "or"
+    :param prec:
+    :param succ:
+    :param oper:
+    :return:
+    """
+    filter_string = prec.filter_string
+    if oper == 'and':
+        filter_string += ' and '
+
+        if prec.include and succ.include:
+            df = prec.merge(succ, how='inner', left_index=True, right_index=True)
+        elif not prec.include and succ.include:
+            df = succ.loc[~succ.index.isin(prec.index), :]
+        elif prec.include and not succ.include:
+            df = prec.loc[~prec.index.isin(succ.index), :]
+        else:  # not prec.include and not succ.include
+            df = prec.merge(succ, how='outer', left_index=True, right_index=True)
+            df.include = False
+    else:
+        filter_string += ' or '
+
+        # doesn't make much sense using not with or, but oh well
+        if prec.include and succ.include:
+            df = prec.merge(succ, how='outer', left_index=True, right_index=True)
+        elif not prec.include and succ.include:
+            df = succ
+        elif prec.include and not succ.include:
+            df = prec
+        else:
+            df = prec.merge(succ, how='inner', left_index=True, right_index=True)
+            df.include = False
+    filter_string = '(' + filter_string + succ.filter_string + ')'
+
+    try:
+        df = df.dropna(axis=1, how='all')
+    except IndexError:
+        # beware of the shape of indices and columns
+        df = TargetFrame(columns=pd.MultiIndex(levels=[[], [], []]))
+
+    df.filter_string = filter_string
+
+    if oper == 'and':
+        df = df.rename(columns=partial(replace_filter_str, filter_string=filter_string), level=0)
+
+    return df
+
+
 def get_tf(query: Union[pp.ParseResults, str, TargetFrame],
            edges: Optional[List[str]] = None,
            tf_filter_list: Optional[pd.Series] = None,
-           target_filter_list: Optional[pd.Series] = None) -> TargetFrame:
+           target_filter_list: Optional[pd.Series] = None,
+           frames: Optional[Dict[int, TargetFrame]] = None,
+           store: Optional[InteractionStore] = None) -> TargetFrame:
     """
     Query TF DataFrame according to query
+
+    Results are cached unless frames are given.
+
     :param query:
     :param edges:
     :param tf_filter_list:
     :param target_filter_list:
+    :param frames: already evaluated subqueries with modifiers or column filters, by id
+    :param store: store with the TFs of the query, if the global store is not loaded
     :return:
     """
+    if frames is not None:
+        if isinstance(query, pp.ParseResults) and id(query) in frames:
+            return frames[id(query)]
+    elif isinstance(query, (pp.ParseResults, str)):
+        return get_cached(query,
+                          partial(evaluate_tf, query, edges, tf_filter_list, target_filter_list, store=store),
+                          edges, tf_filter_list, target_filter_list)
+
+    return evaluate_tf(query, edges, tf_filter_list, target_filter_list, frames, store)
+
+
+def evaluate_tf(query: Union[pp.ParseResults, str, TargetFrame],
+                edges: Optional[List[str]] = None,
+                tf_filter_list: Optional[pd.Series] = None,
+                target_filter_list: Optional[pd.Series] = None,
+                frames: Optional[Dict[int, TargetFrame]] = None,
+                store: Optional[InteractionStore] = None) -> TargetFrame:
     if isinstance(query, pp.ParseResults):
+        evaluate = partial(get_tf,
+                           edges=edges,
+                           tf_filter_list=tf_filter_list,
+                           target_filter_list=target_filter_list,
+                           frames=frames,
+                           store=store)
         it = iter(query)
         stack: Deque[Union[pd.DataFrame, str, pp.ParseResults]] = deque()
 
@@ -641,84 +1252,243 @@ def get_tf(query: Union[pp.ParseResults, str, TargetFrame],
             while True:
                 curr = next(it)
                 if curr in ('and', 'or'):
-                    prec, succ = get_tf(stack.pop(), edges, tf_filter_list, target_filter_list), \
-                                 get_tf(next(it), edges, tf_filter_list, target_filter_list)
-
-                    filter_string = prec.filter_string
-                    if curr == 'and':
-                        filter_string += ' and '
-
-                        if prec.include and succ.include:
-                            df = prec.merge(succ, how='inner', left_index=True, right_index=True)
-                        elif not prec.include and succ.include:
-                            df = succ.loc[~succ.index.isin(prec.index), :]
-                        elif prec.include and not succ.include:
-                            df = prec.loc[~prec.index.isin(succ.index), :]
-                        else:  # not prec.include and not succ.include
-                            df = prec.merge(succ, how='outer', left_index=True, right_index=True)
-                            df.include = False
-                    else:
-                        filter_string += ' or '
-
-                        # doesn't make much sense using not with or, but oh well
-                        if prec.include and succ.include:
-                            df = prec.merge(succ, how='outer', left_index=True, right_index=True)
-                        elif not prec.include and succ.include:
-                            df = succ
-                        elif prec.include and not succ.include:
-                            df = prec
-                        else:
-                            df = prec.merge(succ, how='inner', left_index=True, right_index=True)
-                            df.include = False
-                    filter_string = '(' + filter_string + succ.filter_string + ')'
-
-                    try:
-                        df = df.dropna(axis=1, how='all')
-                    except IndexError:
-                        # beware of the shape of indices and columns
-                        df = TargetFrame(columns=pd.MultiIndex(levels=[[], [], []]))
-
-                    df.filter_string = filter_string
-
-                    if curr == 'and':
-                        df = df.rename(columns=partial(replace_filter_str, filter_string=filter_string), level=0)
-
-                    stack.append(df)
+                    stack.append(combine_frames(evaluate(stack.pop()), evaluate(next(it)), curr))
 
                 elif curr == 'not':
-                    succ = get_tf(next(it), edges, tf_filter_list, target_filter_list)
+                    succ = evaluate(next(it))
                     succ.include = not succ.include
                     succ.filter_string = 'not ' + succ.filter_string
                     stack.append(succ)
                 elif is_modifier(curr):
-                    prec = get_tf(stack.pop(), edges, tf_filter_list, target_filter_list)
-                    mod = get_mod(prec, curr)
-                    prec = prec[mod].dropna(how='all').dropna(how='all', axis=1)  # filter out empty tfs
+                    prec = get_modifier_operand(stack.pop(), curr, edges, tf_filter_list, target_filter_list, frames,
+                                                store)
+                    stack.append(apply_modifier(prec, curr))
+                elif is_column_filter(curr):
+                    prec = evaluate(stack.pop())
+                    stack.append(get_column_filter(prec, curr))
+                else:
+                    stack.append(curr)
+        except StopIteration:
+            return evaluate(stack.pop())
+    elif isinstance(query, (TargetFrame, TargetSeries)):
+        return query
+    elif isinstance(query, str):
+        return get_leaf(query, edges, tf_filter_list, target_filter_list, store=store)
+    else:
+        raise ValueError(query)
 
-                    prec.filter_string += f'[{mod_to_str(curr[0])}]'
-                    prec = prec.rename(columns=partial(replace_filter_str, filter_string=prec.filter_string), level=0)
 
-                    stack.append(prec)
-                elif is_column_filter(curr):
-                    prec = get_tf(stack.pop(), edges, tf_filter_list, target_filter_list)
-                    prec = get_column_filter(prec, curr)
+TargetMask = Tuple[np.ndarray, bool]
+
+
+def get_target_universe(store: InteractionStore, target_filter_list: Optional[pd.Series] = None) -> np.ndarray:
+    """
+    Mask of the targets in store that are annotated and pass the target filter
+    :param store:
+    :param target_filter_list:
+    :return:
+    """
+    anno = async_loader['annotations']
+
+    if target_filter_list is not None:
+        anno = anno[anno.index.str.upper().isin(target_filter_list.str.upper())]
+
+    return np.isin(store.target_ids, anno['id'].values)
+
 
-                    stack.append(prec)
+def get_frame_mask(store: InteractionStore, df: TargetFrame) -> np.ndarray:
+    anno = async_loader['annotations']
+
+    return np.isin(store.target_ids, anno.loc[anno.index.isin(df.index), 'id'].values)
+
+
+def combine_target_masks(oper: str, prec: TargetMask, succ: TargetMask) -> TargetMask:
+    """
+    Same set semantics as the DataFrame merges in get_tf
+    """
+    (prec_mask, prec_include), (succ_mask, succ_include) = prec, succ
+
+    if oper == 'and':
+        if prec_include and succ_include:
+            return prec_mask & succ_mask, True
+        elif not prec_include and succ_include:
+            return succ_mask & ~prec_mask, True
+        elif prec_include and not succ_include:
+            return prec_mask & ~succ_mask, True
+        return prec_mask | succ_mask, False
+
+    if prec_include and succ_include:
+        return prec_mask | succ_mask, True
+    elif not prec_include and succ_include:
+        return succ_mask, True
+    elif prec_include and not succ_include:
+        return prec_mask, True
+    return prec_mask & succ_mask, False
+
+
+def get_target_mask(query: Union[pp.ParseResults, str, TargetFrame, TargetMask],
+                    store: InteractionStore,
+                    universe: np.ndarray,
+                    frames: Dict[int, TargetFrame],
+                    edges: Optional[List[str]] = None,
+                    tf_filter_list: Optional[pd.Series] = None,
+                    target_filter_list: Optional[pd.Series] = None) -> TargetMask:
+    """
+    Evaluate the and/or/not structure of a query on boolean masks of targets
+
+    Modifiers and column filters depend on edge data, so subqueries with them are materialized as DataFrames.
+    The results are saved in frames to be reused by get_tf.
+
+    :param query:
+    :param store:
+    :param universe: mask of targets allowed by annotations and the target filter
+    :param frames:
+    :param edges:
+    :param tf_filter_list:
+    :param target_filter_list:
+    :return: target mask, include
+    """
+    if isinstance(query, pp.ParseResults):
+        if any(is_modifier(q) or is_column_filter(q) for q in query):
+            df = get_tf(query, edges, tf_filter_list, target_filter_list)
+            frames[id(query)] = df
+
+            return get_frame_mask(store, df), df.include
+
+        evaluate = partial(get_target_mask,
+                           store=store,
+                           universe=universe,
+                           frames=frames,
+                           edges=edges,
+                           tf_filter_list=tf_filter_list,
+                           target_filter_list=target_filter_list)
+        it = iter(query)
+        stack: Deque[Union[TargetMask, TargetFrame, str, pp.ParseResults]] = deque()
+
+        try:
+            while True:
+                curr = next(it)
+                if curr in ('and', 'or'):
+                    stack.append(combine_target_masks(curr, evaluate(stack.pop()), evaluate(next(it))))
+                elif curr == 'not':
+                    mask, include = evaluate(next(it))
+                    stack.append((mask, not include))
                 else:
                     stack.append(curr)
         except StopIteration:
-            return get_tf(stack.pop(), edges, tf_filter_list, target_filter_list)
-    elif isinstance(query, (TargetFrame, TargetSeries)):
+            return evaluate(stack.pop())
+    elif isinstance(query, tuple):
         return query
+    elif isinstance(query, (TargetFrame, TargetSeries)):
+        return get_frame_mask(store, query), query.include
     elif isinstance(query, str):
         if query.lower() in {'andalltfs', 'all_tfs', 'multitype'}:
-            return get_all_tf(query.lower(), edges, tf_filter_list, target_filter_list)
+            if tf_filter_list is not None:
+                analyses = store.get_analyses(tf_filter_list)
+            else:
+                analyses = store.analysis_ids
+
+            if query.lower() == 'multitype':
+                analyses = np.intersect1d(analyses, get_multitype_analyses().values.astype(np.int64))
+        elif in_tf_filter(query, tf_filter_list):
+            analyses = store.get_analyses(query)
 
-        return get_tf_data(query, edges, tf_filter_list, target_filter_list)
+            if not analyses.size:
+                raise ValueError(f'"{query}" is not in database')
+        else:
+            return np.zeros_like(universe), True
+
+        return store.get_target_mask(analyses, universe, every=query.lower() == 'andalltfs'), True
     else:
         raise ValueError(query)
 
 
+def restrict_frame(df: TargetFrame, targets: pd.Series) -> TargetFrame:
+    restricted = df.loc[df.index.isin(targets), :]
+    restricted.include = df.include
+    restricted.filter_string = df.filter_string
+
+    return restricted
+
+
+def get_names(query: Union[pp.ParseResults, str]) -> Set[str]:
+    """
+    Get TF names in a query, leaving out all_tfs and the like
+    """
+    if isinstance(query, str):
+        if query.lower() in {'and', 'or', 'not', 'andalltfs', 'all_tfs', 'multitype'}:
+            return set()
+        return {query.upper()}
+
+    return set(chain.from_iterable(get_names(q) for q in query if not (is_modifier(q) or is_column_filter(q))))
+
+
+def get_batch_store(query: Union[pp.ParseResults, str],
+                    tf_filter_list: Optional[pd.Series] = None) -> Optional[InteractionStore]:
+    """
+    Fetch all TFs of a query in one batch when the global store is not loaded
+    :param query:
+    :param tf_filter_list:
+    :return:
+    """
+    names = [n for n in get_names(query) if in_tf_filter(n, tf_filter_list)]
+
+    if len(names) < 2:
+        return None
+
+    return load_interaction_store(Analysis.objects.filter(reduce(or_, (Q(tf__gene_id__iexact=n) for n in names))))
+
+
+def evaluate_query(query: Union[pp.ParseResults, str],
+                   edges: Optional[List[str]] = None,
+                   tf_filter_list: Optional[pd.Series] = None,
+                   target_filter_list: Optional[pd.Series] = None) -> TargetFrame:
+    """
+    Evaluate query in two phases
+
+    The set algebra of the query is done on target masks first, then only the surviving targets are
+    materialized into DataFrames by get_tf.
+
+    :param query:
+    :param edges:
+    :param tf_filter_list:
+    :param target_filter_list:
+    :return:
+    """
+    store = get_store()
+
+    if store is None:
+        return get_tf(query, edges, tf_filter_list, target_filter_list,
+                      store=get_batch_store(query, tf_filter_list))
+
+    if not isinstance(query, pp.ParseResults):
+        return get_tf(query, edges, tf_filter_list, target_filter_list)
+
+    return get_cached(query,
+                      partial(evaluate_masks, store, query, edges, tf_filter_list, target_filter_list),
+                      edges, tf_filter_list, target_filter_list)
+
+
+def evaluate_masks(store: InteractionStore,
+                   query: pp.ParseResults,
+                   edges: Optional[List[str]] = None,
+                   tf_filter_list: Optional[pd.Series] = None,
+                   target_filter_list: Optional[pd.Series] = None) -> TargetFrame:
+    frames: Dict[int, TargetFrame] = {}
+    mask, include = get_target_mask(query, store, get_target_universe(store, target_filter_list), frames,
+                                    edges, tf_filter_list, target_filter_list)
+
+    if not include or not mask.any():
+        return TargetFrame(columns=pd.MultiIndex(levels=[[], [], []], codes=[[], [], []]), include=include)
+
+    anno = async_loader['annotations']
+    targets = pd.Series(anno.index[anno['id'].isin(store.target_ids[mask])])
+
+    frames = {k: restrict_frame(f, targets) for k, f in frames.items()}
+
+    return get_tf(query, edges, tf_filter_list, targets, frames)
+
+
 def reorder_data(df: TargetFrame) -> TargetFrame:
     """
     Order by TF with most edges, then analysis with most edges within tf
@@ -804,14 +1574,77 @@ class QueryFuncs(UserDict):
 QUERY_FUNCS = QueryFuncs()
 
 
+PLACEHOLDER = re.compile(r'\$filter_tf', flags=re.I)
+
+
+def bind_placeholder(query: Union[pp.ParseResults, str, Any], tf: str) -> Union[pp.ParseResults, str, Any]:
+    """
+    Replace $filter_tf in a parsed query with a TF
+
+    Quoted keys and values of modifiers and column filters are bound too, like the names. Subtrees without the
+    placeholder are shared with the template.
+    """
+    if isinstance(query, str):
+        return PLACEHOLDER.sub(tf, query)
+
+    if not isinstance(query, pp.ParseResults):  # numbers of modifiers
+        return query
+
+    bound = [bind_placeholder(q, tf) for q in query]
+
+    if all(b is q or b == q for b, q in zip(bound, query)):
+        return query
+
+    result = query.copy()
+    for i, b in enumerate(bound):
+        result[i] = b
+
+    for key in ('key', 'value'):  # modifiers look up their parts by name
+        if key in query:
+            result[key] = bind_placeholder(query[key], tf)
+
+    return result
+
+
+def evaluate_in_thread(query: Union[pp.ParseResults, str],
+                       edges: Optional[List[str]] = None,
+                       tf_filter_list: Optional[pd.Series] = None,
+                       target_filter_list: Optional[pd.Series] = None) -> TargetFrame:
+    """
+    evaluate_query for worker threads, closing the database connections the thread opened
+    """
+    try:
+        return evaluate_query(query, edges, tf_filter_list, target_filter_list)
+    finally:
+        connections.close_all()
+
+
 @QUERY_FUNCS.register
-def expand(query: str, oper: str, *args, tf_filter_list: Optional[pd.Series] = None, **kwargs):
+def expand(query: str, oper: str, *args,
+           edges: Optional[List[str]] = None,
+           tf_filter_list: Optional[pd.Series] = None,
+           target_filter_list: Optional[pd.Series] = None):
     if tf_filter_list is None or tf_filter_list.empty:
         raise QueryError('Filter TF list required')
 
-    result = f" {oper} ".join(re.sub(r'\$filter_tf', t, f"({query})", flags=re.I) for t in tf_filter_list)
+    oper = oper.strip().lower()
+    if oper not in ('and', 'or'):
+        raise QueryError(f'Invalid operator: {oper}')
 
-    return parse_query(result, tf_filter_list=tf_filter_list, **kwargs)
+    template = expr.parseString(query, parseAll=True)
+    if template.getName() == 'function':
+        raise QueryError('Cannot expand a function')
+
+    template = template.get('query')
+
+    with ThreadPoolExecutor(max_workers=getattr(settings, 'QUERY_EXPAND_WORKERS', 4)) as executor:
+        results = executor.map(partial(evaluate_in_thread,
+                                       edges=edges,
+                                       tf_filter_list=tf_filter_list,
+                                       target_filter_list=target_filter_list),
+                               (bind_placeholder(template, t) for t in tf_filter_list))
+
+        return reduce(partial(combine_frames, oper=oper), results)
 
 
 def parse_query(query: str,
@@ -821,14 +1654,16 @@ def parse_query(query: str,
     try:
         parse = expr.parseString(query, parseAll=True)
 
+        refresh_subquery_cache()
+
         if parse.getName() == 'function':
             fname, *args = parse
-            return QUERY_FUNCS[fname](*args,
-                                      edges=edges,
-                                      tf_filter_list=tf_filter_list,
-                                      target_filter_list=target_filter_list)
-
-        result = get_tf(parse.get('query'), edges, tf_filter_list, target_filter_list)
+            result = QUERY_FUNCS[fname](*args,
+                                        edges=edges,
+                                        tf_filter_list=tf_filter_list,
+                                        target_filter_list=target_filter_list)
+        else:
+            result = evaluate_query(parse.get('query'), edges, tf_filter_list, target_filter_list)
 
         if result.empty or not result.include:
             raise QueryError('empty query')
@@ -842,6 +1677,44 @@ def parse_query(query: str,
         raise QueryError("Could not parse query") from e
 
 
+def get_query_digest(query: str,
+                     edges: Optional[List[str]] = None,
+                     tf_filter_list: Optional[pd.Series] = None,
+                     target_filter_list: Optional[pd.Series] = None,
+                     version: Optional[str] = None) -> str:
+    """
+    Hash of the query and everything else its result depends on, including the version of the data
+
+    Queries that differ only in case or spacing hash the same.
+
+    :param query:
+    :param edges:
+    :param tf_filter_list:
+    :param target_filter_list:
+    :param version: version of the data the result is computed from, see get_cache_version
+    :return:
+    """
+    try:
+        parse = expr.parseString(query, parseAll=True)
+    except pp.ParseException as e:
+        raise QueryError("Could not parse query") from e
+
+    if parse.getName() == 'function':
+        normalized = ' '.join(query.split())
+    else:
+        normalized = '\n'.join(describe_query(parse.get('query'), {}))
+
+    parts = [
+        normalized,
+        ','.join(sorted(edges or [])),
+        list_digest(tf_filter_list) or '',
+        list_digest(target_filter_list) or '',
+        version or get_cache_version()
+    ]
+
+    return hashlib.sha1('\0'.join(parts).encode()).hexdigest()
+
+
 def get_total(df: pd.DataFrame) -> pd.DataFrame:
     return df.pipe(clear_data).groupby(level=[0, 1], axis=1).count().sum()
 
@@ -896,25 +1769,32 @@ def get_query_result(query: Optional[str] = None,
         uid = uuid4()
 
     if query is not None:  # Check if cached
-        result = parse_query(query, edges, tf_filter_list, target_filter_list)
+        version = get_cache_version()
+        digest = get_query_digest(query, edges, tf_filter_list, target_filter_list, version)
+
+        if link_result(uid, 'tabular_output_unfiltered', digest):
+            result = load_result(uid, 'tabular_output_unfiltered')
+        else:
+            result = parse_query(query, edges, tf_filter_list, target_filter_list)
+
+            if get_cache_version() != version:  # data changed while querying, don't share under the old version
+                digest = None
+
+            save_result(uid, 'tabular_output_unfiltered', result, digest)
+
         metadata = get_metadata(result.columns.get_level_values(1))
         ids = get_result_ids(result)
 
         cache.set_many({
-            f'{uid}/tabular_output_unfiltered': result,
             f'{uid}/metadata': metadata,
             f'{uid}/analysis_ids': ids
         })
     else:
-        data = cache.get_many([
-            f'{uid}/tabular_output_unfiltered',
-            f'{uid}/analysis_ids'
-        ])
+        result = load_result(uid, 'tabular_output_unfiltered')
+        ids = cache.get(f'{uid}/analysis_ids')
 
-        result, ids = itemgetter(
-            f'{uid}/tabular_output_unfiltered',
-            f'{uid}/analysis_ids'
-        )(data)
+        if ids is None:
+            raise KeyError(f'{uid}/analysis_ids')
 
         result = filter_df_by_ids(result, ids)
         metadata = get_metadata(result.columns.get_level_values(1))
@@ -942,7 +1822,7 @@ def get_query_result(query: Optional[str] = None,
 
     stats['induce_repress_count'] = result.pipe(induce_repress_count)
 
-    cache.set_many({f'{uid}/tabular_output': result})
+    save_result(uid, 'tabular_output', result)
 
     logger.info(f"Unfiltered Dataframe size: {result.size}")
 
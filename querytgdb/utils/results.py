@@ -0,0 +1,200 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+from typing import Any, Dict, Iterable, Optional, Union
+from uuid import UUID, uuid4
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.core.cache import cache
+
+from querytgdb.utils.snapshot import from_array, to_array
+
+logger = logging.getLogger(__name__)
+
+RESULT_DIR = getattr(settings, 'RESULT_DIR', os.path.join(tempfile.gettempdir(), 'connectf_results'))
+
+# seconds between sweeps of result directories that outlived their manifests
+PRUNE_INTERVAL = 600
+
+last_pruned = 0.0
+
+
+def save_result(uid: Union[str, UUID], name: str, df: pd.DataFrame, digest: Optional[str] = None):
+    """
+    Save a query result as one memory-mappable array per column
+
+    The manifest with the column labels and array files is cached under f'{uid}/{name}', so the result expires
+    along with the rest of the cached data of the query. Every save writes a new directory and removes the
+    directory of the manifest it replaces, unless that is shared with other queries. Arrays that are already
+    memory-mapped stay readable after their files are removed.
+
+    :param uid:
+    :param name:
+    :param df:
+    :param digest: also share the result with other queries under this digest, see link_result
+    :return:
+    """
+    directory = os.path.join(RESULT_DIR, digest or str(uid), f'{name}-{uuid4().hex}')
+    os.makedirs(directory)
+
+    na = {}
+
+    for i, (col, s) in enumerate(df.items()):
+        arr = to_array(s)
+        np.save(os.path.join(directory, f'{i}.npy'), arr, allow_pickle=False)
+
+        # strings, including annotation Categoricals
+        if arr.dtype.kind == 'U' and s.isna().any():
+            na[i] = s.isna().values
+
+    for i, mask in na.items():
+        np.save(os.path.join(directory, f'na_{i}.npy'), mask, allow_pickle=False)
+
+    np.save(os.path.join(directory, 'index.npy'), to_array(df.index), allow_pickle=False)
+
+    manifest = {
+        'directory': directory,
+        'columns': df.columns,
+        'index_name': df.index.name,
+        'na': set(na)
+    }
+
+    previous = cache.get(f'{uid}/{name}')
+
+    cache.set(f'{uid}/{name}', manifest)
+
+    if digest is not None:
+        cache.set(f'shared/{digest}/{name}', manifest)
+
+    if previous is not None and os.path.dirname(previous['directory']) == os.path.join(RESULT_DIR, str(uid)):
+        shutil.rmtree(previous['directory'], ignore_errors=True)
+
+    prune_results()
+
+
+def link_result(uid: Union[str, UUID], name: str, digest: str) -> bool:
+    """
+    Point a query at a result shared under digest, without copying it
+
+    Every link renews the lease of the shared files, so they outlive the manifests of all queries pointing at them.
+
+    :param uid:
+    :param name:
+    :param digest:
+    :return: False if no result is shared under digest
+    """
+    manifest = cache.get(f'shared/{digest}/{name}')
+
+    if manifest is None:
+        return False
+
+    try:
+        os.utime(os.path.dirname(manifest['directory']))
+    except FileNotFoundError:
+        return False
+
+    cache.set_many({
+        f'shared/{digest}/{name}': manifest,
+        f'{uid}/{name}': manifest
+    })
+
+    return True
+
+
+def get_manifest(uid: Union[str, UUID], name: str) -> Dict[str, Any]:
+    manifest = cache.get(f'{uid}/{name}')
+
+    if manifest is None:
+        raise KeyError(f'{uid}/{name}')
+
+    return manifest
+
+
+def get_result_columns(uid: Union[str, UUID], name: str) -> pd.Index:
+    """
+    Get the column labels of a saved query result without loading it
+
+    :raises KeyError: if the result is not available
+    """
+    return get_manifest(uid, name)['columns']
+
+
+def load_result(uid: Union[str, UUID],
+                name: str,
+                fields: Optional[Iterable[str]] = None,
+                analyses: Optional[Iterable[int]] = None) -> pd.DataFrame:
+    """
+    Load a query result saved with save_result, reading only the selected columns
+
+    :param uid:
+    :param name:
+    :param fields: fields to load (EDGE, Log2FC, Pvalue...), all if None
+    :param analyses: analysis ids to load, all if None
+    :return:
+    :raises KeyError: if the result is not available
+    """
+    manifest = get_manifest(uid, name)
+
+    columns = manifest['columns']
+    selected = np.ones(len(columns), dtype=np.bool_)
+
+    if fields is not None:
+        selected &= columns.get_level_values(2).isin(list(fields))
+
+    if analyses is not None:
+        selected &= columns.get_level_values(1).isin(list(analyses))
+
+    directory = manifest['directory']
+
+    def read(filename: str) -> np.ndarray:
+        return np.load(os.path.join(directory, filename), mmap_mode='c', allow_pickle=False)
+
+    try:
+        index = pd.Index(from_array(read('index.npy')), name=manifest['index_name'])
+
+        data = {}
+        for i in np.flatnonzero(selected):
+            data[i] = from_array(read(f'{i}.npy'), read(f'na_{i}.npy') if i in manifest['na'] else None)
+    except FileNotFoundError as e:
+        raise KeyError(f'{uid}/{name}') from e
+
+    df = pd.DataFrame(data, index=index, columns=np.flatnonzero(selected))
+    df.columns = columns[selected]
+
+    return df
+
+
+def prune_results(max_age: Optional[float] = None):
+    """
+    Remove result directories of queries older than max_age seconds
+
+    Runs at most once every PRUNE_INTERVAL seconds per process.
+
+    :param max_age: the default cache timeout if None
+    :return:
+    """
+    global last_pruned
+
+    if time.monotonic() - last_pruned < PRUNE_INTERVAL:
+        return
+
+    last_pruned = time.monotonic()
+
+    if max_age is None:
+        max_age = cache.default_timeout
+
+    if max_age is None:
+        return
+
+    try:
+        now = time.time()
+
+        for d in os.scandir(RESULT_DIR):
+            if d.is_dir() and now - d.stat().st_mtime > max_age:
+                shutil.rmtree(d.path, ignore_errors=True)
+    except OSError:
+        logger.warning("Could not prune query results.", exc_info=True)
@@ -0,0 +1,279 @@
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+from functools import partial
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, Max, Model
+
+from querytgdb.models import Analysis, AnalysisData, Interaction, Regulation
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_DIR = getattr(settings, 'SNAPSHOT_DIR', os.path.join(tempfile.gettempdir(), 'connectf_snapshots'))
+
+
+def get_snapshot_dir() -> str:
+    """
+    Snapshot directory of the current database, so test databases don't share snapshots with the server
+    """
+    name = os.path.basename(str(connection.settings_dict['NAME'])) or 'default'
+
+    return os.path.join(SNAPSHOT_DIR, re.sub(r'[^\w.-]', '_', name))
+
+
+def get_data_version() -> str:
+    """
+    Change counter for the edge tables
+
+    Imports add rows with higher ids and removals lower the analysis count. Expression analyses are hashed,
+    since their EXPERIMENT_TYPE can be edited in place.
+    """
+    analyses = Analysis.objects.aggregate(count=Count('id'), last=Max('id'))
+    interactions = Interaction.objects.aggregate(last=Max('id'))
+    regulations = Regulation.objects.aggregate(last=Max('id'))
+
+    expressions = AnalysisData.objects.filter(
+        key__name='EXPERIMENT_TYPE',
+        value__iexact='expression'
+    ).order_by('analysis_id').values_list('analysis_id', flat=True)
+    expression_hash = hashlib.md5(','.join(map(str, expressions.iterator())).encode()).hexdigest()[:8]
+
+    return f"{analyses['count']}-{analyses['last']}-{interactions['last']}-{regulations['last']}-{expression_hash}"
+
+
+def get_table_version(model: Model) -> str:
+    rows = model.objects.aggregate(count=Count('id'), last=Max('id'))
+
+    return f"{rows['count']}-{rows['last']}"
+
+
+def get_file_version(path: str, chunk_size: int = 1024 ** 2) -> str:
+    """
+    Hash of the contents of a file, so copies of it keep the same version wherever they are and whatever their mtime
+    """
+    digest = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(partial(f.read, chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def read_snapshot(name: str, version: str, root: Optional[str] = None) -> Optional[Dict[str, np.ndarray]]:
+    """
+    Memory-map the arrays of a snapshot copy-on-write, so processes share the pages of the same files
+
+    :param name:
+    :param version:
+    :param root: directory of the snapshots, get_snapshot_dir() if None
+    :return: None if there is no snapshot of version
+    """
+    directory = os.path.join(root or get_snapshot_dir(), name, version)
+
+    if not os.path.isdir(directory):
+        return None
+
+    return {os.path.splitext(f)[0]: np.load(os.path.join(directory, f), mmap_mode='c', allow_pickle=False)
+            for f in os.listdir(directory) if f.endswith('.npy')}
+
+
+def write_snapshot(name: str, version: str, arrays: Dict[str, np.ndarray], root: Optional[str] = None):
+    """
+    Save arrays as a new version of a snapshot, and remove older versions
+
+    Arrays are written to a temporary directory that is renamed into place, so readers never see a
+    partial snapshot.
+
+    :param name:
+    :param version:
+    :param arrays:
+    :param root: directory of the snapshots, get_snapshot_dir() if None
+    """
+    parent = os.path.join(root or get_snapshot_dir(), name)
+    directory = os.path.join(parent, version)
+
+    os.makedirs(parent, exist_ok=True)
+
+    if os.path.isdir(directory):
+        return
+
+    tmp = tempfile.mkdtemp(prefix='.', dir=parent)
+
+    try:
+        for key, arr in arrays.items():
+            np.save(os.path.join(tmp, f'{key}.npy'), arr, allow_pickle=False)
+
+        os.rename(tmp, directory)
+    except OSError:
+        # another process could have written the same version first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+        if not os.path.isdir(directory):
+            raise
+
+    for old in os.listdir(parent):
+        if old != version and not old.startswith('.'):
+            shutil.rmtree(os.path.join(parent, old), ignore_errors=True)
+
+
+def clear_snapshots(name: Optional[str] = None):
+    """
+    Remove snapshots, all of them if name is None
+    """
+    root = get_snapshot_dir()
+
+    shutil.rmtree(os.path.join(root, name) if name else root, ignore_errors=True)
+
+
+def to_array(values) -> np.ndarray:
+    """
+    Convert values to an array that can be saved without pickling
+
+    Objects are saved as fixed width unicode strings.
+    """
+    arr = np.asarray(values)
+
+    if arr.dtype == object:
+        return pd.Series(arr).fillna('').astype(str).to_numpy(dtype=str)
+
+    return arr
+
+
+def from_array(arr: np.ndarray, na: Optional[np.ndarray] = None) -> np.ndarray:
+    if arr.dtype.kind == 'U':
+        arr = arr.astype(object)
+
+        if na is not None:
+            arr[na] = None
+
+    return arr
+
+
+def encode_strings(values) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Encode strings as their UTF-8 bytes one after the other, without padding them to the longest string
+
+    :param values:
+    :return: bytes and the offsets of the strings in them
+    """
+    encoded = [str(v).encode() for v in values]
+
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def decode_strings(data: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    buffer = data.tobytes()
+
+    strings = np.empty(len(offsets) - 1, dtype=object)
+    strings[:] = [buffer[start:end].decode() for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+    return strings
+
+
+def write_frame(name: str, version: str, df: pd.DataFrame, root: Optional[str] = None):
+    """
+    Save a DataFrame as a snapshot
+
+    Numeric data of a homogeneous frame is saved as one 2D array, and index levels as codes, so reading it back
+    does not copy them. Other columns that are not numeric are saved as integer codes and a dictionary of their
+    distinct strings, and read back as Categoricals over the mapped codes. Only the dictionaries are copied into
+    each process.
+    """
+    arrays = {
+        'columns': to_array(df.columns),
+        'index_names': np.array([n or '' for n in df.index.names], dtype=str)
+    }
+
+    if isinstance(df.index, pd.MultiIndex):
+        for i, (level, codes) in enumerate(zip(df.index.levels, df.index.codes)):
+            arrays[f'level_{i}'] = to_array(level)
+            arrays[f'codes_{i}'] = np.asarray(codes)
+    else:
+        arrays['index'] = to_array(df.index)
+
+    dtypes = df.dtypes.unique()
+
+    if len(dtypes) == 1 and np.issubdtype(dtypes[0], np.number):
+        arrays['values'] = df.values
+    else:
+        for i, (col, s) in enumerate(df.items()):
+            if s.dtype.kind in 'biufcmM':
+                arrays[f'column_{i}'] = to_array(s)
+            else:
+                # missing values have code -1
+                categorical = pd.Categorical(s)
+
+                arrays[f'column_codes_{i}'] = categorical.codes
+                arrays[f'column_strings_{i}'], arrays[f'column_offsets_{i}'] = encode_strings(
+                    categorical.categories)
+
+    write_snapshot(name, version, arrays, root)
+
+
+def read_frame(name: str, version: str, root: Optional[str] = None) -> Optional[pd.DataFrame]:
+    arrays = read_snapshot(name, version, root)
+
+    if arrays is None:
+        return None
+
+    names = [n or None for n in arrays['index_names']]
+
+    if 'index' in arrays:
+        index = pd.Index(from_array(arrays['index']), name=names[0])
+    else:
+        index = pd.MultiIndex(levels=[from_array(arrays[f'level_{i}']) for i in range(len(names))],
+                              codes=[arrays[f'codes_{i}'] for i in range(len(names))],
+                              names=names,
+                              verify_integrity=False)
+
+    columns = pd.Index(from_array(arrays['columns']))
+
+    if 'values' in arrays:
+        return pd.DataFrame(arrays['values'], index=index, columns=columns, copy=False)
+
+    data = {}
+
+    for i, col in enumerate(columns):
+        if f'column_codes_{i}' in arrays:
+            categories = pd.Index(decode_strings(arrays[f'column_strings_{i}'], arrays[f'column_offsets_{i}']),
+                                  dtype=object)
+            data[col] = pd.Categorical.from_codes(arrays[f'column_codes_{i}'], categories=categories)
+        else:
+            # an ndarray view of the memmap, not a copy
+            data[col] = np.asarray(from_array(arrays[f'column_{i}'], arrays.get(f'na_{i}')))
+
+    return pd.DataFrame(data, index=index, columns=columns, copy=False)
+
+
+def get_frame(name: str, version: str, load: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+    """
+    Read DataFrame from the snapshot of version, or load and save it if there is none
+    """
+    try:
+        df = read_frame(name, version)
+    except (OSError, ValueError):
+        # removed or replaced while reading
+        logger.warning("Could not read %s snapshot.", name, exc_info=True)
+        df = None
+
+    if df is None:
+        df = load()
+
+        try:
+            write_frame(name, version, df)
+        except OSError:
+            logger.warning("Could not save %s snapshot.", name, exc_info=True)
+
+    return df
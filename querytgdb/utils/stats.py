@@ -0,0 +1,212 @@
+from itertools import chain
+from typing import Hashable, Iterable, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sparse
+from scipy.special import gammaln
+
+
+def indicator_matrix(sets: Sequence[Iterable[Hashable]], vocabulary: pd.Index) -> sparse.csr_matrix:
+    """
+    Encode sets as a sparse boolean matrix with a row per set and a column per item of vocabulary
+
+    Items missing from vocabulary are left out.
+    """
+    sets = [list(s) for s in sets]
+
+    # one lookup of the items of all sets
+    indices = vocabulary.get_indexer(pd.Index(list(chain.from_iterable(sets)), dtype=object))
+    rows = np.repeat(np.arange(len(sets)), [len(s) for s in sets])
+    found = indices >= 0
+
+    indptr = np.zeros(len(sets) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows[found], minlength=len(sets)), out=indptr[1:])
+
+    return sparse.csr_matrix((np.ones(indptr[-1], dtype=np.int32), indices[found], indptr),
+                             shape=(len(sets), len(vocabulary)))
+
+
+def intersection_counts(rows: Sequence[Iterable[Hashable]],
+                        cols: Sequence[Iterable[Hashable]],
+                        vocabulary: Optional[pd.Index] = None) -> np.ndarray:
+    """
+    Count the items shared by every pair of sets with one sparse matrix product
+
+    :param rows:
+    :param cols:
+    :param vocabulary: all items of the sets, computed if None
+    :return: len(rows) × len(cols) array of intersection sizes
+    """
+    rows = [set(r) for r in rows]
+    cols = [set(c) for c in cols]
+
+    if vocabulary is None:
+        vocabulary = pd.Index(set().union(*rows, *cols))
+
+    return (indicator_matrix(rows, vocabulary) @ indicator_matrix(cols, vocabulary).T).toarray()
+
+
+def pairwise_intersections(incidence: sparse.spmatrix) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Items shared by every pair of sets, from a boolean item × set matrix
+
+    Pairs are in np.triu_indices(n_sets, 1) order.
+
+    :param incidence:
+    :return: items of all pairs concatenated, sorted within each pair, and the number of items of each pair
+    """
+    rows = sparse.csr_matrix(incidence, dtype=np.bool_)
+    rows.sort_indices()
+
+    n = rows.shape[1]
+    sizes = np.diff(rows.indptr)
+
+    pairs = [np.empty(0, dtype=np.int64)]
+    items = [np.empty(0, dtype=np.int64)]
+
+    # items in the same number of sets make their pairs in one step
+    for size in np.unique(sizes[sizes > 1]):
+        item = np.flatnonzero(sizes == size)
+        sets = rows.indices[rows.indptr[item][:, np.newaxis] + np.arange(size)].astype(np.int64)
+
+        left, right = np.triu_indices(size, 1)
+        i, j = sets[:, left], sets[:, right]
+
+        pairs.append((i * n - i * (i + 1) // 2 + j - i - 1).ravel())
+        items.append(np.repeat(item, left.size))
+
+    pairs = np.concatenate(pairs)
+    items = np.concatenate(items)
+
+    return items[np.lexsort((items, pairs))], np.bincount(pairs, minlength=n * (n - 1) // 2)
+
+
+def log_binom(n, k) -> np.ndarray:
+    return gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+
+
+def hypergeom_tail(k, total, good, draws, upper: bool) -> np.ndarray:
+    """
+    Hypergeometric probability of k or more good items (upper), or of k or fewer, for arrays of distributions
+
+    The pmf at k comes from log binomial coefficients, and the following terms from the ratio of consecutive
+    terms, one step for all distributions at a time. Only call it for the tail away from the mode, where the terms
+    shrink with each step, so the sum stops after a few standard deviations.
+
+    :param k:
+    :param total: number of items
+    :param good: number of good items
+    :param draws: number of items drawn
+    :param upper:
+    :return:
+    """
+    k, total, good, draws = (np.array(x, dtype=np.float64).ravel() for x in
+                             np.broadcast_arrays(k, total, good, draws))
+    bad = total - good
+
+    lo = np.maximum(0, draws - bad)
+    hi = np.minimum(good, draws)
+
+    if upper:
+        k = np.maximum(k, lo)
+        valid = k <= hi
+    else:
+        k = np.minimum(k, hi)
+        valid = k >= lo
+
+    k[~valid] = lo[~valid]
+    log_pmf = log_binom(good, k) + log_binom(bad, draws - k) - log_binom(total, draws)
+
+    # sums of the terms relative to the pmf at k
+    term = np.ones_like(k)
+    tail = np.ones_like(k)
+    active = np.flatnonzero(valid & (k != (hi if upper else lo)))
+
+    while active.size:
+        x = k[active]
+
+        if upper:
+            ratio = (good[active] - x) * (draws[active] - x) / ((x + 1) * (bad[active] - draws[active] + x + 1))
+            k[active] = x + 1
+        else:
+            ratio = x * (bad[active] - draws[active] + x) / ((good[active] - x + 1) * (draws[active] - x + 1))
+            k[active] = x - 1
+
+        term[active] *= ratio
+        tail[active] += term[active]
+
+        active = active[(k[active] != (hi if upper else lo)[active]) &
+                        (term[active] > np.finfo(np.float64).eps * tail[active])]
+
+    return np.where(valid, np.exp(log_pmf + np.log(tail)), 0.)
+
+
+def hypergeom_sf(k, total, good, draws) -> np.ndarray:
+    """
+    Vectorized scipy.stats.hypergeom.sf, the probability of more than k good items
+
+    Sums the tail on the side of k away from the mode, the other tail is the complement.
+    """
+    k, total, good, draws = np.broadcast_arrays(*map(np.asarray, (k, total, good, draws)))
+    mode = np.floor((draws + 1) * (good + 1) / (total + 2))
+
+    above = (k + 1 > mode).ravel()
+    p = np.empty(above.shape, dtype=np.float64)
+
+    p[above] = hypergeom_tail(k.ravel()[above] + 1, total.ravel()[above], good.ravel()[above],
+                              draws.ravel()[above], upper=True)
+    p[~above] = 1 - hypergeom_tail(k.ravel()[~above], total.ravel()[~above], good.ravel()[~above],
+                                   draws.ravel()[~above], upper=False)
+
+    return np.clip(p, 0, 1).reshape(k.shape)
+
+
+def hypergeom_cdf(k, total, good, draws) -> np.ndarray:
+    """
+    Vectorized scipy.stats.hypergeom.cdf, the probability of k or fewer good items
+    """
+    k, total, good, draws = np.broadcast_arrays(*map(np.asarray, (k, total, good, draws)))
+    mode = np.floor((draws + 1) * (good + 1) / (total + 2))
+
+    below = (k < mode).ravel()
+    p = np.empty(below.shape, dtype=np.float64)
+
+    p[below] = hypergeom_tail(k.ravel()[below], total.ravel()[below], good.ravel()[below],
+                              draws.ravel()[below], upper=False)
+    p[~below] = 1 - hypergeom_tail(k.ravel()[~below] + 1, total.ravel()[~below], good.ravel()[~below],
+                                   draws.ravel()[~below], upper=True)
+
+    return np.clip(p, 0, 1).reshape(k.shape)
+
+
+def fisher_exact_greater(a, b, c, d) -> np.ndarray:
+    """
+    One-sided Fisher's exact test of [[a, b], [c, d]] tables, alternative='greater', for arrays of tables
+
+    Same p-values as scipy.stats.fisher_exact, from the vectorized hypergeometric survival function.
+
+    :param a:
+    :param b:
+    :param c:
+    :param d:
+    :return:
+    """
+    a, b, c, d = np.broadcast_arrays(*map(np.asarray, (a, b, c, d)))
+
+    return hypergeom_sf(a - 1, a + b + c + d, a + b, a + c)
+
+
+def fisher_exact_less(a, b, c, d) -> np.ndarray:
+    """
+    One-sided Fisher's exact test of [[a, b], [c, d]] tables, alternative='less', for arrays of tables
+
+    :param a:
+    :param b:
+    :param c:
+    :param d:
+    :return:
+    """
+    a, b, c, d = np.broadcast_arrays(*map(np.asarray, (a, b, c, d)))
+
+    return hypergeom_cdf(a, a + b + c + d, a + b, a + c)
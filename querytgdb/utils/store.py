@@ -0,0 +1,348 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, Iterable, Optional, Union
+
+import numpy as np
+import pandas as pd
+from django.db import DatabaseError
+from django.db.models import QuerySet
+from scipy import sparse
+
+from querytgdb.models import Analysis, AnalysisData, Interaction, Regulation
+from querytgdb.utils import async_loader, skip_for_management
+from querytgdb.utils.snapshot import get_data_version, read_snapshot, write_snapshot
+
+logger = logging.getLogger(__name__)
+
+# seconds between checks of the database for a newer version of the edge tables
+CHECK_INTERVAL = 10
+
+
+class InteractionStore:
+    """
+    Columnar in-memory copy of the Interaction and Regulation tables
+
+    Edges are held in a CSR analysis × target matrix. P-values and fold changes are aligned with the
+    data array of the matrix, so slicing out the rows of an analysis gives all of its edges at once.
+    """
+
+    def __init__(self,
+                 analysis_ids: np.ndarray,
+                 tf_ids: np.ndarray,
+                 tf_names: np.ndarray,
+                 expression: np.ndarray,
+                 target_ids: np.ndarray,
+                 matrix: sparse.csr_matrix,
+                 p_value: np.ndarray,
+                 log2fc: np.ndarray):
+        self.analysis_ids = analysis_ids
+        self.tf_ids = tf_ids
+        self.tf_names = tf_names
+        self.expression = expression
+        self.target_ids = target_ids
+        self.matrix = matrix
+        self.p_value = p_value
+        self.log2fc = log2fc
+
+        self.version: Optional[str] = None  # data version the store was loaded from
+        self.checked = time.monotonic()
+
+        self._tf_upper = pd.Series(tf_names, dtype=object).str.upper().values
+
+    @classmethod
+    def from_frames(cls,
+                    analyses: pd.DataFrame,
+                    interactions: pd.DataFrame,
+                    regulations: pd.DataFrame,
+                    expressions: Iterable[int]) -> 'InteractionStore':
+        """
+        Build store from table dumps
+
+        :param analyses: columns: id, tf_id, tf_name
+        :param interactions: columns: analysis_id, target_id
+        :param regulations: columns: analysis_id, target_id, p_value, foldchange
+        :param expressions: ids of expression analyses
+        :return:
+        """
+        analyses = analyses.sort_values('id')
+        analysis_ids = analyses['id'].values.astype(np.int64)
+
+        if not regulations.empty:
+            edges = interactions.merge(regulations, on=['analysis_id', 'target_id'], how='left')
+        else:
+            edges = interactions.reindex(columns=['analysis_id', 'target_id', 'p_value', 'foldchange'])
+
+        target_ids = np.unique(edges['target_id'].values.astype(np.int64))
+
+        rows = np.searchsorted(analysis_ids, edges['analysis_id'].values.astype(np.int64))
+        cols = np.searchsorted(target_ids, edges['target_id'].values.astype(np.int64))
+        order = np.lexsort((cols, rows))
+
+        indptr = np.zeros(analysis_ids.size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=analysis_ids.size), out=indptr[1:])
+
+        matrix = sparse.csr_matrix((np.ones(order.size, dtype=np.bool_), cols[order], indptr),
+                                   shape=(analysis_ids.size, target_ids.size))
+
+        return cls(
+            analysis_ids=analysis_ids,
+            tf_ids=analyses['tf_id'].values.astype(np.int64),
+            tf_names=analyses['tf_name'].values,
+            expression=np.isin(analysis_ids, np.fromiter(expressions, dtype=np.int64)),
+            target_ids=target_ids,
+            matrix=matrix,
+            p_value=edges['p_value'].values.astype(np.float64)[order],
+            log2fc=edges['foldchange'].values.astype(np.float64)[order]
+        )
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {
+            'analysis_ids': self.analysis_ids,
+            'tf_ids': self.tf_ids,
+            'tf_names': self.tf_names.astype(str),
+            'expression': self.expression,
+            'target_ids': self.target_ids,
+            'data': self.matrix.data,
+            'indices': self.matrix.indices,
+            'indptr': self.matrix.indptr,
+            'p_value': self.p_value,
+            'log2fc': self.log2fc
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> 'InteractionStore':
+        """
+        Build store from arrays of to_arrays, without copying the edge arrays
+        :param arrays:
+        :return:
+        """
+        matrix = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                                   shape=(arrays['analysis_ids'].size, arrays['target_ids'].size),
+                                   copy=False)
+
+        return cls(
+            analysis_ids=arrays['analysis_ids'],
+            tf_ids=arrays['tf_ids'],
+            tf_names=arrays['tf_names'].astype(object),
+            expression=arrays['expression'],
+            target_ids=arrays['target_ids'],
+            matrix=matrix,
+            p_value=arrays['p_value'],
+            log2fc=arrays['log2fc']
+        )
+
+    @property
+    def expressions(self) -> np.ndarray:
+        return self.analysis_ids[self.expression]
+
+    def get_analyses(self, tfs: Union[str, Iterable[str]]) -> np.ndarray:
+        """
+        Get analysis ids for TFs by gene id (case insensitive)
+        :param tfs:
+        :return:
+        """
+        if isinstance(tfs, str):
+            tfs = [tfs]
+
+        return self.analysis_ids[np.isin(self._tf_upper, [t.upper() for t in tfs])]
+
+    def get_tf_id(self, analysis_id: int) -> int:
+        return self.tf_ids[np.searchsorted(self.analysis_ids, analysis_id)]
+
+    def get_tfs(self) -> pd.DataFrame:
+        return pd.DataFrame({'ANALYSIS': self.analysis_ids, 'TF': self.tf_names}, columns=['ANALYSIS', 'TF'])
+
+    def get_rows(self, analysis_ids: Optional[Iterable[int]] = None) -> np.ndarray:
+        if analysis_ids is None:
+            return np.arange(self.analysis_ids.size)
+
+        return np.flatnonzero(np.isin(self.analysis_ids, np.asarray(analysis_ids, dtype=np.int64)))
+
+    def get_target_mask(self,
+                        analysis_ids: Optional[Iterable[int]] = None,
+                        universe: Optional[np.ndarray] = None,
+                        every: bool = False) -> np.ndarray:
+        """
+        Get a boolean mask over target_ids of the targets of analyses
+        :param analysis_ids: all analyses if None
+        :param universe: mask of the targets to consider, all if None
+        :param every: only keep targets of every analysis with targets in universe
+        :return:
+        """
+        matrix = self.matrix[self.get_rows(analysis_ids)]
+        indices = matrix.indices
+        rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+
+        if universe is not None:
+            keep = universe[indices]
+            indices, rows = indices[keep], rows[keep]
+
+        if every:
+            return np.bincount(indices, minlength=self.target_ids.size) == max(np.unique(rows).size, 1)
+
+        mask = np.zeros(self.target_ids.size, dtype=np.bool_)
+        mask[indices] = True
+
+        return mask
+
+    def get_edges(self, analysis_ids: Optional[Iterable[int]] = None) -> pd.DataFrame:
+        """
+        Get edges of analyses in long format, equivalent to the Interaction table left joined with Regulation
+
+        :param analysis_ids: all analyses if None
+        :return:
+        """
+        rows = self.get_rows(analysis_ids)
+
+        starts = self.matrix.indptr[rows]
+        counts = self.matrix.indptr[rows + 1] - starts
+        idx = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+        return pd.DataFrame({
+            'id': self.target_ids[self.matrix.indices[idx]],
+            'ANALYSIS': np.repeat(self.analysis_ids[rows], counts),
+            'Pvalue': self.p_value[idx],
+            'Log2FC': self.log2fc[idx]
+        }, columns=['id', 'ANALYSIS', 'Pvalue', 'Log2FC'])
+
+
+def load_interaction_store(analyses: Optional[QuerySet] = None) -> InteractionStore:
+    """
+    Load analyses into a store with one query per table
+    :param analyses: all analyses if None
+    :return:
+    """
+    interactions = Interaction.objects.all()
+    regulations = Regulation.objects.all()
+    expressions = AnalysisData.objects.filter(key__name='EXPERIMENT_TYPE', value__iexact='expression')
+
+    if analyses is None:
+        analyses = Analysis.objects.all()
+    else:
+        interactions = interactions.filter(analysis__in=analyses)
+        regulations = regulations.filter(analysis__in=analyses)
+        expressions = expressions.filter(analysis__in=analyses)
+
+    return InteractionStore.from_frames(
+        pd.DataFrame(analyses.values_list('id', 'tf_id', 'tf__gene_id').iterator(),
+                     columns=['id', 'tf_id', 'tf_name']),
+        pd.DataFrame(interactions.values_list('analysis_id', 'target_id').iterator(),
+                     columns=['analysis_id', 'target_id']),
+        pd.DataFrame(regulations.values_list('analysis_id', 'target_id', 'p_value', 'foldchange').iterator(),
+                     columns=['analysis_id', 'target_id', 'p_value', 'foldchange']),
+        expressions.values_list('analysis_id', flat=True))
+
+
+def load_store_snapshot() -> InteractionStore:
+    """
+    Load store from the snapshot of the current data version, or from the database and save a snapshot if there
+    is none
+    :return:
+    """
+    version = get_data_version()
+
+    try:
+        arrays = read_snapshot('interactions', version)
+    except (OSError, ValueError):
+        # snapshot removed or replaced while reading
+        logger.warning("Could not read interaction snapshot.", exc_info=True)
+        arrays = None
+
+    if arrays is not None:
+        store = InteractionStore.from_arrays(arrays)
+    else:
+        store = load_interaction_store()
+
+        try:
+            write_snapshot('interactions', version, store.to_arrays())
+        except OSError:
+            logger.warning("Could not save interaction snapshot.", exc_info=True)
+
+    store.version = version
+
+    return store
+
+
+@skip_for_management
+def get_interaction_store() -> Optional[InteractionStore]:
+    """
+    Load store from the snapshot of the current data version, or from the database if there is none
+    :return:
+    """
+    try:
+        return load_store_snapshot()
+    except DatabaseError:
+        logger.warning("Could not load interactions into memory, falling back to database queries.")
+        return None
+
+
+async_loader['interactions'] = get_interaction_store
+
+reload_lock = threading.Lock()
+reloading: Optional[Future] = None
+last_reload = -np.inf
+
+
+def get_store() -> Optional[InteractionStore]:
+    """
+    Get the interaction store if it holds the current version of the edge tables
+
+    A store older than the database is reloaded in the background, queries fall back to the database until the
+    new store is loaded.
+
+    :return: None if the store is not loaded or out of date
+    """
+    global reloading, last_reload
+
+    store = async_loader['interactions']
+
+    if store is None:
+        return None
+
+    with reload_lock:
+        if reloading is not None:
+            if not reloading.done():
+                return None
+
+            try:
+                new_store = reloading.result()
+            except Exception:
+                logger.warning("Could not reload interactions.", exc_info=True)
+                new_store = None
+
+            reloading = None
+
+            if new_store is not None:
+                async_loader['interactions'] = store = new_store
+
+        if time.monotonic() - store.checked > CHECK_INTERVAL:
+            store.checked = time.monotonic()
+
+            try:
+                if get_data_version() != store.version:
+                    store.version = None
+            except DatabaseError:
+                logger.warning("Could not check interaction version.")
+
+        if store.version is None:
+            if reloading is None and time.monotonic() - last_reload > CHECK_INTERVAL:
+                last_reload = time.monotonic()
+                reloading = async_loader.pool.submit(get_interaction_store)
+
+            return None
+
+    return store
+
+
+def get_store_version() -> str:
+    """
+    Version of the edge tables that queries are answered from, by the store or the database
+    """
+    store = get_store()
+
+    if store is not None:
+        return store.version
+
+    return get_data_version()
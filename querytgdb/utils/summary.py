@@ -11,6 +11,7 @@ from django.core.cache import cache
 
 from ..models import Analysis
 from ..utils import clear_data, data_to_edges
+from ..utils.results import load_result
 
 logger = logging.getLogger(__name__)
 
@@ -21,8 +22,8 @@ def rename_tf(name: Tuple[str, str, str], gene_name_symbol: str) -> str:
 
 def get_summary(uid: Union[UUID, str], size_limit: int = 50) -> Dict[str, Any]:
     try:
-        cached_data = cache.get_many([f"{uid}/tabular_output", f"{uid}/analysis_ids"])
-        df, ids = itemgetter(f"{uid}/tabular_output", f"{uid}/analysis_ids")(cached_data)
+        df = load_result(uid, 'tabular_output', ['EDGE', 'Log2FC'])
+        ids = cache.get_many([f"{uid}/analysis_ids"])[f"{uid}/analysis_ids"]
     except KeyError as e:
         raise ValueError('data not found') from e
 
@@ -0,0 +1,158 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Dict, Iterable, NamedTuple, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+from querytgdb.models import Annotation
+from querytgdb.utils import load_annotations, skip_for_management
+from querytgdb.utils.parser import NAMED_QUERIES, get_cache_version, get_query_digest, parse_query
+from querytgdb.utils.results import link_result, save_result
+from querytgdb.utils.snapshot import get_frame, get_table_version
+from querytgdb.utils.store import load_store_snapshot
+
+logger = logging.getLogger(__name__)
+
+# seconds a worker may hold the lock on computing a shared named query result
+LOCK_TIMEOUT = 600
+
+
+class Timing(NamedTuple):
+    name: str
+    seconds: float
+    error: Optional[BaseException] = None
+
+
+def warm_interactions():
+    load_store_snapshot()
+
+
+def warm_annotations():
+    get_frame('annotations', get_table_version(Annotation), load_annotations)
+
+
+def warm_motif_annotations(path: str):
+    from querytgdb.utils.motif_enrichment.motif import read_annotation_file
+
+    read_annotation_file(path)
+
+
+def warm_motif_regions():
+    """
+    Build the gene × cluster motif count matrices of each region, in the memory of the current process
+    """
+    from querytgdb.utils.motif_enrichment import ADD_MOTIFS, MOTIFS
+
+    for motif_data in (MOTIFS, ADD_MOTIFS):
+        for region in motif_data.regions:
+            motif_data.region_matrix(region)
+
+
+def warm_named_query(query: str):
+    """
+    Compute the result of a named query and share it under its digest, see link_result
+
+    Only one process computes a result at a time, others leave it to the process holding the lock.
+    """
+    version = get_cache_version()
+    digest = get_query_digest(query, version=version)
+    uid = f'shared/{digest}'
+
+    if link_result(uid, 'tabular_output_unfiltered', digest):
+        return
+
+    lock = f'{uid}/warming'
+
+    if not cache.add(lock, os.getpid(), LOCK_TIMEOUT):
+        logger.info("Named query %s is being warmed by another process.", query)
+        return
+
+    try:
+        result = parse_query(query)
+
+        if get_cache_version() == version:
+            save_result(uid, 'tabular_output_unfiltered', result, digest)
+    finally:
+        cache.delete(lock)
+
+
+def get_tasks(in_process: bool = False) -> Dict[str, Callable[[], None]]:
+    """
+    Get warmup tasks by name
+
+    :param in_process: include tasks that only warm the memory of the current process
+    :return:
+    """
+    tasks = OrderedDict([
+        ('interactions', warm_interactions),
+        ('annotations', warm_annotations),
+        ('motifs', partial(warm_motif_annotations, settings.MOTIF_ANNOTATION)),
+        ('motifs_tf', partial(warm_motif_annotations, settings.MOTIF_TF_ANNOTATION))
+    ])
+
+    if in_process:
+        tasks['motif_regions'] = warm_motif_regions
+
+    for name in NAMED_QUERIES.keys():
+        tasks[f'named_query:{name}'] = partial(warm_named_query, name)
+
+    return tasks
+
+
+def run_task(name: str, func: Callable[[], None]) -> Timing:
+    start = time.perf_counter()
+
+    try:
+        func()
+        return Timing(name, time.perf_counter() - start)
+    except Exception as e:
+        logger.warning("Could not warm %s.", name, exc_info=True)
+        return Timing(name, time.perf_counter() - start, e)
+    finally:
+        connections.close_all()
+
+
+def warm_cache(names: Optional[Iterable[str]] = None,
+               in_process: bool = False,
+               workers: Optional[int] = None) -> Dict[str, Timing]:
+    """
+    Run warmup tasks in parallel
+
+    :param names: names of the tasks to run, all if None
+    :param in_process:
+    :param workers: number of threads
+    :return: timings by task name, in task order
+    """
+    tasks = get_tasks(in_process)
+
+    if names is not None:
+        names = set(names)
+        tasks = OrderedDict((k, v) for k, v in tasks.items() if k in names)
+
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(run_task, name, func) for name, func in tasks.items()]
+
+    return OrderedDict((f.result().name, f.result()) for f in futures)
+
+
+@skip_for_management
+def warm_on_startup():
+    """
+    Warm the motif region caches of a worker process and the shared named query results in the background
+
+    Snapshots are loaded by the async loader already, run the warm_cache command before starting the workers to
+    build them.
+    """
+    if not getattr(settings, 'WARM_CACHE_ON_STARTUP', False):
+        return
+
+    names = [name for name in get_tasks(True) if name == 'motif_regions' or name.startswith('named_query:')]
+
+    threading.Thread(target=warm_cache, args=(names, True), daemon=True).start()
@@ -0,0 +1,214 @@
+import io
+import json
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+
+from querytgdb.utils import PandasJSONEncoder, StreamingJsonResponse
+from querytgdb.utils.formatter import HEADER_LEN
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+COLUMNAR_JSON = 'application/vnd.connectf.columnar+json'
+ARROW_STREAM = 'application/vnd.apache.arrow.stream'
+
+
+def encode_column(col: np.ndarray) -> Dict[str, List]:
+    """
+    Encode a column of formatted rows as the smallest of three layouts
+
+    - sparse: {'index': rows with a value, 'values': their values}
+    - dictionary: {'dictionary': distinct values, 'codes': index into dictionary per row, -1 if empty}
+    - dense: {'values': value per row, null if empty}
+
+    :param col: object array of cells
+    :return:
+    """
+    mask = pd.notna(col)
+    count = int(mask.sum())
+
+    if count * 2 < len(col):
+        index = np.flatnonzero(mask)
+        return {'index': index.tolist(), 'values': col[index].tolist()}
+
+    if all(isinstance(c, str) for c in col[mask]):
+        codes, uniques = pd.factorize(col)
+
+        if len(uniques) * 2 < count:
+            return {'dictionary': uniques.tolist(), 'codes': codes.tolist()}
+
+    return {'values': col.tolist()}
+
+
+class EncodedColumns(Sequence):
+    """
+    Columns of a 2D object array, encoded with encode_column as they are read, so they can be streamed
+    """
+
+    def __init__(self, data: np.ndarray):
+        self.data = data
+
+    def __len__(self):
+        return self.data.shape[1]
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [encode_column(self.data[:, i]) for i in range(*item.indices(len(self)))]
+
+        return encode_column(self.data[:, item])
+
+
+def to_columnar(rows: List[List]) -> Dict[str, Any]:
+    """
+    Split formatted rows into header rows and encoded data columns
+
+    Columns are encoded lazily, see EncodedColumns.
+    """
+    data = np.array(rows[HEADER_LEN:], dtype=object).reshape(-1, len(rows[0]))
+
+    return {
+        'header': rows[:HEADER_LEN],
+        'length': data.shape[0],
+        'data': EncodedColumns(data)
+    }
+
+
+def to_arrow(rows: List[List], **metadata: Any) -> bytes:
+    """
+    Write the data rows as an Arrow IPC stream, one column per table column
+
+    Text columns are dictionary encoded. The header rows and other metadata are JSON encoded in the schema metadata.
+    """
+    data = np.array(rows[HEADER_LEN:], dtype=object).reshape(-1, len(rows[0]))
+    arrays = []
+
+    for i in range(data.shape[1]):
+        arr = pa.array(data[:, i], from_pandas=True)
+
+        if pa.types.is_string(arr.type):
+            arr = arr.dictionary_encode()
+
+        arrays.append(arr)
+
+    table = pa.Table.from_arrays(arrays, names=[str(i) for i in range(data.shape[1])])
+    table = table.replace_schema_metadata({
+        'header': json.dumps(rows[:HEADER_LEN], cls=PandasJSONEncoder),
+        **{k: json.dumps(v, cls=PandasJSONEncoder) for k, v in metadata.items()}
+    })
+
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+    return sink.getvalue()
+
+
+def parse_accept(accept: str) -> List[Tuple[str, float]]:
+    """
+    Parse the media ranges of an Accept header with their quality values, in order
+    """
+    ranges = []
+
+    for part in accept.split(','):
+        media_type, *params = (p.strip() for p in part.split(';'))
+
+        if not media_type:
+            continue
+
+        quality = 1.0
+
+        for param in params:
+            name, _, value = param.partition('=')
+
+            if name.strip().lower() == 'q':
+                try:
+                    quality = min(max(float(value), 0.0), 1.0)
+                except ValueError:
+                    quality = 0.0
+
+        ranges.append((media_type.lower(), quality))
+
+    return ranges
+
+
+def get_quality(ranges: List[Tuple[str, float]], media_type: str) -> Tuple[float, int, int]:
+    """
+    Quality of a media type by the most specific matching range, with its specificity and position for ordering
+    """
+    main_type = media_type.split('/')[0]
+    best = (0.0, -1, 0)
+
+    for position, (media_range, quality) in enumerate(ranges):
+        if media_range == media_type:
+            specificity = 2
+        elif media_range == f'{main_type}/*':
+            specificity = 1
+        elif media_range == '*/*':
+            specificity = 0
+        else:
+            continue
+
+        if specificity > best[1]:
+            best = (quality, specificity, -position)
+
+    return best
+
+
+def negotiate(accept: str, offers: Sequence[str]) -> Optional[str]:
+    """
+    Pick the offered media type the client prefers, earlier offers win ties
+
+    :return: None if no offer is acceptable
+    """
+    ranges = parse_accept(accept)
+    qualities = [(get_quality(ranges, offer), -i, offer) for i, offer in enumerate(offers)]
+    (quality, *_), _, offer = max(qualities)
+
+    if quality <= 0:
+        return None
+
+    return offer
+
+
+def table_response(request, res: Dict[str, Any]) -> HttpResponse:
+    """
+    Respond with a query table in the format asked for in the Accept header
+
+    Arrow streams are only sent if pyarrow is installed, the row-major JSON table is the default. Asking only for
+    Arrow without pyarrow gets a 406.
+
+    :param request:
+    :param res: response with the formatted rows at res['result']['data']
+    :return:
+    """
+    accept = request.META.get('HTTP_ACCEPT', '').strip() or '*/*'
+    offers = ['application/json', COLUMNAR_JSON]
+
+    if pa is not None:
+        offers.append(ARROW_STREAM)
+
+    media_type = negotiate(accept, offers)
+
+    if media_type is None and pa is None and negotiate(accept, [ARROW_STREAM]) is not None:
+        response = HttpResponse('Arrow streams are not available', status=406, content_type='text/plain')
+    elif media_type == ARROW_STREAM:
+        result = res['result']
+        response = HttpResponse(to_arrow(result['data'],
+                                         **{k: v for k, v in result.items() if k != 'data'},
+                                         **{k: v for k, v in res.items() if k != 'result'}),
+                                content_type=ARROW_STREAM)
+    elif media_type == COLUMNAR_JSON:
+        response = StreamingJsonResponse({**res, 'result': {**res['result'], **to_columnar(res['result']['data'])}},
+                                         ('result', 'data'), chunk_size=16, content_type=COLUMNAR_JSON)
+    else:
+        response = StreamingJsonResponse(res, ('result', 'data'))
+
+    patch_vary_headers(response, ['Accept'])
+
+    return response
@@ -7,35 +7,41 @@ import shutil
 import tempfile
 import warnings
 from itertools import chain
-from operator import itemgetter
 from threading import Lock
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 from uuid import uuid4
 
 import matplotlib
+import numpy as np
 from django.conf import settings
 from django.core.cache import cache
 from django.core.files.storage import FileSystemStorage
-from django.http import FileResponse, Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, JsonResponse
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, \
+    HttpResponseNotFound, JsonResponse
 from django.utils.datastructures import MultiValueDictKeyError
 from django.views.generic import View
 from jsonschema import ValidationError, validate
 
+from querytgdb.cache import stats as cache_stats
 from querytgdb.utils.export import create_export_zip, export_csv, write_excel
 from querytgdb.utils.gene_list_enrichment import gene_list_enrichment
 from .utils import GzipFileResponse, NetworkJSONEncoder, PandasJSONEncoder, check_annotations, \
     convert_float, metadata_to_dict, svg_font_adder
 from .utils.analysis_enrichment import AnalysisEnrichmentError, analysis_enrichment, analysis_enrichment_csv
+from .utils.artifacts import artifacts
 from .utils.file import BadFile, filter_gene_lists_by_background, get_background_genes, get_file, get_gene_lists, \
     get_genes, get_network, merge_network_filter_tfs, merge_network_lists, network_to_filter_tfs, network_to_lists
-from .utils.formatter import format_data
+from .utils.formatter import cache_row_chunks, format_data, get_cached_row_order, get_chunked_rows, get_data_columns, \
+    update_formatted_data
 from .utils.motif_enrichment import ADD_MOTIFS, MOTIFS, MotifEnrichmentError, NoEnrichedMotif, \
     get_additional_motif_enrichment_json, get_motif_enrichment_heatmap, get_motif_enrichment_heatmap_table, \
     get_motif_enrichment_json
 from .utils.motif_enrichment.motif import AdditionalMotifData, MotifData
 from .utils.network import get_auc_figure, get_network_json, get_network_sif, get_network_stats, get_pruned_network
 from .utils.parser import Ids, QueryError, filter_df_by_ids, get_query_result, reorder_data
+from .utils.results import load_result, save_result
 from .utils.summary import get_summary
+from .utils.wire import table_response
 
 logger = logging.getLogger(__name__)
 
@@ -45,6 +51,50 @@ gene_lists_storage = FileSystemStorage(settings.GENE_LISTS)
 networks_storage = FileSystemStorage(settings.TARGET_NETWORKS)
 
 
+def get_formatted_output(request_id) -> Tuple[List[Dict], List[Dict], List[List], Dict, Ids]:
+    """
+    Get the formatted table of a query from the cache, or format it again from the query result
+
+    :param request_id:
+    :return: column formats, merged cells, rows, metadata and analysis ids
+    :raises KeyError: if the query is not available
+    """
+    cached_data = cache.get_many([f'{request_id}/formatted_tabular_output', f'{request_id}/analysis_ids'])
+
+    try:
+        columns, merged_cells, result_list, metadata = cached_data[f'{request_id}/formatted_tabular_output']
+        ids = cached_data[f'{request_id}/analysis_ids']
+    except KeyError:
+        result, metadata, stats, _uid, ids = get_query_result(size_limit=50_000_000, uid=request_id)
+
+        columns, merged_cells, result_list = format_data(result, stats, metadata, ids)
+        metadata = metadata_to_dict(metadata)
+
+        cache.set_many({
+            f'{request_id}/formatted_tabular_output': (columns, merged_cells, result_list, metadata),
+            f'{request_id}/formatted_columns': get_data_columns(result)
+        })
+        artifacts.invalidate(request_id, 'formatted_tabular_output')
+
+    return columns, merged_cells, result_list, metadata, ids
+
+
+def get_row_chunks(request_id) -> Dict:
+    """
+    Get the formatted table of a query cached in chunks of rows, see cache_row_chunks
+
+    :param request_id:
+    :return:
+    :raises KeyError: if the query is not available
+    """
+
+    def chunk_rows():
+        columns, merged_cells, result_list, _metadata, _ids = get_formatted_output(request_id)
+        return cache_row_chunks(request_id, columns, merged_cells, result_list)
+
+    return artifacts.get_or_set(request_id, 'row_chunks', chunk_rows)
+
+
 class QueryView(View):
     """
     Endpoint for new query or get cached queries
@@ -52,10 +102,7 @@ class QueryView(View):
 
     def get(self, request, request_id):
         try:
-            cached_data = cache.get_many([f'{request_id}/formatted_tabular_output', f'{request_id}/analysis_ids'])
-
-            columns, merged_cells, result_list, metadata = cached_data[f'{request_id}/formatted_tabular_output']
-            ids = cached_data[f'{request_id}/analysis_ids']
+            columns, merged_cells, result_list, metadata, ids = get_formatted_output(request_id)
 
             res = {
                 'result': {
@@ -68,31 +115,9 @@ class QueryView(View):
                 'analysis_ids': list(ids.items())
             }
 
-            return JsonResponse(res, encoder=PandasJSONEncoder)
+            return table_response(request, res)
         except KeyError:
-            try:
-                result, metadata, stats, _uid, ids = get_query_result(size_limit=50_000_000,
-                                                                      uid=request_id)
-
-                columns, merged_cells, result_list = format_data(result, stats, metadata, ids)
-                metadata = metadata_to_dict(metadata)
-
-                cache.set(f'{request_id}/formatted_tabular_output', (columns, merged_cells, result_list, metadata))
-
-                res = {
-                    'result': {
-                        'data': result_list,
-                        'mergeCells': merged_cells,
-                        'columns': columns
-                    },
-                    'metadata': metadata,
-                    'request_id': request_id,
-                    'analysis_ids': list(ids.items())
-                }
-
-                return JsonResponse(res, encoder=PandasJSONEncoder)
-            except KeyError:
-                raise Http404('Query not available')
+            raise Http404('Query not available')
 
     def post(self, request, *args, **kwargs):
         errors = []
@@ -176,6 +201,7 @@ class QueryView(View):
             cache.set_many({
                 f'{request_id}/query': query.strip() + '\n',  # save queries
                 f'{request_id}/formatted_tabular_output': (columns, merged_cells, result_list, metadata),
+                f'{request_id}/formatted_columns': get_data_columns(result)
             })
 
             res = {
@@ -192,7 +218,7 @@ class QueryView(View):
             if errors:
                 res['errors'] = errors
 
-            return JsonResponse(res, encoder=PandasJSONEncoder)
+            return table_response(request, res)
         except (QueryError, BadFile) as e:
             return HttpResponseBadRequest(e)
         except ValueError as e:
@@ -201,6 +227,63 @@ class QueryView(View):
             return HttpResponseBadRequest(f"Problem with query: {e}")
 
 
+class QueryRowsView(View):
+    """
+    Window of the rows of a query table, sorted and filtered on the server
+    """
+    max_limit = 1000
+
+    def get(self, request, request_id):
+        try:
+            offset = int(request.GET.get('offset', 0))
+            limit = int(request.GET.get('limit', 100))
+            sort = request.GET.get('sort')
+            descending = False
+
+            if sort:
+                descending = sort.startswith('-')
+                sort = int(sort.lstrip('-'))
+            else:
+                sort = None
+
+            if offset < 0 or not 0 < limit <= self.max_limit:
+                raise ValueError('offset or limit out of range')
+        except ValueError as e:
+            return HttpResponseBadRequest(f'Bad window: {e}')
+
+        for retry in (False, True):
+            try:
+                row_chunks = get_row_chunks(request_id)
+            except KeyError:
+                raise Http404('Query not available')
+
+            def get_rows():
+                return row_chunks['header'] + get_chunked_rows(request_id, row_chunks, np.arange(row_chunks['total']))
+
+            try:
+                order = get_cached_row_order(request_id, row_chunks['columns'], get_rows, sort, descending,
+                                             request.GET.get('filter'))
+                rows = get_chunked_rows(request_id, row_chunks, order[offset:offset + limit])
+                break
+            except ValueError as e:
+                return HttpResponseBadRequest(e)
+            except KeyError:  # chunks evicted from the cache, cut them again once
+                if retry:
+                    raise Http404('Query not available')
+
+                artifacts.discard(request_id, 'row_chunks')
+
+        return JsonResponse({
+            'header': row_chunks['header'],
+            'data': rows,
+            'mergeCells': row_chunks['merged_cells'],
+            'columns': row_chunks['columns'],
+            'total': len(order),
+            'offset': offset,
+            'limit': limit
+        }, encoder=PandasJSONEncoder)
+
+
 ANALYSIS_ID_SCHEMA = {
     "type": "array",
     "items": {
@@ -263,6 +346,8 @@ class EditQueryView(View):
             if not any(v['show'] for v in data.values()):
                 return HttpResponseBadRequest("cannot hide all analyses")
 
+            prev_ids = dict(ids)
+
             for key in ids:
                 try:
                     if ids[key]['name'] != data[key]['name']:
@@ -272,49 +357,35 @@ class EditQueryView(View):
                 except KeyError:
                     pass
 
+            renamed = {k for k, v in ids.items() if v['name'] != prev_ids[k]['name']}
+            toggled = {k for k, v in ids.items() if v['show'] != prev_ids[k]['show']}
+
             cache.set(f'{request_id}/analysis_ids', ids)
 
-            cached_result = cache.get_many([f'{request_id}/target_genes', f'{request_id}/tabular_output_unfiltered'])
+            if toggled:
+                result = load_result(request_id, 'tabular_output_unfiltered')
+                result = filter_df_by_ids(result, ids)
 
-            result = cached_result[f'{request_id}/tabular_output_unfiltered']
-            result = filter_df_by_ids(result, ids)
+                try:
+                    user_lists = cache.get_many([f'{request_id}/target_genes'])[f'{request_id}/target_genes']
+                    result = result[result.index.str.upper().isin(user_lists[0].index.str.upper())].dropna(
+                        axis=1, how='all')
 
-            try:
-                user_lists = cached_result[f'{request_id}/target_genes']
-                result = result[result.index.str.upper().isin(user_lists[0].index.str.upper())].dropna(axis=1,
-                                                                                                       how='all')
+                    if result.empty:
+                        raise QueryError("Empty result (user list too restrictive).")
 
-                if result.empty:
-                    raise QueryError("Empty result (user list too restrictive).")
+                    result = reorder_data(result)
+                except KeyError:
+                    pass
 
-                result = reorder_data(result)
-            except KeyError:
-                pass
-
-            cache.set(f'{request_id}/tabular_output', result)  # refresh filtered tabular output
-
-            # delete cache keys and refresh cache here.
-            cache.delete_many([
-                # formatted output
-                f'{request_id}/formatted_tabular_output',
-                # network
-                f'{request_id}/network',
-                # AUPR curve
-                f'{request_id}/figure',
-                f'{request_id}/figure_data',
-                # network stats
-                f'{request_id}/stats',
-                # Gene list enrichment
-                f'{request_id}/list_enrichment',
-                f'{request_id}/list_enrichment_legend',
-                f'{request_id}/list_enrichment_data',
-                # motif enrichment
-                *(f'{request_id}/{r}_enrich' for r in MOTIFS.regions),
-                # analysis enrichment
-                f'{request_id}/analysis_enrichment',
-                # summary
-                f'{request_id}/summary'
-            ])
+                artifacts.invalidate(request_id, 'analysis_ids', keep=['formatted_tabular_output'])
+                save_result(request_id, 'tabular_output', result)  # refresh filtered tabular output
+            else:
+                # renaming leaves the filtered tabular output as is
+                artifacts.invalidate(request_id, 'analysis_ids', keep=['tabular_output', 'formatted_tabular_output'])
+
+            if (renamed or toggled) and not update_formatted_data(request_id, ids, renamed, toggled):
+                artifacts.discard(request_id, 'formatted_tabular_output')
 
             return JsonResponse(list(ids.items()), status=201, safe=False, encoder=PandasJSONEncoder)
         except (json.JSONDecodeError, ValidationError, QueryError) as e:
@@ -334,15 +405,11 @@ class NetworkAuprView(View):
 
                 cached_data = cache.get_many([
                     f'{request_id}/target_network',
-                    f'{request_id}/tabular_output_unfiltered',
                     f'{request_id}/analysis_ids'
                 ])
 
-                df, ids = itemgetter(
-                    f'{request_id}/tabular_output_unfiltered',
-                    f'{request_id}/analysis_ids'
-                )(cached_data)
-                df = filter_df_by_ids(df, ids)
+                df = load_result(request_id, 'tabular_output_unfiltered', ['EDGE', 'Log2FC'])
+                df = filter_df_by_ids(df, cached_data[f'{request_id}/analysis_ids'])
 
                 result = get_auc_figure(cached_data[f'{request_id}/target_network'],
                                         df,
@@ -382,18 +449,12 @@ class NetworkPrunedView(View):
 class StatsView(View):
     def get(self, request, request_id):
         try:
-            data_cache = f'{request_id}/tabular_output'
-            stats_cache = f'{request_id}/stats'
-
-            stats = cache.get(stats_cache)
-
-            if stats is None:
-                try:
-                    stats = get_network_stats(cache.get(data_cache))
-                except AttributeError:
-                    raise Http404('Stats not available')
-
-                cache.set(stats_cache, stats)
+            try:
+                stats = artifacts.get_or_set(
+                    request_id, 'stats',
+                    lambda: get_network_stats(load_result(request_id, 'tabular_output', ['EDGE', 'Log2FC'])))
+            except KeyError:
+                raise Http404('Stats not available')
 
             return JsonResponse(stats, encoder=PandasJSONEncoder)
         except FileNotFoundError:
@@ -705,11 +766,7 @@ class MotifEnrichmentAdditionalMotifsView(View):
 class AnalysisEnrichmentView(View):
     def get(self, request, request_id):
         try:
-            result = cache.get(f'{request_id}/analysis_enrichment')
-
-            if result is None:
-                result = analysis_enrichment(request_id)
-                cache.set(f'{request_id}/analysis_enrichment', result)
+            result = artifacts.get_or_set(request_id, 'analysis_enrichment', lambda: analysis_enrichment(request_id))
 
             return JsonResponse(result, encoder=PandasJSONEncoder)
         except AnalysisEnrichmentError as e:
@@ -733,18 +790,31 @@ class AnalysisEnrichmentCsvView(View):
 
 class SummaryView(View):
     def get(self, request, request_id):
-        result = cache.get(f'{request_id}/summary')
-
-        if result is None:
-            try:
-                result = get_summary(request_id)
-                cache.set(f'{request_id}/summary', result)
-            except ValueError as e:
-                return HttpResponseNotFound(e)
+        try:
+            result = artifacts.get_or_set(request_id, 'summary', lambda: get_summary(request_id))
+        except ValueError as e:
+            return HttpResponseNotFound(e)
 
         return JsonResponse(result, encoder=PandasJSONEncoder)
 
 
+class ArtifactStatusView(View):
+    def get(self, request, request_id):
+        return JsonResponse(artifacts.status(request_id))
+
+
+class CacheStatsView(View):
+    def get(self, request):
+        if not (settings.DEBUG or getattr(settings, 'CACHE_STATS_ENABLED', False)):
+            return HttpResponseForbidden()
+
+        return JsonResponse({
+            'pid': os.getpid(),
+            'codec': getattr(cache, 'codec', None),
+            'families': cache_stats.to_dict()
+        })
+
+
 class ListDownloadView(View):
     def head(self, request, list_name):
         files = chain(gene_lists_storage.listdir('.')[1], networks_storage.listdir('.')[1])
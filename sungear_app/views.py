@@ -2,7 +2,7 @@ import json
 import logging
 from collections import OrderedDict
 from functools import reduce
-from operator import itemgetter, or_
+from operator import or_
 from typing import Dict, List, Tuple
 
 import pandas as pd
@@ -13,6 +13,7 @@ from sungear import SungearException, sungear
 
 from querytgdb.models import Analysis
 from querytgdb.utils import PandasJSONEncoder, async_loader, clear_data, get_metadata
+from querytgdb.utils.results import load_result
 
 logger = logging.getLogger(__name__)
 
@@ -38,11 +39,8 @@ def make_meta_dict(col, metadata, ids):
 
 def get_sungear(uid, filter_genes: List[str] = None) -> Tuple[Dict, bool]:
     try:
-        cached_data = cache.get_many([f'{uid}/tabular_output', f'{uid}/analysis_ids'])
-        df, ids = itemgetter(
-            f'{uid}/tabular_output',
-            f'{uid}/analysis_ids'
-        )(cached_data)
+        df = load_result(uid, 'tabular_output', ['EDGE', 'Log2FC'])
+        ids = cache.get_many([f'{uid}/analysis_ids'])[f'{uid}/analysis_ids']
     except KeyError as e:
         raise SungearNotFound() from e
 